@@ -1,6 +1,5 @@
-import json
 import os
-from flask import Flask, Response, request, send_from_directory
+from flask import Flask, request, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
@@ -11,7 +10,8 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        DATABASE_PROFILE="default"
     )
     
     if test_config is None:
@@ -26,26 +26,58 @@ def create_app(test_config=None):
 
     db.init_app(app)
 
+    from . import serializers
+    serializers.init_app(app)
+
+    from . import database
+    database.init_app(app)
+
+    from . import cache
+    cache.init_app(app)
+
+    from . import events
+    events.init_app(app)
+
+    from . import limits
+    limits.init_app(app)
+
     # add CLI commands
     from . import models
     from . import api
+    from . import validation
+    validation.register_validator(models.Book)
+    validation.register_validator(models.Book, partial=True)
     app.cli.add_command(models.init_db_command)
+    app.cli.add_command(models.upgrade_db_command)
+    app.cli.add_command(models.rebuild_search_index_command)
+    app.cli.add_command(models.compact_changes_command)
     app.cli.add_command(models.delete_db_command)
     app.cli.add_command(models.insert_initial_data)
+    from . import bulk
+    app.cli.add_command(bulk.import_books_command)
+    app.cli.add_command(bulk.export_books_command)
     app.register_blueprint(api.api_bp)
 
+    from . import metrics
+    metrics.init_app(app)
+
+    # registered after metrics so that compression runs first and counts
+    # towards the request time
+    from . import compression
+    compression.init_app(app)
+
     # API start route
-    from .utils import LibraryBuilder
+    from .utils import LibraryBuilder, render_mason
     @app.route("/api/", methods=["GET"])
     def entry():
         body = LibraryBuilder()
         body.add_namespace("library", "/api/")
         body.add_control_get_books()
-        return Response(
-            json.dumps(body, indent=4),
-            200,
-            mimetype="application/vnd.mason+json"
-        )
+        return render_mason(body)
+
+    if app.config.get("PRELOAD"):
+        from . import preload
+        preload.preload(app)
     
     return app
 
@@ -1,10 +1,21 @@
 from flask import Blueprint
 from flask_restful import Api
 
-from api.resources.book import BookCollection, BookItem
+from api import limits
+from api.resources.batch import BookBatch
+from api.resources.events import BookEvents
+from api.resources.book import (
+    BookChanges, BookCollection, BookItem, BookSchema
+)
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
+api_bp.before_request(limits.admit_request)
+api_bp.teardown_request(limits.release_request)
 
 api.add_resource(BookCollection, "/books/")
 api.add_resource(BookItem, "/books/<book_id>/")
+api.add_resource(BookBatch, "/books/batch/")
+api.add_resource(BookChanges, "/books/changes/")
+api.add_resource(BookEvents, "/books/events/")
+api.add_resource(BookSchema, "/schemas/book/")
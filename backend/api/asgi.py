@@ -0,0 +1,354 @@
+"""
+Async serving mode. create_asgi_app returns an ASGI application that serves
+reads of the book collection and book items on an async SQLAlchemy engine
+with the aiosqlite driver, so a slow client only holds a coroutine instead
+of a worker thread, and so is the event stream. Everything else, writes
+included, is passed on to the Flask app as a WSGI call on a pool of
+ASGI_WSGI_THREADS threads. Needs the "async" extras:
+
+    pip install aiosqlite uvicorn
+    uvicorn --factory api.asgi:create_asgi_app
+"""
+
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response, request
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from api import create_app, db
+from api.database import WRITE_PRAGMAS, add_pragmas, get_read_engine
+from api.resources.book import read_handler
+from api.resources.events import (
+    EVENT_STREAM, STREAM_HEADERS, open_event_stream
+)
+
+EVENTS_ENDPOINT = "api.bookevents"
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+class WsgiFallback(object):
+    """
+    Serves ASGI requests with a WSGI app, each call on a thread of the
+    given pool, so that a slow request, e.g. a streamed collection read by
+    a slow client, doesn't hold up the other requests that go through the
+    Flask app. The body is read before the call, the response is sent as
+    the app produces it and the thread waits for every message to be sent.
+    """
+
+    def __init__(self, wsgi_application, executor):
+        self.wsgi_application = wsgi_application
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        environ = _build_environ(scope, b"".join(body))
+        # a thread of the pool can wait for a concurrency slot
+        del environ["library.async"]
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, self._run, environ, loop, send
+        )
+
+    def _run(self, environ, loop, send):
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response_start = {}
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response_start.get("sent"):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+
+        def send_body(data, more_body):
+            if not response_start.get("sent"):
+                send_message({
+                    "type": "http.response.start",
+                    "status": response_start["status"],
+                    "headers": response_start["headers"],
+                })
+                response_start["sent"] = True
+            send_message({
+                "type": "http.response.body", "body": data,
+                "more_body": more_body,
+            })
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            for data in result:
+                if data:
+                    send_body(data, True)
+            send_body(b"", False)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+
+class AsyncApp(object):
+    """
+    ASGI application wrapping the Flask app. Reads are run with the same
+    read handlers as the Flask views and the responses go through the
+    after_request hooks of the app, so the output is identical in both
+    modes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            app.config.get("ASGI_WSGI_THREADS", 32),
+            thread_name_prefix="wsgi"
+        )
+        self.wsgi = WsgiFallback(app, self.executor)
+        options = {
+            "poolclass": AsyncAdaptedQueuePool,
+            "pool_size": 5,
+            "max_overflow": 10,
+        }
+        options.update(app.config.get("ASYNC_ENGINE_OPTIONS") or {})
+        self.engine = create_async_engine(async_database_uri(app), **options)
+        pragmas = app.config.get("SQLITE_PRAGMAS") or {}
+        self.read_engine = "read_engine" in app.extensions
+        if self.read_engine:
+            pragmas = {
+                pragma: value for pragma, value in pragmas.items()
+                if pragma not in WRITE_PRAGMAS
+            }
+        add_pragmas(self.engine.sync_engine, pragmas)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            return await self.wsgi(scope, receive, send)
+
+        environ = _build_environ(scope)
+        with self.app.request_context(environ):
+            handler = None
+            events = request.endpoint == EVENTS_ENDPOINT \
+                and scope["method"] == "GET"
+            if request.routing_exception is None:
+                handler = read_handler(request.endpoint, request.view_args)
+            if self.read_engine and get_read_engine() is None:
+                # the client has just written, read from the primary
+                handler = None
+            if handler is not None:
+                response = await self._respond(handler)
+                headers = response.get_wsgi_headers(environ)
+                body = response.get_data()
+        if events:
+            return await self._serve_events(environ, receive, send)
+        if handler is None:
+            return await self.wsgi(scope, receive, send)
+
+        await send(_response_start(response, headers))
+        await send({
+            "type": "http.response.body",
+            "body": b"" if scope["method"] == "HEAD" else body,
+        })
+
+    async def _respond(self, handler):
+        try:
+            response = self.app.preprocess_request()
+            if response is None:
+                async with self.engine.connect() as conn:
+                    response = await run_queries_async(handler, conn)
+            response = self.app.make_response(response)
+        except Exception as e:
+            response = self.app.make_response(self.app.handle_exception(e))
+        return self.app.process_response(response)
+
+    async def _serve_events(self, environ, receive, send):
+        """
+        Serves the event stream on the event loop, so that an open stream
+        only holds a coroutine instead of a thread. Subscribing runs on the
+        thread pool as it reads from the database.
+        """
+
+        with self.app.request_context(environ):
+            response, stream = await asyncio.get_running_loop().run_in_executor(
+                self.executor, contextvars.copy_context().run, self._open_events
+            )
+            headers = response.get_wsgi_headers(environ)
+        await send(_response_start(response, headers))
+        if stream is None:
+            await send({"type": "http.response.body", "body": response.get_data()})
+            return
+
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            data = stream.start()
+            while not disconnect.done():
+                await send({
+                    "type": "http.response.body", "body": data,
+                    "more_body": True,
+                })
+                events = asyncio.ensure_future(
+                    stream.subscriber.get_async(stream.heartbeat)
+                )
+                await asyncio.wait(
+                    {events, disconnect}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not events.done():
+                    events.cancel()
+                    break
+                data = stream.format(events.result())
+        finally:
+            disconnect.cancel()
+            stream.close()
+
+    def _open_events(self):
+        stream = None
+        try:
+            response = self.app.preprocess_request()
+            if response is None:
+                response = open_event_stream()
+                if not isinstance(response, Response):
+                    # the body is sent by _serve_events, an empty iterator
+                    # keeps the response streamed without Content-Length
+                    stream = response
+                    response = Response(
+                        iter(()), mimetype=EVENT_STREAM, headers=STREAM_HEADERS
+                    )
+            response = self.app.make_response(response)
+        except Exception as e:
+            response = self.app.make_response(self.app.handle_exception(e))
+        finally:
+            db.session.remove()
+        return self.app.process_response(response), stream
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.engine.dispose()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+async def run_queries_async(handler, conn):
+    """
+    Runs a read handler on an async connection and returns its response,
+    see api.database.run_queries.
+    : param handler: the generator returned by a read handler
+    : param conn: an AsyncConnection
+    """
+
+    try:
+        statement = next(handler)
+        while True:
+            result = await conn.execute(statement)
+            statement = handler.send(result.all())
+    except StopIteration as stop:
+        return stop.value
+
+
+def async_database_uri(app):
+    """
+    Returns the URI of the async engine: ASYNC_DATABASE_URI if it is set,
+    otherwise the URI of the read engine, or SQLALCHEMY_DATABASE_URI if
+    there is none, with the async driver of its dialect.
+    """
+
+    uri = app.config.get("ASYNC_DATABASE_URI")
+    if uri:
+        return uri
+    if "read_engine" in app.extensions:
+        url = app.extensions["read_engine"].url
+    else:
+        url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    try:
+        driver = ASYNC_DRIVERS[url.get_backend_name()]
+    except KeyError:
+        raise ValueError(
+            "No async driver for '{}', set ASYNC_DATABASE_URI".format(
+                url.get_backend_name()
+            )
+        )
+    return str(url.set(drivername=driver))
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def _response_start(response, headers):
+    return {
+        "type": "http.response.start",
+        "status": response.status_code,
+        "headers": [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers.items()
+        ],
+    }
+
+
+def _build_environ(scope, body=b""):
+    """
+    Builds the WSGI environ of a request from its ASGI scope and body.
+    """
+
+    script_name = scope.get("root_path", "")
+    path = scope["path"]
+    if script_name and path.startswith(script_name):
+        path = path[len(script_name):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        # tells admission control not to block the event loop
+        "library.async": True,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = "HTTP_" + name
+        value = value.decode("latin-1")
+        if name in environ:
+            value = environ[name] + "," + value
+        environ[name] = value
+    if body:
+        environ.setdefault("CONTENT_LENGTH", str(len(body)))
+    return environ
+
+
+def create_asgi_app(test_config=None):
+    """
+    Creates the Flask app and wraps it in the ASGI application.
+    : param dict test_config: configuration passed on to create_app
+    """
+
+    return AsyncApp(create_app(test_config))
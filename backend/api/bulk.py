@@ -0,0 +1,256 @@
+import csv
+import json
+import time
+import click
+from flask.cli import with_appcontext
+from api import db
+from api.models import (
+    Book, BookChange, ChangeCounter, rebuild_search_index
+)
+from api.serializers import get_serializer
+from api import validation
+
+FORMATS = ("csv", "ndjson")
+EXTENSIONS = {
+    ".csv": "csv",
+    ".ndjson": "ndjson",
+    ".jsonl": "ndjson",
+}
+COLUMNS = ("book_id", "title", "author", "description")
+FTS_TRIGGERS = ("book_fts_insert", "book_fts_delete", "book_fts_update")
+INSERT_SQL = (
+    "INSERT INTO book (book_id, title, author, description, version, "
+    "updated_at) VALUES (?, ?, ?, ?, 1, CURRENT_TIMESTAMP)"
+)
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_COMMIT_EVERY = 100000
+
+
+def read_rows(stream, fmt):
+    """
+    Reads book documents one at a time from a CSV or NDJSON stream. CSV
+    files need a header row, empty cells are read as missing values and
+    book_id is converted to an integer. Yields tuples of (line, document).
+    : param stream: text stream to read from
+    : param str fmt: "csv" or "ndjson"
+    """
+
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            doc = {
+                key: value for key, value in row.items()
+                if key in COLUMNS and value != ""
+            }
+            if "book_id" in doc:
+                try:
+                    doc["book_id"] = int(doc["book_id"])
+                except ValueError:
+                    pass
+            yield reader.line_num, doc
+    else:
+        for line, text in enumerate(stream, 1):
+            if text.strip():
+                try:
+                    yield line, json.loads(text)
+                except ValueError as e:
+                    raise ValueError("line {}: {}".format(line, e))
+
+
+def import_books(stream, fmt, batch_size=DEFAULT_BATCH_SIZE,
+                 commit_every=DEFAULT_COMMIT_EVERY, fast=False):
+    """
+    Inserts books from a CSV or NDJSON stream with executemany in batches
+    of batch_size rows on the raw DB-API connection, committing every
+    commit_every rows, so memory use does not depend on the size of the
+    file. Documents are validated against the book schema. Books without a
+    book_id get a new one. With fast, the book indexes and the full-text
+    triggers are dropped during the import and rebuilt once at the end,
+    which is much faster for large catalogs. Imported books are not in the
+    change log, which is reset instead. Raises ValueError on an
+    invalid document, rows committed before it stay in the database and
+    the change log is reset for them too.
+    Returns the number of imported books.
+    : param stream: text stream to read from
+    : param str fmt: "csv" or "ndjson"
+    : param int batch_size: number of rows per executemany call
+    : param int commit_every: number of rows per transaction
+    : param bool fast: drop indexes and full-text triggers during the import
+    """
+
+    count = 0
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        if fast:
+            _drop_indexes(cursor)
+            conn.commit()
+        try:
+            validator = validation.get_validator(Book)
+            batch = []
+            pending = 0
+            for line, doc in read_rows(stream, fmt):
+                try:
+                    validator.validate(doc)
+                except validation.ValidationError as e:
+                    raise ValueError("line {}: {}".format(line, e.message))
+                batch.append(tuple(doc.get(name) for name in COLUMNS))
+                if len(batch) >= batch_size:
+                    pending += _insert(cursor, batch, line)
+                    batch = []
+                    if pending >= commit_every:
+                        conn.commit()
+                        count += pending
+                        pending = 0
+            if batch:
+                pending += _insert(cursor, batch, line)
+            conn.commit()
+            count += pending
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if fast:
+                _create_indexes(cursor)
+                conn.commit()
+        cursor.execute("ANALYZE book")
+        conn.commit()
+    finally:
+        conn.close()
+        if fast:
+            rebuild_search_index()
+        # also when a later row fails, the committed batches are imported
+        if count:
+            BookChange.reset()
+            ChangeCounter.bump("book")
+            db.session.commit()
+    return count
+
+
+def export_books(stream, fmt, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Writes every book to a CSV or NDJSON stream in book_id order. Rows are
+    fetched batch_size at a time so memory use does not depend on the size
+    of the catalog. Returns the number of exported books.
+    : param stream: text stream for CSV, binary stream for NDJSON
+    : param str fmt: "csv" or "ndjson"
+    : param int batch_size: number of rows fetched at a time
+    """
+
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(COLUMNS)
+    else:
+        dumps = get_serializer().dumps
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT {} FROM book ORDER BY book_id".format(", ".join(COLUMNS))
+        )
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if fmt == "csv":
+                writer.writerows(rows)
+            else:
+                stream.write(b"".join(
+                    dumps({
+                        name: value for name, value in zip(COLUMNS, row)
+                        if value is not None
+                    }) + b"\n"
+                    for row in rows
+                ))
+            count += len(rows)
+    finally:
+        conn.close()
+    return count
+
+
+def _insert(cursor, batch, line):
+    try:
+        cursor.executemany(INSERT_SQL, batch)
+    except db.engine.dialect.dbapi.IntegrityError as e:
+        raise ValueError("batch ending on line {}: {}".format(line, e))
+    return len(batch)
+
+
+def _drop_indexes(cursor):
+    for name in FTS_TRIGGERS:
+        cursor.execute("DROP TRIGGER IF EXISTS {}".format(name))
+    for index in Book.__table__.indexes:
+        cursor.execute("DROP INDEX IF EXISTS {}".format(index.name))
+
+
+def _create_indexes(cursor):
+    for index in Book.__table__.indexes:
+        cursor.execute("CREATE INDEX IF NOT EXISTS {} ON book ({})".format(
+            index.name, ", ".join(column.name for column in index.columns)
+        ))
+
+
+def _get_format(path, fmt):
+    if fmt is not None:
+        return fmt
+    for extension, name in EXTENSIONS.items():
+        if path.lower().endswith(extension):
+            return name
+    raise click.UsageError(
+        "Can't tell the format of '{}', use --format".format(path)
+    )
+
+
+def _open(path, mode):
+    # csv needs newline="" which click.open_file does not pass on
+    if path == "-":
+        return click.open_file(path, mode)
+    if "b" in mode:
+        return open(path, mode)
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def _report(action, count, elapsed):
+    click.echo("{} {} books in {:.2f} s ({:.0f} rows/s)".format(
+        action, count, elapsed, count / elapsed if elapsed else 0
+    ), err=True)
+
+
+#
+# CLI commands for importing and exporting catalogs
+#
+
+# Imports books from a CSV or NDJSON file, - for stdin
+@click.command("import-books")
+@click.argument("path")
+@click.option("--format", "fmt", type=click.Choice(FORMATS))
+@click.option("--batch-size", type=click.IntRange(1), default=DEFAULT_BATCH_SIZE)
+@click.option("--commit-every", type=click.IntRange(1),
+              default=DEFAULT_COMMIT_EVERY)
+@click.option("--fast", is_flag=True,
+              help="Drop indexes and full-text triggers during the import "
+                   "and rebuild them afterwards.")
+@with_appcontext
+def import_books_command(path, fmt, batch_size, commit_every, fast):
+    fmt = _get_format(path, fmt)
+    start = time.perf_counter()
+    with _open(path, "r") as stream:
+        try:
+            count = import_books(stream, fmt, batch_size, commit_every, fast)
+        except ValueError as e:
+            raise click.ClickException("Import stopped at {}".format(e))
+    _report("Imported", count, time.perf_counter() - start)
+
+# Exports all books to a CSV or NDJSON file, - for stdout
+@click.command("export-books")
+@click.argument("path")
+@click.option("--format", "fmt", type=click.Choice(FORMATS))
+@click.option("--batch-size", type=click.IntRange(1), default=DEFAULT_BATCH_SIZE)
+@with_appcontext
+def export_books_command(path, fmt, batch_size):
+    fmt = _get_format(path, fmt)
+    start = time.perf_counter()
+    with _open(path, "w" if fmt == "csv" else "wb") as stream:
+        count = export_books(stream, fmt, batch_size)
+    _report("Exported", count, time.perf_counter() - start)
@@ -0,0 +1,204 @@
+import threading
+from collections import OrderedDict, namedtuple
+from flask import Response, current_app
+from api.compression import compress_variants, negotiate_encoding
+from api.utils import add_validators
+
+# encoded maps content codings to the compressed body, so that hot
+# responses don't have to be compressed again on every hit
+CachedResponse = namedtuple("CachedResponse", [
+    "body", "status", "mimetype", "etag", "last_modified", "encoded"
+], defaults=[{}])
+
+
+def entry_size(entry):
+    """
+    Returns the number of bytes a cache entry holds.
+    """
+
+    return len(entry.body) + sum(len(data) for data in entry.encoded.values())
+
+
+class CacheBackend(object):
+    """
+    Interface for the storage behind the response cache. The in-process
+    MemoryCache is used with RESPONSE_CACHE = "memory", a backend shared
+    between worker processes (e.g. on top of Redis or memcached) can be plugged in by
+    implementing these methods and setting an instance as the RESPONSE_CACHE
+    config value.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """
+    A thread safe in-process LRU cache that is bounded both by the number of
+    entries and by the total size of the cached bodies in bytes.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        size = entry_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= entry_size(old)
+            self._entries[key] = value
+            self.size += size
+            while (len(self._entries) > self.max_entries
+                   or self.size > self.max_bytes):
+                __, evicted = self._entries.popitem(last=False)
+                self.size -= entry_size(evicted)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= entry_size(old)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResponseCache(object):
+    """
+    Cache for serialized Mason representations of books and pages of the
+    book collection. The keys contain the state of the data in the
+    database, read by the request anyway: the version of a book for its
+    item and the change counter of the book table for the collection. Every
+    write changes them in its own transaction, so an entry of older data is
+    never served again by any worker process, also after writes of other
+    processes such as import-books, and is evicted eventually. Nothing has
+    to be invalidated.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def item_key(self, book_id, version, variant=""):
+        return "book:{}:{}:{}".format(book_id, version, variant)
+
+    def collection_key(self, counter, variant):
+        return "books:{}:{}".format(counter, variant)
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key, response, etag=None, last_modified=None):
+        """
+        Stores a rendered response together with its compressed variants.
+        Only successful responses with a body are cached.
+        : param str key: key from item_key or collection_key
+        : param Response response: the rendered response
+        """
+
+        if response.status_code != 200 or response.is_streamed:
+            return
+        body = response.get_data()
+        self.backend.set(key, CachedResponse(
+            body,
+            response.status_code,
+            response.mimetype,
+            etag,
+            last_modified,
+            compress_variants(body),
+        ))
+
+    @property
+    def stats(self):
+        stats = {"hits": self.hits, "misses": self.misses}
+        if isinstance(self.backend, MemoryCache):
+            stats["entries"] = len(self.backend)
+            stats["bytes"] = self.backend.size
+            stats["evictions"] = self.backend.evictions
+        return stats
+
+
+def init_app(app):
+    """
+    Sets up the response cache from the RESPONSE_CACHE config value, which
+    can be None to disable caching, "memory" for the in-process LRU cache
+    or an instance of a CacheBackend subclass.
+    """
+
+    backend = app.config.get("RESPONSE_CACHE")
+    if backend == "memory":
+        backend = MemoryCache(
+            max_entries=app.config.get("RESPONSE_CACHE_MAX_ENTRIES", 1024),
+            max_bytes=app.config.get(
+                "RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024
+            ),
+        )
+    if backend is None:
+        app.extensions["response_cache"] = None
+    else:
+        app.extensions["response_cache"] = ResponseCache(backend)
+
+
+def get_cache():
+    """
+    Returns the response cache of the current app or None if caching is
+    disabled.
+    """
+
+    return current_app.extensions.get("response_cache")
+
+
+def create_cached_response(entry):
+    """
+    Creates a response from a cache entry, using the stored compressed body
+    if the client accepts one.
+    """
+
+    encoding = negotiate_encoding(len(entry.body))
+    body = entry.encoded.get(encoding)
+    if body is None:
+        encoding = None
+        body = entry.body
+    resp = Response(body, entry.status, mimetype=entry.mimetype)
+    resp.headers["X-Cache"] = "HIT"
+    etag = entry.etag
+    if encoding is not None:
+        resp.headers["Content-Encoding"] = encoding
+        etag = "{}-{}".format(etag, encoding)
+    return add_validators(resp, etag, entry.last_modified)
@@ -0,0 +1,169 @@
+import gzip
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {
+    "application/vnd.mason+json",
+    "application/x-ndjson",
+    "application/schema+json",
+    "application/json",
+}
+# Streamed responses are flushed after this much input so that compressed
+# output keeps flowing to the client instead of piling up in the compressor
+STREAM_FLUSH_SIZE = 64 * 1024
+
+
+def supported_encodings():
+    """
+    Returns the content codings the server can produce, best first.
+    """
+
+    if brotli is not None:
+        return ["br", "gzip"]
+    return ["gzip"]
+
+
+def compress(data, encoding):
+    """
+    Compresses a whole body with the given content coding.
+    : param bytes data: the body to compress
+    : param str encoding: "gzip" or "br"
+    """
+
+    config = current_app.config
+    if encoding == "br":
+        return brotli.compress(
+            data, quality=config["COMPRESSION_BROTLI_QUALITY"]
+        )
+    return gzip.compress(
+        data, compresslevel=config["COMPRESSION_GZIP_LEVEL"], mtime=0
+    )
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compresses an iterable of chunks incrementally so that memory use does
+    not depend on the size of the response. Output is flushed regularly so
+    that the client receives data while the response is still being built.
+    : param chunks: iterable of bytes or str chunks
+    : param str encoding: "gzip" or "br"
+    """
+
+    config = current_app.config
+    if encoding == "br":
+        compressor = brotli.Compressor(
+            quality=config["COMPRESSION_BROTLI_QUALITY"]
+        )
+        compress_chunk, flush = compressor.process, compressor.flush
+        finish = compressor.finish
+    else:
+        compressor = zlib.compressobj(
+            config["COMPRESSION_GZIP_LEVEL"], zlib.DEFLATED, 31
+        )
+        compress_chunk = compressor.compress
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+
+    def generate():
+        pending = 0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                data = compress_chunk(chunk)
+                pending += len(chunk)
+                if pending >= STREAM_FLUSH_SIZE:
+                    data += flush()
+                    pending = 0
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+    return generate()
+
+
+def negotiate_encoding(size=None):
+    """
+    Chooses a content coding for the response to the current request based
+    on its Accept-Encoding header. Returns None if compression is off, the
+    client accepts none of the supported codings or the body is smaller
+    than COMPRESSION_MIN_SIZE.
+    : param int size: size of the body, None for streamed responses
+    """
+
+    config = current_app.config
+    if not config["COMPRESSION"]:
+        return None
+    if size is not None and size < config["COMPRESSION_MIN_SIZE"]:
+        return None
+    return request.accept_encodings.best_match(supported_encodings())
+
+
+def compress_variants(data):
+    """
+    Compresses a body with every supported content coding for storing next
+    to the raw body in the response cache. Returns an empty dict if the body
+    is too small to be worth compressing.
+    : param bytes data: the body to compress
+    """
+
+    config = current_app.config
+    if not config["COMPRESSION"] or len(data) < config["COMPRESSION_MIN_SIZE"]:
+        return {}
+    return {
+        encoding: compress(data, encoding)
+        for encoding in supported_encodings()
+    }
+
+
+def init_app(app):
+    """
+    Sets up response compression. Mason, NDJSON and JSON responses are
+    compressed with brotli (if installed) or gzip according to the
+    Accept-Encoding header of the request. Bodies smaller than
+    COMPRESSION_MIN_SIZE are sent as they are and streamed responses are
+    compressed chunk by chunk. Set COMPRESSION to False to turn it off.
+    """
+
+    app.config.setdefault("COMPRESSION", True)
+    app.config.setdefault("COMPRESSION_MIN_SIZE", 1024)
+    app.config.setdefault("COMPRESSION_GZIP_LEVEL", 6)
+    app.config.setdefault("COMPRESSION_BROTLI_QUALITY", 4)
+
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESSIBLE:
+            return response
+        response.vary.add("Accept-Encoding")
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or request.method == "HEAD"
+                or "Content-Encoding" in response.headers):
+            return response
+
+        if response.is_streamed:
+            encoding = negotiate_encoding()
+            if encoding is None:
+                return response
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            encoding = negotiate_encoding(len(data))
+            if encoding is None:
+                return response
+            response.set_data(compress(data, encoding))
+
+        response.headers["Content-Encoding"] = encoding
+        if response.headers.get("ETag"):
+            etag, weak = response.get_etag()
+            response.set_etag("{}-{}".format(etag, encoding), weak)
+        return response
@@ -0,0 +1,258 @@
+import sqlite3
+import uuid
+from functools import partial
+from urllib.parse import urlencode
+from flask import current_app, request
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from api import db
+
+# Database profiles, selected with the DATABASE_PROFILE config value. The
+# production profile is meant for running several worker processes against
+# one SQLite file: WAL lets readers run alongside the single writer,
+# synchronous=NORMAL is safe in WAL mode and avoids an fsync per commit,
+# and the busy timeout makes writers wait for the lock instead of failing
+# with "database is locked". Connections are pooled so that the per
+# connection pragmas are only run once per connection.
+PROFILES = {
+    "default": {
+        "pragmas": {},
+        "engine_options": {},
+    },
+    "production": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,
+            "cache_size": -64000,
+            "mmap_size": 268435456,
+            "temp_store": "MEMORY",
+        },
+        "engine_options": {
+            "poolclass": QueuePool,
+            "pool_size": 5,
+            "max_overflow": 10,
+            "pool_recycle": 3600,
+            "connect_args": {"check_same_thread": False},
+        },
+    },
+}
+# Pragmas that change the database file and so can't be run on read-only
+# connections
+WRITE_PRAGMAS = ("journal_mode",)
+# Cookie set on write responses when reads go to a replica, so that the
+# client's next reads go to the primary until the replica has caught up
+READ_PRIMARY_COOKIE = "read_primary"
+
+
+def init_app(app):
+    """
+    Applies the database profile chosen with DATABASE_PROFILE to the app.
+    Engine options of the profile are used as defaults for
+    SQLALCHEMY_ENGINE_OPTIONS and pragmas as defaults for SQLITE_PRAGMAS, so
+    single values can be overridden in config.py or the test config. The
+    pragmas are run on every new connection by an engine connect listener.
+    """
+
+    name = app.config.get("DATABASE_PROFILE") or "default"
+    try:
+        profile = PROFILES[name]
+    except KeyError:
+        raise ValueError("Unknown DATABASE_PROFILE '{}'".format(name))
+
+    engine_options = dict(profile["engine_options"])
+    uri = app.config["SQLALCHEMY_DATABASE_URI"]
+    if is_memory_database(uri):
+        # Flask-SQLAlchemy would take the name for a relative file path
+        engine_options["creator"] = partial(connect_memory_database, uri)
+    engine_options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options
+    pragmas = dict(profile["pragmas"])
+    pragmas.update(app.config.get("SQLITE_PRAGMAS") or {})
+    app.config["SQLITE_PRAGMAS"] = pragmas
+
+    if pragmas:
+        with app.app_context():
+            add_pragmas(db.engine, pragmas)
+    if is_memory_database(uri):
+        # SQLite frees a shared in-memory database when its last connection
+        # is closed, which the pool may do at any time, so the app holds a
+        # connection of its own outside of the pool
+        app.extensions["memory_database"] = connect_memory_database(uri)
+    _init_read_engine(app, engine_options, pragmas)
+
+
+def memory_database_uri(name=None):
+    """
+    Returns the URI of a named in-memory SQLite database in shared-cache
+    mode. Unlike "sqlite://", where every connection gets an empty database
+    of its own, all connections of the process opened with the URI share
+    the database, so it can be used from pooled connections, other threads
+    and the async engine. The database lives as long as the app using it.
+    Meant for test fixtures, which then don't need a database file.
+    : param str name: name of the database, a new unique name by default
+    """
+
+    if name is None:
+        name = "library-" + uuid.uuid4().hex
+    return "sqlite:///file:{}?mode=memory&cache=shared&uri=true".format(name)
+
+
+def is_memory_database(uri):
+    """
+    Checks whether a URI points to a named in-memory SQLite database.
+    : param str uri: SQLAlchemy URI of the database
+    """
+
+    url = make_url(uri)
+    return url.get_backend_name() == "sqlite" \
+        and url.query.get("mode") == "memory"
+
+
+def connect_memory_database(uri):
+    """
+    Opens a DB-API connection to a named in-memory SQLite database.
+    : param str uri: URI returned by memory_database_uri
+    """
+
+    url = make_url(uri)
+    query = {name: value for name, value in url.query.items() if name != "uri"}
+    return sqlite3.connect(
+        "{}?{}".format(url.database, urlencode(query)),
+        uri=True, check_same_thread=False
+    )
+
+
+def _init_read_engine(app, engine_options, pragmas):
+    """
+    Creates the engine for read handlers from READ_DATABASE: None to read
+    from the primary database, "readonly" to open the primary SQLite file
+    read-only with a pool of its own, or the URI of a replica. Reads on a
+    replica can lag behind writes, so after a write the client reads from
+    the primary for READ_AFTER_WRITE_SECONDS, which defaults to 5 seconds
+    for replicas and 0 for "readonly" where there is no lag.
+    """
+
+    read_database = app.config.get("READ_DATABASE")
+    if not read_database:
+        return
+    if read_database == "readonly":
+        uri = read_only_uri(app.config["SQLALCHEMY_DATABASE_URI"])
+        app.config.setdefault("READ_AFTER_WRITE_SECONDS", 0)
+    else:
+        uri = read_database
+        app.config.setdefault("READ_AFTER_WRITE_SECONDS", 5)
+
+    options = dict(engine_options)
+    options.update(app.config.get("READ_ENGINE_OPTIONS") or {})
+    engine = app.extensions["read_engine"] = create_engine(uri, **options)
+    add_pragmas(engine, {
+        pragma: value for pragma, value in pragmas.items()
+        if pragma not in WRITE_PRAGMAS
+    })
+
+    seconds = app.config["READ_AFTER_WRITE_SECONDS"]
+    if not seconds:
+        return
+
+    @app.after_request
+    def read_after_write(response):
+        if request.method in ("POST", "PUT", "PATCH", "DELETE") \
+                and response.status_code < 400:
+            response.set_cookie(
+                READ_PRIMARY_COOKIE, "1", max_age=seconds, httponly=True
+            )
+        return response
+
+
+def read_only_uri(uri):
+    """
+    Turns the URI of a SQLite database file into the URI that opens the
+    same file read-only.
+    : param str uri: SQLAlchemy URI of the database
+    """
+
+    url = make_url(uri)
+    if url.get_backend_name() != "sqlite" \
+            or url.database in (None, "", ":memory:") \
+            or url.query.get("mode") == "memory":
+        raise ValueError("READ_DATABASE 'readonly' needs a SQLite file")
+    query = dict(url.query, mode="ro", uri="true")
+    return str(url.set(database="file:" + url.database, query=query))
+
+
+def get_read_engine():
+    """
+    Returns the engine read handlers should use for the current request, or
+    None to use the session on the primary database.
+    """
+
+    engine = current_app.extensions.get("read_engine")
+    if engine is not None and request.cookies.get(READ_PRIMARY_COOKIE):
+        return None
+    return engine
+
+
+def reads_after_write():
+    """
+    Returns True if the client of the current request has written recently
+    and must see its own writes, so its reads bypass the response cache.
+    """
+
+    return bool(request.cookies.get(READ_PRIMARY_COOKIE))
+
+
+def reads_from_replica():
+    """
+    Returns True if the read handlers of the current request read from a
+    replica, whose rows can lag behind the primary. Such reads must not be
+    stored in the response cache, which is keyed on the primary's changes.
+    """
+
+    return get_read_engine() is not None \
+        and current_app.config["READ_DATABASE"] != "readonly"
+
+
+def add_pragmas(engine, pragmas):
+    """
+    Runs the given pragmas on every new connection of a SQLite engine.
+    : param engine: the engine, for an async engine its sync_engine
+    : param dict pragmas: pragma names and values
+    """
+
+    if not pragmas or engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
+        cursor.close()
+
+
+def run_queries(handler):
+    """
+    Runs a read handler on the read engine, or the session if there is no
+    read engine, and returns its response. Read handlers are generators
+    that yield the statements they need and get back the rows of each
+    statement, which keeps them independent of how the statements are
+    executed. The ASGI app runs the same handlers on an async engine.
+    : param handler: the generator returned by a read handler
+    """
+
+    engine = get_read_engine()
+    if engine is None:
+        return _run(handler, db.session)
+    with engine.connect() as conn:
+        return _run(handler, conn)
+
+
+def _run(handler, conn):
+    try:
+        statement = next(handler)
+        while True:
+            statement = handler.send(conn.execute(statement).all())
+    except StopIteration as stop:
+        return stop.value
@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from flask import current_app
+from sqlalchemy import func, select
+from api import db
+from api.models import BookChange
+
+logger = logging.getLogger(__name__)
+
+# Sent to a subscriber that fell behind instead of the events it missed
+RESYNC = {"op": "resync"}
+# Maximum number of changes read from the log at a time
+POLL_BATCH_SIZE = 500
+
+
+class Subscriber(object):
+    """
+    A client of the event stream with a bounded queue of events. Publishing
+    never waits for a subscriber: when a slow client's queue is full, the
+    queued events are dropped and the client gets a single RESYNC instead,
+    after which it has to catch up from the change feed. Memory use is
+    therefore bounded by max_events per subscriber.
+    """
+
+    def __init__(self, max_events):
+        self.max_events = max_events
+        self.events = deque()
+        self.resync = False
+        self._cond = threading.Condition()
+        self._waiter = None
+
+    def put(self, events):
+        """
+        Queues events for the subscriber. Returns False if the subscriber
+        was behind and the events were dropped.
+        """
+
+        with self._cond:
+            if self.resync:
+                return False
+            if len(self.events) + len(events) > self.max_events:
+                self.events.clear()
+                self.resync = True
+            else:
+                self.events.extend(events)
+            self._cond.notify()
+            if self._waiter is not None:
+                self._waiter()
+            return not self.resync
+
+    def get(self, timeout):
+        """
+        Waits up to timeout seconds for events and returns the queued
+        events, [RESYNC] if the subscriber fell behind, or an empty list if
+        nothing was published in time.
+        : param float timeout: seconds to wait
+        """
+
+        with self._cond:
+            if not self.events and not self.resync:
+                self._cond.wait(timeout)
+            return self._take()
+
+    async def get_async(self, timeout):
+        """
+        Like get, but waits without blocking the event loop, for the ASGI
+        app.
+        : param float timeout: seconds to wait
+        """
+
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        with self._cond:
+            if self.events or self.resync:
+                return self._take()
+            self._waiter = lambda: loop.call_soon_threadsafe(ready.set)
+        try:
+            await asyncio.wait_for(ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._waiter = None
+        with self._cond:
+            return self._take()
+
+    def _take(self):
+        if self.resync:
+            self.resync = False
+            return [RESYNC]
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+
+class EventBackend(object):
+    """
+    Interface for telling every worker process that books have changed. The
+    events themselves are always read from the book_change log, which all
+    processes share, so a backend only has to wake up the brokers: publish
+    is called by the process that committed the changes and every broker
+    that should see them must then call EventBroker.poll. MemoryBackend
+    only reaches the own process, ChangeLogBackend reaches all of them by
+    polling. A backend on top of e.g. Redis pub/sub can be plugged in by
+    implementing these methods and setting an instance as the EVENTS_BACKEND
+    config value.
+    """
+
+    def start(self, broker):
+        """
+        Called when the broker gets its first subscriber.
+        """
+
+    def publish(self, broker):
+        raise NotImplementedError
+
+
+class MemoryBackend(EventBackend):
+    """
+    Publishes events to the subscribers of the own process only, in the
+    request that committed the changes.
+    """
+
+    def publish(self, broker):
+        broker.poll()
+
+
+class ChangeLogBackend(EventBackend):
+    """
+    Publishes events to the subscribers of every worker process. Each
+    process polls the change log every poll_interval seconds from a
+    background thread, which runs while the process has subscribers, and
+    the process that committed the changes wakes its own thread right away.
+    """
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self, broker):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, args=(broker,), daemon=True
+                )
+                self._thread.start()
+
+    def publish(self, broker):
+        self._wake.set()
+
+    def _run(self, broker):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self._lock:
+                if not broker.stats["subscribers"]:
+                    self._thread = None
+                    return
+            try:
+                with broker.app.app_context():
+                    broker.poll()
+            except Exception:
+                logger.exception("Polling the change log failed")
+
+
+class EventBroker(object):
+    """
+    In-process pub/sub of book changes for the event stream. The broker
+    keeps the sequence number of the last change it has published, reads
+    the changes after it from the change log when its backend wakes it up
+    and hands them to every subscriber. The log is not read at all while
+    there are no subscribers.
+    """
+
+    def __init__(self, app, backend, max_events=100):
+        self.app = app
+        self.backend = backend
+        self.max_events = max_events
+        self.last = None
+        self.published = 0
+        self.dropped = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        """
+        Adds a subscriber that gets every change committed from now on.
+        Must be called in an app context.
+        """
+
+        subscriber = Subscriber(self.max_events)
+        with self._lock:
+            if self.last is None:
+                self.last = _last_seq()
+            self._subscribers.add(subscriber)
+        self.backend.start(self)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            if not self._subscribers:
+                self.last = None
+
+    def poll(self):
+        """
+        Publishes the changes committed after the last published one. Must
+        be called in an app context.
+        """
+
+        with self._lock:
+            while self.last is not None:
+                events = read_events(self.last, POLL_BATCH_SIZE)
+                if not events:
+                    break
+                self.last = events[-1]["seq"]
+                self.published += len(events)
+                for subscriber in self._subscribers:
+                    if not subscriber.put(events):
+                        self.dropped += 1
+                if len(events) < POLL_BATCH_SIZE:
+                    break
+
+    @property
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+def read_events(since, limit):
+    """
+    Reads the changes after a sequence number from the change log as event
+    dicts, oldest first. Reset markers become events with the op "reset".
+    : param int since: sequence number of the last known change
+    : param int limit: maximum number of events
+    """
+
+    rows = db.session.execute(
+        select(
+            BookChange.seq, BookChange.op, BookChange.book_id,
+            BookChange.version
+        ).where(BookChange.seq > since).order_by(BookChange.seq).limit(limit)
+    ).all()
+    events = []
+    for row in rows:
+        event = {"seq": row.seq, "op": row.op}
+        if row.book_id is not None:
+            event["book_id"] = row.book_id
+        if row.version is not None:
+            event["version"] = row.version
+        events.append(event)
+    return events
+
+
+def _last_seq():
+    return db.session.execute(select(func.max(BookChange.seq))).scalar() or 0
+
+
+def init_app(app):
+    """
+    Sets up the event stream from the EVENTS_BACKEND config value, which
+    can be None to disable it, "memory" for a single process (the default),
+    "changelog" for several worker processes or an instance of an
+    EventBackend subclass.
+    """
+
+    backend = app.config.get("EVENTS_BACKEND", "memory")
+    if backend == "memory":
+        backend = MemoryBackend()
+    elif backend == "changelog":
+        backend = ChangeLogBackend(app.config.get("EVENTS_POLL_INTERVAL", 1.0))
+    if backend is None:
+        app.extensions["events"] = None
+    else:
+        app.extensions["events"] = EventBroker(
+            app, backend, app.config.get("EVENTS_QUEUE_SIZE", 100)
+        )
+
+
+def get_broker():
+    """
+    Returns the event broker of the current app or None if the event
+    stream is disabled.
+    """
+
+    return current_app.extensions.get("events")
+
+
+def publish_changes():
+    """
+    Publishes the changes committed by the current request to the event
+    stream. Must be called by write handlers after they commit.
+    """
+
+    broker = get_broker()
+    if broker is not None:
+        broker.backend.publish(broker)
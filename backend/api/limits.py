@@ -0,0 +1,281 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, request
+from api.utils import create_error_response
+
+# Endpoint classes of reads, limited separately so that a burst of
+# expensive collection reads can't starve the cheap item reads. Every
+# request that changes data belongs to the "write" class.
+ENDPOINT_CLASSES = {
+    "api.bookcollection": "collection",
+    "api.bookchanges": "collection",
+    "api.bookitem": "item",
+    "api.bookschema": "item",
+    "api.bookevents": "item",
+}
+ENDPOINT_CLASS_NAMES = ("collection", "item", "write")
+# Endpoints that are rate limited but don't take a concurrency slot, as
+# their responses stay open for as long as the client is connected
+LONG_LIVED_ENDPOINTS = ("api.bookevents",)
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class LimitStore(object):
+    """
+    Interface for the storage of the token buckets of the rate limiter. The
+    in-process MemoryStore is used with RATE_LIMIT_STORE = "memory", where
+    every worker process allows the full rate. A store shared between
+    worker processes (e.g. on top of Redis) can be plugged in by
+    implementing take and setting an instance as the RATE_LIMIT_STORE
+    config value. Taking a token must be atomic.
+    """
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token from the bucket of a key. The bucket holds at most
+        burst tokens and gets rate new tokens per second. Returns 0 if a
+        token was taken, otherwise the seconds until there is one.
+        : param str key: the bucket, e.g. client and endpoint class
+        : param float rate: tokens per second
+        : param int burst: size of the bucket
+        """
+
+        raise NotImplementedError
+
+
+class MemoryStore(LimitStore):
+    """
+    A thread safe in-process token bucket store. The buckets of at most
+    max_keys clients are kept, the least recently used bucket is dropped
+    when there are more, which gives that client a full bucket again.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limits the number of requests of one endpoint class that are handled at
+    the same time in the process. A request over the limit waits in a queue
+    of at most max_queue requests for up to timeout seconds for a slot and
+    is rejected when the queue is full or the time is up, so a burst is
+    shed instead of piling up on the workers.
+    """
+
+    def __init__(self, limit, max_queue=0, timeout=0.0):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, wait=True):
+        """
+        Takes a slot, waiting in the queue if needed. Returns False if the
+        request was rejected.
+        : param bool wait: wait in the queue, False rejects right away when
+            all slots are taken
+        """
+
+        with self._cond:
+            if self.active < self.limit:
+                self.active += 1
+                return True
+            if not wait or self.queued >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            try:
+                deadline = time.monotonic() + self.timeout
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
+class AdmissionControl(object):
+    """
+    Per client rate limits and per process concurrency limits for each
+    endpoint class. Either can be missing for a class, which is then not
+    limited by it.
+    """
+
+    def __init__(self, store, rate_limits, limiters, retry_after=1):
+        self.store = store
+        self.rate_limits = rate_limits
+        self.limiters = limiters
+        self.retry_after = retry_after
+        self.rate_limited = {name: 0 for name in ENDPOINT_CLASS_NAMES}
+
+    def check_rate(self, endpoint_class, client):
+        """
+        Takes a token from the client's bucket of an endpoint class. Returns
+        0 if the request is allowed, otherwise the seconds until it is.
+        """
+
+        limit = self.rate_limits.get(endpoint_class)
+        if limit is None:
+            return 0
+        rate, burst = limit
+        wait = self.store.take(
+            "{}:{}".format(client, endpoint_class), rate, burst
+        )
+        if wait:
+            self.rate_limited[endpoint_class] += 1
+        return wait
+
+    @property
+    def stats(self):
+        stats = {}
+        for name in ENDPOINT_CLASS_NAMES:
+            limiter = self.limiters.get(name)
+            if limiter is not None:
+                stats[name + "_active"] = limiter.active
+                stats[name + "_queued"] = limiter.queued
+                stats[name + "_rejected"] = limiter.rejected
+            if name in self.rate_limits:
+                stats[name + "_rate_limited"] = self.rate_limited[name]
+        return stats
+
+
+def init_app(app):
+    """
+    Sets up admission control from the config. RATE_LIMITS maps endpoint
+    classes ("collection", "item" and "write") to (rate, burst) tuples for
+    the token bucket of each client, where rate is in requests per second.
+    RATE_LIMIT_STORE is "memory" (the default) or an instance of a
+    LimitStore subclass. CONCURRENCY_LIMITS maps endpoint classes to the
+    number of requests handled at a time, with at most
+    CONCURRENCY_QUEUE_SIZE more waiting up to CONCURRENCY_QUEUE_TIMEOUT
+    seconds. Nothing is limited if neither is set.
+    """
+
+    rate_limits = app.config.get("RATE_LIMITS") or {}
+    concurrency_limits = app.config.get("CONCURRENCY_LIMITS") or {}
+    for name in list(rate_limits) + list(concurrency_limits):
+        if name not in ENDPOINT_CLASS_NAMES:
+            raise ValueError("Unknown endpoint class '{}'".format(name))
+    if not rate_limits and not concurrency_limits:
+        app.extensions["limits"] = None
+        return
+
+    store = app.config.get("RATE_LIMIT_STORE", "memory")
+    if store == "memory":
+        store = MemoryStore(app.config.get("RATE_LIMIT_MAX_CLIENTS", 10000))
+    limiters = {
+        name: ConcurrencyLimiter(
+            limit,
+            app.config.get("CONCURRENCY_QUEUE_SIZE", 10),
+            app.config.get("CONCURRENCY_QUEUE_TIMEOUT", 1.0),
+        )
+        for name, limit in concurrency_limits.items()
+    }
+    app.extensions["limits"] = AdmissionControl(
+        store, rate_limits, limiters,
+        app.config.get("CONCURRENCY_RETRY_AFTER", 1)
+    )
+
+
+def get_endpoint_class():
+    """
+    Returns the endpoint class of the current request, or None if it is
+    not limited.
+    """
+
+    if request.method not in READ_METHODS:
+        return "write"
+    return ENDPOINT_CLASSES.get(request.endpoint)
+
+
+def admit_request():
+    """
+    Before request hook of the API blueprint. Answers requests over the rate
+    limit of their client with 429 and requests that don't get a
+    concurrency slot with 503, both with a Retry-After header. The ASGI app
+    doesn't wait for a slot, as that would block its event loop.
+    """
+
+    control = current_app.extensions.get("limits")
+    if control is None:
+        return None
+    endpoint_class = get_endpoint_class()
+    if endpoint_class is None:
+        return None
+
+    wait = control.check_rate(endpoint_class, request.remote_addr)
+    if wait:
+        retry_after = max(1, int(math.ceil(wait)))
+        return _reject(
+            429, "Too many requests",
+            "Rate limit of {} requests exceeded, retry in {} s".format(
+                endpoint_class, retry_after
+            ),
+            retry_after
+        )
+
+    limiter = control.limiters.get(endpoint_class)
+    if limiter is None or request.endpoint in LONG_LIVED_ENDPOINTS:
+        return None
+    if not limiter.acquire(wait=not request.environ.get("library.async")):
+        return _reject(
+            503, "Service unavailable",
+            "Too many {} requests in progress, retry later".format(
+                endpoint_class
+            ),
+            control.retry_after
+        )
+    g.concurrency_limiter = limiter
+    return None
+
+
+def release_request(exc=None):
+    """
+    Teardown hook of the API blueprint that frees the concurrency slot of
+    the request. Streamed responses hold their slot until they are done.
+    """
+
+    limiter = g.pop("concurrency_limiter", None)
+    if limiter is not None:
+        limiter.release()
+
+
+def _reject(status_code, title, message, retry_after):
+    resp = create_error_response(status_code, title, message)
+    resp.headers["Retry-After"] = str(retry_after)
+    return resp
@@ -0,0 +1,275 @@
+import io
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from api import db
+
+PROMETHEUS = "text/plain; version=0.0.4; charset=utf-8"
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+PHASES = ("db", "serialize", "validate")
+
+
+class Histogram(object):
+    """
+    A Prometheus style histogram with one series per combination of label
+    values. Buckets are cumulative when rendered.
+    """
+
+    def __init__(self, name, description, label_names, buckets):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = [[0] * len(self.buckets), 0, 0.0]
+                self._series[labels] = series
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} histogram".format(self.name),
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+            for labels, (counts, count, total) in series:
+                label_text = ",".join(
+                    '{}="{}"'.format(name, _escape(value))
+                    for name, value in zip(self.label_names, labels)
+                )
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        self.name, label_text, bound, cumulative
+                    ))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+                    self.name, label_text, count
+                ))
+                lines.append("{}_sum{{{}}} {}".format(
+                    self.name, label_text, total
+                ))
+                lines.append("{}_count{{{}}} {}".format(
+                    self.name, label_text, count
+                ))
+        return "\n".join(lines)
+
+
+def _escape(value):
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
+
+
+class Metrics(object):
+    """
+    Request metrics of one process, rendered in the Prometheus text format
+    by the /api/_metrics endpoint.
+    """
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            "library_http_request_duration_seconds",
+            "Time spent handling requests.",
+            ("endpoint", "method", "status"),
+            DURATION_BUCKETS,
+        )
+        self.phase_duration = Histogram(
+            "library_request_phase_duration_seconds",
+            "Time spent in SQL, serialization and validation per request.",
+            ("endpoint", "method", "phase"),
+            DURATION_BUCKETS,
+        )
+        self.db_statements = Histogram(
+            "library_db_statements_per_request",
+            "Number of SQL statements run per request.",
+            ("endpoint", "method"),
+            COUNT_BUCKETS,
+        )
+        self.counters = {}
+
+    def add_counters(self, prefix, description, get_stats):
+        """
+        Adds counters that are read when the metrics are rendered, e.g. the
+        hit and miss counts of the response cache.
+        : param str prefix: prefix of the metric names
+        : param str description: help text of the metrics
+        : param get_stats: function returning a dict of counter values
+        """
+
+        self.counters[prefix] = (description, get_stats)
+
+    def _render_counters(self):
+        lines = []
+        for prefix, (description, get_stats) in sorted(self.counters.items()):
+            for name, value in sorted(get_stats().items()):
+                metric = "{}_{}".format(prefix, name)
+                lines.append("# HELP {} {}".format(metric, description))
+                lines.append("# TYPE {} gauge".format(metric))
+                lines.append("{} {}".format(metric, value))
+        return lines
+
+    def render(self):
+        parts = [
+            self.request_duration.render(),
+            self.phase_duration.render(),
+            self.db_statements.render(),
+        ]
+        parts += self._render_counters()
+        return "\n".join(parts) + "\n"
+
+
+@contextmanager
+def timed(phase):
+    """
+    Adds the time spent in the block to a phase of the current request, e.g.
+    "serialize" or "validate". Does nothing unless instrumentation is on.
+    : param str phase: name of the phase
+    """
+
+    timings = g.get("timings") if has_request_context() else None
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+
+def init_app(app):
+    """
+    Sets up the opt-in request instrumentation when INSTRUMENTATION is set.
+    Nothing is registered otherwise, so there is no overhead when it is off.
+    Every response then gets a Server-Timing header with the total time, the
+    time spent in SQL with the number of statements, and the time spent in
+    serialization and validation. The same numbers are aggregated into
+    histograms served by /api/_metrics. With INSTRUMENTATION_PROFILER also
+    set, a request with "?_profile=1" is run under cProfile and answered
+    with the profile instead of the normal response.
+    """
+
+    if not app.config.get("INSTRUMENTATION"):
+        return
+
+    metrics = app.extensions["metrics"] = Metrics()
+    cache = app.extensions.get("response_cache")
+    if cache is not None:
+        metrics.add_counters(
+            "library_response_cache", "Response cache statistics.",
+            lambda: cache.stats
+        )
+    broker = app.extensions.get("events")
+    if broker is not None:
+        metrics.add_counters(
+            "library_events", "Event stream statistics.",
+            lambda: broker.stats
+        )
+    control = app.extensions.get("limits")
+    if control is not None:
+        metrics.add_counters(
+            "library_admission", "Rate limiting and admission control "
+            "statistics.", lambda: control.stats
+        )
+    profiler_enabled = app.config.get("INSTRUMENTATION_PROFILER", False)
+
+    with app.app_context():
+        engines = [db.engine]
+    if "read_engine" in app.extensions:
+        engines.append(app.extensions["read_engine"])
+    for engine in engines:
+        _instrument_engine(engine)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        g.timings = {phase: 0.0 for phase in PHASES}
+        g.db_statements = 0
+        if profiler_enabled and request.args.get("_profile") == "1":
+            import cProfile
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @app.after_request
+    def record_timing(response):
+        if "request_start" not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        endpoint = request.endpoint or "none"
+        timings = g.timings
+        metrics.request_duration.observe(
+            (endpoint, request.method, str(response.status_code)), total
+        )
+        for phase in PHASES:
+            metrics.phase_duration.observe(
+                (endpoint, request.method, phase), timings[phase]
+            )
+        metrics.db_statements.observe(
+            (endpoint, request.method), g.db_statements
+        )
+        response.headers["Server-Timing"] = ", ".join([
+            "total;dur={:.3f}".format(total * 1000),
+            'db;dur={:.3f};desc="{} statements"'.format(
+                timings["db"] * 1000, g.db_statements
+            ),
+            "serialize;dur={:.3f}".format(timings["serialize"] * 1000),
+            "validate;dur={:.3f}".format(timings["validate"] * 1000),
+        ])
+
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            import pstats
+            output = io.StringIO()
+            stats = pstats.Stats(profiler, stream=output)
+            stats.sort_stats("cumulative").print_stats(40)
+            return Response(output.getvalue(), 200, mimetype="text/plain")
+        return response
+
+    @app.route("/api/_metrics", methods=["GET"])
+    def metrics_endpoint():
+        return Response(metrics.render(), 200, mimetype=PROMETHEUS)
+
+
+def _instrument_engine(engine):
+    """
+    Adds the time and number of SQL statements run on an engine to the
+    current request.
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        start = conn.info["query_start"].pop()
+        timings = g.get("timings") if has_request_context() else None
+        if timings is not None:
+            timings["db"] += time.perf_counter() - start
+            g.db_statements += 1
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
@@ -1,13 +1,46 @@
 import click
+from datetime import datetime, timedelta
+from flask import current_app
 from flask.cli import with_appcontext
+from sqlalchemy import DDL, event, func, inspect, literal
+from sqlalchemy.schema import CreateColumn
 from api import db
 
+# Column weights for ranking search results with bm25, matches in the title
+# count the most and matches in the description the least
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+# Fields of a book that clients can write
+WRITABLE_FIELDS = ("title", "author", "description")
+# Defaults of the change log settings: the log is compacted every
+# CHANGE_LOG_COMPACT_EVERY changes and keeps changes for CHANGE_LOG_RETENTION
+# seconds, but at most CHANGE_LOG_MAX_ROWS of them
+CHANGE_LOG_COMPACT_EVERY = 1000
+CHANGE_LOG_RETENTION = 7 * 24 * 3600
+CHANGE_LOG_MAX_ROWS = 100000
+
 
 class Book(db.Model):
     book_id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=True)
     author = db.Column(db.String, nullable=True)
     description = db.Column(db.String, nullable=True)
+    version = db.Column(
+        db.Integer, nullable=False, default=1, server_default="1"
+    )
+    updated_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+
+    # Composite indexes for the filters and sort orders of the collection.
+    # Each ends with book_id, the tie-breaker of every sort order, so that
+    # filtered and sorted pages are read in order from a single index.
+    # AUTOINCREMENT keeps the ids of deleted books from being given to new
+    # books, which would otherwise start over at version 1 with the same
+    # ETag as the deleted book.
+    __table_args__ = (
+        db.Index("ix_book_title_book_id", "title", "book_id"),
+        db.Index("ix_book_author_book_id", "author", "book_id"),
+        db.Index("ix_book_author_title_book_id", "author", "title", "book_id"),
+        {"sqlite_autoincrement": True},
+    )
     
     @staticmethod
     def get_schema():
@@ -34,6 +67,396 @@ class Book(db.Model):
         }
         return schema
 
+    @staticmethod
+    def search_statement(query, limit):
+        """
+        Returns a statement that searches books by title, author and
+        description using the book_fts full-text index, best matches first
+        ranked by bm25, or None if the query has no search terms. Every word
+        of the query must match, the last word also as a prefix so the
+        search works while the user is still typing.
+        : param str query: the search terms
+        : param int limit: maximum number of books to return
+        """
+
+        terms = [
+            '"{}"'.format(word.replace('"', '""')) for word in query.split()
+        ]
+        if not terms:
+            return None
+        terms[-1] += "*"
+        return db.text(
+            "SELECT book.* FROM book "
+            "JOIN book_fts ON book_fts.rowid = book.book_id "
+            "WHERE book_fts MATCH :terms "
+            "ORDER BY bm25(book_fts, {}, {}, {}) "
+            "LIMIT :limit".format(*SEARCH_WEIGHTS)
+        ).bindparams(terms=" ".join(terms), limit=limit).columns(
+            *Book.__table__.c
+        )
+
+    @staticmethod
+    def update_by_id(book_id, values, versions=None):
+        """
+        Updates a book with a single UPDATE statement that also increments
+        its version and sets updated_at. Returns a row of (book_id, version,
+        updated_at) for the updated book, or None if there is no such book
+        or its version is not one of the given versions. Runs in the current
+        transaction, which the caller commits.
+        : param book_id: id of the book
+        : param dict values: new values of fields in WRITABLE_FIELDS
+        : param versions: versions the book must have, None for any
+        """
+
+        names = [name for name in WRITABLE_FIELDS if name in values]
+        assignments = ["{0} = :{0}".format(name) for name in names]
+        assignments += ["version = version + 1", "updated_at = :updated_at"]
+        params = {name: values[name] for name in names}
+        params.update(book_id=book_id, updated_at=datetime.utcnow())
+        return _write_returning(
+            "UPDATE book SET {} WHERE book_id = :book_id".format(
+                ", ".join(assignments)
+            ),
+            params, versions, "book_id", "version", "updated_at"
+        )
+
+    @staticmethod
+    def delete_by_id(book_id, versions=None):
+        """
+        Deletes a book with a single DELETE statement. Returns the id of the
+        deleted book, or None if there is no such book or its version is not
+        one of the given versions. Runs in the current transaction, which
+        the caller commits.
+        : param book_id: id of the book
+        : param versions: versions the book must have, None for any
+        """
+
+        row = _write_returning(
+            "DELETE FROM book WHERE book_id = :book_id",
+            {"book_id": book_id}, versions, "book_id"
+        )
+        return None if row is None else row.book_id
+
+
+def _write_returning(sql, params, versions, *names):
+    """
+    Runs an UPDATE or DELETE of one book, only if the book has one of the
+    given versions unless versions is None, and returns the named columns of
+    the affected row or None. SQLAlchemy 1.4 can't compile RETURNING for
+    SQLite, so the statement is written as text. SQLite supports RETURNING
+    since version 3.35.
+    """
+
+    binds = []
+    if versions is not None:
+        sql += " AND version IN :versions"
+        params = dict(params, versions=list(versions))
+        binds.append(db.bindparam("versions", expanding=True))
+    if "updated_at" in params:
+        binds.append(db.bindparam("updated_at", type_=db.DateTime))
+    columns = [Book.__table__.c[name] for name in names]
+    statement = db.text(
+        "{} RETURNING {}".format(sql, ", ".join(names))
+    ).bindparams(*binds).columns(*columns)
+    return db.session.execute(statement, params).first()
+
+
+# The full-text index is an external content FTS5 table that mirrors the
+# searchable columns of book and is kept in sync with triggers, so every
+# write path, including bulk statements, updates it.
+BOOK_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS book_fts USING fts5("
+    "title, author, description, "
+    "content='book', content_rowid='book_id', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS book_fts_insert AFTER INSERT ON book BEGIN "
+    "INSERT INTO book_fts(rowid, title, author, description) "
+    "VALUES (new.book_id, new.title, new.author, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS book_fts_delete AFTER DELETE ON book BEGIN "
+    "INSERT INTO book_fts(book_fts, rowid, title, author, description) "
+    "VALUES ('delete', old.book_id, old.title, old.author, old.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS book_fts_update "
+    "AFTER UPDATE OF title, author, description ON book BEGIN "
+    "INSERT INTO book_fts(book_fts, rowid, title, author, description) "
+    "VALUES ('delete', old.book_id, old.title, old.author, old.description); "
+    "INSERT INTO book_fts(rowid, title, author, description) "
+    "VALUES (new.book_id, new.title, new.author, new.description); END",
+]
+
+for statement in BOOK_FTS_DDL:
+    event.listen(
+        Book.__table__, "after_create",
+        DDL(statement).execute_if(dialect="sqlite")
+    )
+event.listen(
+    Book.__table__, "before_drop",
+    DDL("DROP TABLE IF EXISTS book_fts").execute_if(dialect="sqlite")
+)
+
+
+def rebuild_search_index():
+    """
+    Creates the full-text index and its triggers if they are missing and
+    rebuilds the index from the contents of the book table.
+    """
+
+    with db.engine.begin() as conn:
+        for statement in BOOK_FTS_DDL:
+            conn.execute(db.text(statement))
+        conn.execute(db.text(
+            "INSERT INTO book_fts(book_fts) VALUES ('rebuild')"
+        ))
+
+
+class ChangeCounter(db.Model):
+    """
+    Table level change counters. The counter of a table is incremented in
+    the same transaction as every write to the table, which makes it a cheap
+    validator for cached representations of the whole table.
+    """
+
+    name = db.Column(db.String, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    @staticmethod
+    def bump(name):
+        """
+        Increments the counter of a table in the current transaction.
+        : param str name: name of the table
+        """
+
+        now = datetime.utcnow()
+        result = db.session.execute(
+            db.update(ChangeCounter)
+            .where(ChangeCounter.name == name)
+            .values(value=ChangeCounter.value + 1, updated_at=now)
+        )
+        if result.rowcount == 0:
+            db.session.add(ChangeCounter(name=name, value=1, updated_at=now))
+
+    @staticmethod
+    def select(name):
+        """
+        Returns a select of (value, updated_at) for the counter of a table.
+        : param str name: name of the table
+        """
+
+        return db.select(
+            ChangeCounter.value, ChangeCounter.updated_at
+        ).where(ChangeCounter.name == name)
+
+
+class BookChange(db.Model):
+    """
+    Append-only log of the writes to the book table, for clients that sync
+    incrementally. Every change gets a sequence number from AUTOINCREMENT,
+    so sequence numbers only grow, even after old changes are deleted. The
+    log is compacted to the latest change of each book and changes older
+    than the retention are replaced by a single "reset" marker, which has
+    no book_id. Clients with a sequence before the latest marker have to
+    reload the collection.
+    """
+
+    seq = db.Column(db.Integer, primary_key=True)
+    op = db.Column(db.String, nullable=False)
+    book_id = db.Column(db.Integer, nullable=True)
+    version = db.Column(db.Integer, nullable=True)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_book_change_book_id_seq", "book_id", "seq"),
+        {"sqlite_autoincrement": True},
+    )
+
+    @staticmethod
+    def record(op, *book_ids):
+        """
+        Adds a change of the given books to the log in the current
+        transaction. Creates and updates record
+        the version of the book, so they must be recorded after the write.
+        Compacts the log every CHANGE_LOG_COMPACT_EVERY changes.
+        : param str op: "create", "update" or "delete"
+        : param book_ids: ids of the changed books
+        """
+
+        if not book_ids:
+            return
+        now = datetime.utcnow()
+        table = BookChange.__table__
+        if op == "delete" and len(book_ids) > 1:
+            db.session.execute(table.insert(), [
+                {"op": op, "book_id": book_id, "changed_at": now}
+                for book_id in book_ids
+            ])
+            last = db.session.execute(
+                db.select(func.max(BookChange.seq))
+            ).scalar()
+        elif op == "delete":
+            last = db.session.execute(table.insert().values(
+                op=op, book_id=book_ids[0], changed_at=now
+            )).lastrowid
+        else:
+            result = db.session.execute(table.insert().from_select(
+                ["op", "book_id", "version", "changed_at"],
+                db.select(
+                    literal(op), Book.book_id, Book.version,
+                    literal(now, db.DateTime)
+                ).where(Book.book_id.in_(book_ids))
+            ))
+            last = result.lastrowid
+
+        every = current_app.config.get(
+            "CHANGE_LOG_COMPACT_EVERY", CHANGE_LOG_COMPACT_EVERY
+        )
+        if last // every != (last - len(book_ids)) // every:
+            BookChange.compact()
+
+    @staticmethod
+    def compact(retention=None, max_rows=None):
+        """
+        Compacts the log in the current transaction. Changes superseded by a
+        later change of the same book are deleted, and the changes older
+        than retention, or beyond the newest max_rows, are replaced by a
+        reset marker.
+        : param retention: seconds to keep changes for, None for the
+            CHANGE_LOG_RETENTION setting
+        : param max_rows: number of changes to keep, None for the
+            CHANGE_LOG_MAX_ROWS setting
+        """
+
+        config = current_app.config
+        if retention is None:
+            retention = config.get("CHANGE_LOG_RETENTION", CHANGE_LOG_RETENTION)
+        if max_rows is None:
+            max_rows = config.get("CHANGE_LOG_MAX_ROWS", CHANGE_LOG_MAX_ROWS)
+
+        table = BookChange.__table__
+        db.session.execute(table.delete().where(
+            table.c.seq.not_in(
+                db.select(func.max(BookChange.seq))
+                .group_by(BookChange.book_id)
+            )
+        ))
+
+        expired = db.session.execute(
+            db.select(func.max(BookChange.seq)).where(
+                BookChange.changed_at
+                < datetime.utcnow() - timedelta(seconds=retention)
+            )
+        ).scalar()
+        overflow = db.session.execute(
+            db.select(BookChange.seq).order_by(BookChange.seq.desc())
+            .offset(max_rows).limit(1)
+        ).scalar()
+        cutoff = max(expired or 0, overflow or 0)
+        if cutoff:
+            BookChange._reset_at(cutoff)
+
+    @staticmethod
+    def reset():
+        """
+        Replaces the whole log with a new reset marker in the current
+        transaction, for writes that don't record their changes, such as
+        bulk imports. Every client has to reload the collection.
+        """
+
+        table = BookChange.__table__
+        result = db.session.execute(table.insert().values(
+            op="reset", changed_at=datetime.utcnow()
+        ))
+        db.session.execute(
+            table.delete().where(table.c.seq < result.lastrowid)
+        )
+
+    @staticmethod
+    def _reset_at(seq):
+        table = BookChange.__table__
+        db.session.execute(
+            table.update().where(table.c.seq == seq)
+            .values(op="reset", book_id=None, version=None)
+        )
+        db.session.execute(table.delete().where(table.c.seq < seq))
+
+    @staticmethod
+    def select_bounds():
+        """
+        Returns a select of (reset, last): the sequence number of the latest
+        reset marker and of the latest change, both None if there are none.
+        """
+
+        return db.select(
+            db.select(func.max(BookChange.seq))
+            .where(BookChange.book_id.is_(None)).scalar_subquery()
+            .label("reset"),
+            db.select(func.max(BookChange.seq)).scalar_subquery()
+            .label("last"),
+        )
+
+
+def upgrade_db():
+    """
+    Brings an existing database up to date with the models without losing
+    data. Missing tables and indexes are created and columns added to the
+    models since the database was created are added with ALTER TABLE. A
+    book table without AUTOINCREMENT is rebuilt with it.
+    """
+
+    db.create_all()
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        existing = {col["name"] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+            with db.engine.begin() as conn:
+                conn.execute(db.text(
+                    "ALTER TABLE {} ADD COLUMN {}".format(table.name, ddl)
+                ))
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind=db.engine)
+
+    if db.engine.dialect.name == "sqlite":
+        with db.engine.connect() as conn:
+            sql = conn.execute(db.text(
+                "SELECT sql FROM sqlite_master WHERE name = 'book'"
+            )).scalar()
+        if "AUTOINCREMENT" not in sql.upper():
+            _rebuild_book_table()
+        elif not inspector.has_table("book_fts"):
+            rebuild_search_index()
+
+
+def _rebuild_book_table():
+    """
+    Recreates the book table with AUTOINCREMENT and the same rows. The ids
+    of books in the change log count as used, so that the ids of books
+    deleted before the upgrade are not given out again either. The
+    full-text triggers are dropped with the old table, so the search index
+    is rebuilt afterwards.
+    """
+
+    columns = ", ".join(column.name for column in Book.__table__.columns)
+    with db.engine.begin() as conn:
+        for index in Book.__table__.indexes:
+            conn.execute(db.text("DROP INDEX IF EXISTS " + index.name))
+        conn.execute(db.text("ALTER TABLE book RENAME TO book_old"))
+        Book.__table__.create(bind=conn)
+        conn.execute(db.text(
+            "INSERT INTO book ({0}) SELECT {0} FROM book_old".format(columns)
+        ))
+        conn.execute(db.text("DROP TABLE book_old"))
+        conn.execute(db.text("DELETE FROM sqlite_sequence WHERE name = 'book'"))
+        conn.execute(db.text(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT 'book', MAX("
+            "(SELECT IFNULL(MAX(book_id), 0) FROM book), "
+            "(SELECT IFNULL(MAX(book_id), 0) FROM book_change))"
+        ))
+    rebuild_search_index()
+
 
 
 #
@@ -74,3 +497,22 @@ def delete_db_command():
 @with_appcontext
 def init_db_command():
     db.create_all()
+
+# Creates or rebuilds the full-text search index
+@click.command("rebuild-search-index")
+@with_appcontext
+def rebuild_search_index_command():
+    rebuild_search_index()
+
+# Upgrades an existing database to the current models
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    upgrade_db()
+
+# Compacts the change log of the books
+@click.command("compact-changes")
+@with_appcontext
+def compact_changes_command():
+    BookChange.compact()
+    db.session.commit()
@@ -0,0 +1,94 @@
+"""
+Preload mode for servers that fork their worker processes from a master,
+like gunicorn with preload_app. With PRELOAD set, create_app warms up the
+app in the master: everything the workers would otherwise build lazily on
+their first requests is built once before the fork, and the workers share
+those memory pages with the master copy-on-write instead of each building
+a private copy. Database connections must not cross the fork, so the pools
+are emptied at the end and every worker fills its own, see warm_pool and
+gunicorn.conf.py.
+"""
+
+import gc
+import logging
+from flask import request
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import configure_mappers
+from api import db, validation
+from api.database import run_queries
+from api.resources.book import read_handler
+
+logger = logging.getLogger(__name__)
+
+# Reads run once before the fork to compile their SQL statements, build the
+# Mason URL templates and import the modules they need lazily
+WARM_UP_URLS = (
+    "/api/books/?limit=1",
+    "/api/books/1/",
+    "/api/books/changes/?since=0&limit=1",
+)
+
+
+def preload(app):
+    """
+    Warms up the app before worker processes are forked: compiles the full
+    validators of the schemas, configures the mappers, finishes the URL map
+    and runs a few reads. The response cache is emptied again afterwards and
+    the connections opened for the reads are closed. Finally the garbage
+    collector is told to leave the objects created so far alone, so that
+    collections in the workers don't write to, and thereby copy, the shared
+    pages.
+    : param app: the Flask app
+    """
+
+    validation.preload_validators()
+    configure_mappers()
+    app.url_map.update()
+    with app.app_context():
+        with app.test_request_context("/api/"):
+            app.view_functions["entry"]()
+        try:
+            for url in WARM_UP_URLS:
+                with app.test_request_context(url):
+                    run_queries(
+                        read_handler(request.endpoint, request.view_args)
+                    )
+        except SQLAlchemyError:
+            # e.g. before init-db, the statements are then compiled later
+            logger.warning("Could not warm up the book reads", exc_info=True)
+        finally:
+            db.session.remove()
+        cache = app.extensions.get("response_cache")
+        if cache is not None:
+            cache.backend.clear()
+            cache.hits = cache.misses = 0
+        _dispose_engines(app)
+    gc.collect()
+    gc.freeze()
+
+
+def warm_pool(app):
+    """
+    Opens the pooled connections of the app's engines in a worker process,
+    so that its first requests don't pay for connecting and running the
+    pragmas. Meant to be called right after the fork.
+    : param app: the Flask app
+    """
+
+    with app.app_context():
+        engines = [db.engine]
+    if "read_engine" in app.extensions:
+        engines.append(app.extensions["read_engine"])
+    for engine in engines:
+        size = getattr(engine.pool, "size", None)
+        if size is None:
+            continue
+        connections = [engine.connect() for __ in range(size())]
+        for connection in connections:
+            connection.close()
+
+
+def _dispose_engines(app):
+    db.engine.dispose()
+    if "read_engine" in app.extensions:
+        app.extensions["read_engine"].dispose()
@@ -0,0 +1,266 @@
+import json
+from datetime import datetime
+from flask import current_app, request
+from flask_restful import Resource
+from sqlalchemy import bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from api.models import Book, BookChange, ChangeCounter
+from api import db
+from api.events import publish_changes
+from api import validation
+from api.utils import (
+    MasonBuilder, cached_url_for, create_error_response, render_mason
+)
+
+MASON = "application/vnd.mason+json"
+NDJSON = "application/x-ndjson"
+OPERATIONS = ("create", "update", "delete")
+DEFAULT_CHUNK_SIZE = 500
+MAX_BATCH_SIZE = 10000
+
+
+class BookBatch(Resource):
+
+    def post(self):
+        if request.mimetype == NDJSON:
+            try:
+                ops = [
+                    json.loads(line)
+                    for line in request.get_data(as_text=True).splitlines()
+                    if line.strip()
+                ]
+            except ValueError as e:
+                return create_error_response(
+                    400, "Invalid NDJSON document", str(e)
+                )
+        elif request.is_json:
+            ops = request.get_json(silent=True)
+            if not isinstance(ops, list):
+                return create_error_response(
+                    400, "Invalid JSON document",
+                    "Batch requests must be an array of operations"
+                )
+        else:
+            return create_error_response(
+                415, "Unsupported media type",
+                "Requests must be JSON or NDJSON"
+            )
+
+        if len(ops) > MAX_BATCH_SIZE:
+            return create_error_response(
+                413, "Batch too large",
+                "A batch can have at most {} operations".format(MAX_BATCH_SIZE)
+            )
+
+        try:
+            chunk_size = int(request.args.get(
+                "chunk_size",
+                current_app.config.get("BATCH_CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
+            ))
+            if chunk_size < 1:
+                raise ValueError
+        except ValueError:
+            return create_error_response(
+                400, "Invalid chunk size",
+                "chunk_size must be a positive integer"
+            )
+        atomic = request.args.get("atomic") in ("1", "true")
+
+        results = [_validate_op(op) for op in ops]
+        if atomic and any(result is not None for result in results):
+            return _atomic_failure(results)
+
+        pending = [
+            (index, op) for index, op in enumerate(ops)
+            if results[index] is None
+        ]
+        chunks = [
+            pending[start:start + chunk_size]
+            for start in range(0, len(pending), chunk_size)
+        ]
+        # In atomic mode the chunks are only flushed and everything is
+        # committed, or rolled back, together at the end
+        if atomic:
+            chunks = [chunks]
+        else:
+            chunks = [[chunk] for chunk in chunks]
+        for transaction in chunks:
+            try:
+                for chunk in transaction:
+                    _apply_chunk(chunk, results)
+                if atomic and any(
+                    result["status"] >= 400 for result in results
+                ):
+                    db.session.rollback()
+                    return _atomic_failure(results)
+                db.session.commit()
+                publish_changes()
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                for chunk in transaction:
+                    for index, op in chunk:
+                        results[index] = _error_result(
+                            500, "Database error", str(e)
+                        )
+
+        body = MasonBuilder(items=results)
+        return render_mason(body)
+
+
+def _atomic_failure(results):
+    """
+    Creates the response for an atomic batch where some operations failed.
+    Operations that would have succeeded get the status 424 since none of
+    them were applied.
+    """
+
+    body = MasonBuilder(items=[
+        result if result is not None and result["status"] >= 400
+        else {"status": 424}
+        for result in results
+    ])
+    body.add_error(
+        "Batch failed",
+        "No operations were applied because some of them failed"
+    )
+    return render_mason(body, 400)
+
+
+def _error_result(status, title, message):
+    result = MasonBuilder(status=status)
+    result.add_error(title, message)
+    return result
+
+
+def _validate_op(op):
+    """
+    Validates a single batch operation. Returns None if the operation is
+    valid and an error result if it isn't.
+    """
+
+    if not isinstance(op, dict) or op.get("op") not in OPERATIONS:
+        return _error_result(
+            400, "Invalid operation",
+            "Operations must be objects with op set to one of {}".format(
+                ", ".join(OPERATIONS)
+            )
+        )
+
+    if op["op"] != "create":
+        book_id = op.get("book_id")
+        if not isinstance(book_id, int) or isinstance(book_id, bool):
+            return _error_result(
+                400, "Invalid operation",
+                "{} operations require an integer book_id".format(op["op"])
+            )
+
+    if op["op"] != "delete":
+        book = {key: value for key, value in op.items() if key != "op"}
+        try:
+            validation.validate(book, Book)
+        except validation.ValidationError as e:
+            return _error_result(400,
+                "Invalid JSON document. Missing field or incorrect type.",
+                str(e)
+            )
+
+    return None
+
+
+def _apply_chunk(chunk, results):
+    """
+    Applies one chunk of valid operations with bulk statements: one query to
+    find which of the referenced books exist, then an executemany INSERT,
+    an executemany UPDATE and a single DELETE. Fills in the result of every operation.
+    """
+
+    referenced = {
+        op["book_id"] for index, op in chunk if op["op"] != "create"
+    }
+    existing = set()
+    if referenced:
+        existing = {
+            row.book_id for row in db.session.query(Book.book_id).filter(
+                Book.book_id.in_(referenced)
+            )
+        }
+
+    creates = []
+    updates = []
+    deletes = set()
+    for index, op in chunk:
+        if op["op"] == "create":
+            creates.append((index, {
+                "title": op["title"],
+                "author": op.get("author"),
+                "description": op.get("description"),
+            }))
+            continue
+
+        book_id = op["book_id"]
+        if book_id not in existing:
+            results[index] = _error_result(
+                404, "Not found",
+                "No book was found with the id '{}'".format(book_id)
+            )
+        elif op["op"] == "update":
+            updates.append({
+                "book_id": book_id,
+                "title": op["title"],
+                "author": op.get("author"),
+                "description": op.get("description"),
+            })
+            results[index] = {"status": 204, "book_id": book_id}
+        else:
+            existing.discard(book_id)
+            deletes.add(book_id)
+            results[index] = {"status": 204, "book_id": book_id}
+
+    if creates:
+        db.session.execute(
+            db.insert(Book), [mapping for index, mapping in creates]
+        )
+        # executemany doesn't return the new ids. With AUTOINCREMENT SQLite
+        # gives every new row an id above all ids so far, and this
+        # transaction holds the write lock since the INSERT, so the new
+        # books have the largest ids.
+        last_id = db.session.execute(
+            db.select(db.func.max(Book.book_id))
+        ).scalar()
+        for book_id, (index, mapping) in enumerate(
+                creates, last_id - len(creates) + 1):
+            mapping["book_id"] = book_id
+            results[index] = {
+                "status": 201,
+                "book_id": book_id,
+                "href": cached_url_for("api.bookitem", book_id=book_id),
+            }
+    if updates:
+        db.session.execute(
+            db.update(Book)
+            .where(Book.book_id == bindparam("b_book_id"))
+            .values(
+                title=bindparam("b_title"),
+                author=bindparam("b_author"),
+                description=bindparam("b_description"),
+                version=Book.version + 1,
+                updated_at=datetime.utcnow(),
+            ),
+            [
+                {"b_" + key: value for key, value in update.items()}
+                for update in updates
+            ]
+        )
+    if deletes:
+        Book.query.filter(Book.book_id.in_(deletes)).delete(
+            synchronize_session=False
+        )
+    if creates or updates or deletes:
+        BookChange.record(
+            "create", *(mapping["book_id"] for index, mapping in creates)
+        )
+        BookChange.record(
+            "update", *(update["book_id"] for update in updates)
+        )
+        BookChange.record("delete", *deletes)
+        ChangeCounter.bump("book")
@@ -1,40 +1,49 @@
-import json
-from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from flask import (
+    Response, current_app, request, stream_with_context, url_for
+)
 from flask_restful import Resource
-from api.models import Book
+from sqlalchemy import and_, select, tuple_
+from api.models import WRITABLE_FIELDS, Book, BookChange, ChangeCounter
 from api import db
-from api.utils import LibraryBuilder, create_error_response
+from api.cache import create_cached_response, get_cache
+from api.database import (
+    get_read_engine, reads_after_write, reads_from_replica, run_queries
+)
+from api.events import publish_changes
+from api import validation
+from api.utils import (
+    BOOK_SCHEMA, LibraryBuilder, MasonBuilder, add_validators, book_etag,
+    cached_url_for, changes_etag, collection_etag, create_error_response,
+    create_not_modified_response, decode_cursor, encode_cursor,
+    if_match_versions, is_not_modified, render_mason, representation_variant,
+    serialize
+)
 
 MASON = "application/vnd.mason+json"
+JSON_SCHEMA = "application/schema+json"
+NDJSON = "application/x-ndjson"
+STREAM_BATCH_SIZE = 500
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+# Maximum number of ids in "?ids=" and number of ids per IN query, below
+# the default SQLite limit of 999 bound parameters
+MAX_IDS = 1000
+IDS_CHUNK_SIZE = 500
+SORT_COLUMNS = {
+    "book_id": Book.book_id,
+    "title": Book.title,
+    "author": Book.author,
+}
+FILTERS = ("author", "title_prefix")
+FIELDS = ("book_id", "title", "author", "description")
+ITEM_COLUMNS = FIELDS + ("version", "updated_at")
+CONTROLS = ("none", "minimal", "full")
 
 
 class BookCollection(Resource):
 
     def get(self):
-        body = LibraryBuilder()
-        body.add_namespace("library", "n/a")
-        body.add_control("self", url_for("api.bookcollection"))
-        body.add_control_add_book()
-        
-        body["items"] = []
-        for db_book in Book.query.all():
-            item = LibraryBuilder(
-                book_id=db_book.book_id,
-                title=db_book.title,
-                author=db_book.author,
-                description=db_book.description
-            )
-            item.add_control("self", url_for(
-                "api.bookitem", 
-                book_id=db_book.book_id
-                )
-            )
-            item.add_control_edit_book(db_book.book_id)
-            item.add_control_delete_book(db_book.book_id)
-            body["items"].append(item)
-
-        return Response(json.dumps(body, indent=4, default=str), 200, mimetype=MASON)
+        return run_queries(_get_collection())
 
 
     def post(self):
@@ -44,8 +53,8 @@ class BookCollection(Resource):
             )
 
         try:
-            validate(request.json, Book.get_schema())
-        except ValidationError as e:
+            validation.validate(request.json, Book)
+        except validation.ValidationError as e:
             return create_error_response(400,
                 "Invalid JSON document. Missing field or incorrect type.", str(e)
             )
@@ -57,81 +66,777 @@ class BookCollection(Resource):
         )
 
         db.session.add(book)
+        db.session.flush()
+        BookChange.record("create", book.book_id)
+        ChangeCounter.bump("book")
         db.session.commit()
+        publish_changes()
 
-        return Response(status=201, headers={
+        resp = Response(status=201, headers={
             "Location": url_for("api.bookitem", book_id=book.book_id)
         })
+        return add_validators(
+            resp, book_etag(book.book_id, book.version), book.updated_at
+        )
 
 
 
-class BookItem(Resource):
-    
-    def get(self, book_id):
-        db_book = Book.query.filter_by(book_id=book_id).first()
-        if db_book is None:
-            return create_error_response(
-                404, "Not found",
-                "No book was found with the id '{}'".format(book_id)
-            )
+def _get_collection():
+    """
+    Read handler of the collection. Like every read handler it is a
+    generator that yields the statements it needs and receives their rows,
+    so that it can run on the session with run_queries or on the async
+    engine of the ASGI app. Returns the response.
+    """
 
-        
-        if db_book is not None:
-            body = LibraryBuilder(
-                book_id=db_book.book_id,
-                title=db_book.title,
-                author=db_book.author,
-                description=db_book.description
-            )
-            body.add_namespace("library", "n/a")
-            body.add_control("self", url_for("api.bookitem", book_id=book_id))
-            body.add_control("collection", url_for("api.bookcollection"))
-            body.add_control_edit_book(book_id)
-            body.add_control_delete_book(book_id)
-            
-        return Response(json.dumps(body, indent=4), 200, mimetype=MASON)
+    rows = yield ChangeCounter.select("book")
+    counter, last_modified = rows[0] if rows else (0, None)
+    etag = collection_etag(counter)
+    if is_not_modified(etag, last_modified):
+        return create_not_modified_response(etag, last_modified)
 
+    cache = get_cache()
+    stream = _wants_stream() and "ids" not in request.args
+    if cache is not None and not stream:
+        cache_key = cache.collection_key(counter, representation_variant())
+        entry = None if reads_after_write() else cache.get(cache_key)
+        if entry is not None:
+            return _cached_response(entry, vary="Accept")
 
-    def put(self, book_id):
-        db_book = Book.query.filter_by(book_id=book_id).first()
-        if db_book is None:
+    paginated = any(
+        key in request.args for key in ("limit", "after", "before")
+    )
+    try:
+        fields = _parse_fields(request.args.get("fields"))
+        controls = _parse_controls(request.args.get("controls"))
+        limit = _parse_limit(request.args.get("limit"))
+        sort, descending = _parse_sort(request.args.get("sort"))
+        after = decode_cursor(request.args.get("after"), sort)
+        before = decode_cursor(request.args.get("before"), sort)
+        ids = _parse_ids(request.args.get("ids"))
+    except ValueError as e:
+        return create_error_response(
+            400, "Invalid query parameters", str(e)
+        )
+
+    if stream:
+        if "q" in request.args or paginated:
             return create_error_response(
-                404, "Not found",
-                "No book was found with the id '{}'".format(book_id)
+                400, "Invalid query parameters",
+                "The stream holds the whole collection and can't be "
+                "combined with search or paging"
             )
+        resp = _stream_books(fields, controls, sort, descending)
+        resp.vary.add("Accept")
+        return add_validators(resp, etag, last_modified)
 
-        if not request.json:
+    shared_schema = _wants_shared_schema()
+    body = LibraryBuilder()
+    body.add_namespace("library", "n/a")
+    body.add_control("self", cached_url_for("api.bookcollection"))
+    body.add_control_add_book()
+    body.add_control_batch_books()
+    body.add_control_search_books()
+    body.add_control_get_books_by_id()
+    body.add_control_book_changes()
+
+    terms = request.args.get("q")
+    filtered = any(key in request.args for key in FILTERS)
+    if ids is not None:
+        if terms is not None or paginated or filtered \
+                or "sort" in request.args:
+            return create_error_response(
+                400, "Invalid query parameters",
+                "A list of ids can't be combined with search, filters, "
+                "sorting or paging"
+            )
+        found = {}
+        unique = list(dict.fromkeys(ids))
+        for start in range(0, len(unique), IDS_CHUNK_SIZE):
+            rows = yield _select_books(fields).where(
+                Book.book_id.in_(unique[start:start + IDS_CHUNK_SIZE])
+            )
+            found.update((row.book_id, row) for row in rows)
+        body["items"] = [
+            _book_item(found[book_id], shared_schema, fields, controls)
+            if book_id in found else _missing_item(book_id)
+            for book_id in ids
+        ]
+    elif terms is not None:
+        cursor = after is not None or before is not None
+        if cursor or "sort" in request.args:
             return create_error_response(
-                415, "Unsupported media type",
-                "Requests must be JSON"
+                400, "Invalid query parameters",
+                "Search results are ordered by relevance and can't be "
+                "sorted or paged with cursors"
             )
+        if filtered:
+            return create_error_response(
+                400, "Invalid query parameters",
+                "Search can't be combined with the author and title_prefix "
+                "filters"
+            )
+        statement = Book.search_statement(terms, limit)
+        books = [] if statement is None else (yield statement)
+    elif paginated:
+        books, has_prev, has_next = yield from _get_page(
+            _filter_books(_select_books(fields, sort)), sort, descending,
+            limit, after, before
+        )
+        params = {
+            key: value for key, value in request.args.items()
+            if key not in ("after", "before")
+        }
+        params["limit"] = limit
+        if has_prev:
+            cursor = _book_cursor(books[0], sort)
+            body.add_control_prev_page(cursor, **params)
+        if has_next:
+            cursor = _book_cursor(books[-1], sort)
+            body.add_control_next_page(cursor, **params)
+    else:
+        books = yield _filter_books(_select_books(fields, sort)).order_by(
+            *_sort_order(sort, descending)
+        )
+
+    if ids is None:
+        body["items"] = [
+            _book_item(db_book, shared_schema, fields, controls)
+            for db_book in books
+        ]
+
+    resp = render_mason(body)
+    resp.vary.add("Accept")
+    if cache is not None and not reads_from_replica():
+        cache.set(cache_key, resp, etag, last_modified)
+    return add_validators(resp, etag, last_modified)
+
+
+def _book_item(db_book, shared_schema=False, fields=FIELDS, controls="full"):
+    """
+    Builds the Mason representation of a book as an item of the collection.
+    db_book can be a Book or a row from _select_books.
+    : param tuple fields: the fields to include, see _parse_fields
+    : param str controls: which controls to include, see _parse_controls
+    """
+
+    item = LibraryBuilder(
+        (field, getattr(db_book, field)) for field in fields
+    )
+    if controls == "none":
+        return item
+    item.add_control("self", cached_url_for(
+        "api.bookitem",
+        book_id=db_book.book_id
+        )
+    )
+    if controls == "full":
+        item.add_control_edit_book(db_book.book_id, shared_schema)
+        item.add_control_delete_book(db_book.book_id)
+    return item
+
+
+def _missing_item(book_id):
+    """
+    Builds the item of a book that was asked for with "?ids=" but doesn't
+    exist.
+    """
+
+    item = LibraryBuilder(book_id=book_id, status=404)
+    item.add_error(
+        "Not found", "No book was found with the id '{}'".format(book_id)
+    )
+    return item
+
+
+def _parse_ids(value):
+    """
+    Parses the "ids" query parameter, a comma separated list of book ids.
+    Returns the ids in the requested order, or None if it is missing.
+    """
+
+    if value is None:
+        return None
+    try:
+        ids = [int(book_id) for book_id in value.split(",")]
+    except ValueError:
+        raise ValueError("ids must be a comma separated list of book ids")
+    if len(ids) > MAX_IDS:
+        raise ValueError("ids can have at most {} book ids".format(MAX_IDS))
+    return ids
+
+
+def _parse_fields(value):
+    """
+    Parses the "fields" query parameter, a comma separated list of the book
+    fields to include in each item. book_id is always included because the
+    item can't be identified without it. Returns all fields if the
+    parameter is missing.
+    """
+
+    if value is None:
+        return FIELDS
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in FIELDS]
+    if unknown:
+        raise ValueError("fields must be a comma separated list of {}"
+            .format(", ".join(FIELDS)))
+    return tuple(
+        name for name in FIELDS if name == "book_id" or name in names
+    )
+
+
+def _parse_controls(value):
+    """
+    Parses the "controls" query parameter which selects the controls added
+    to each item: "full" (the default) for self, edit and delete, "minimal"
+    for only the self link and "none" for no controls at all.
+    """
 
+    if value is None:
+        return "full"
+    if value not in CONTROLS:
+        raise ValueError("controls must be one of {}".format(
+            ", ".join(CONTROLS)
+        ))
+    return value
+
+
+def _select_books(fields, sort="book_id"):
+    """
+    Returns a select of only the columns needed for the given fields and
+    sort order, so that unused columns such as the description are not read
+    from the database at all. Read handlers work on the rows directly
+    instead of loading Book instances, which saves the identity map and
+    attribute instrumentation of the ORM for every row.
+    """
+
+    columns = set(fields) | {sort}
+    return select(*[getattr(Book, name) for name in FIELDS if name in columns])
+
+
+def read_handler(endpoint, view_args):
+    """
+    Returns the read handler for a request to the given endpoint, or None
+    if the request has to go through the Flask view, e.g. a streamed
+    collection. Used by the ASGI app to serve reads on the async engine.
+    : param str endpoint: endpoint of the request
+    : param dict view_args: arguments matched from the URL
+    """
+
+    if endpoint == "api.bookitem":
+        return _get_book(view_args["book_id"])
+    if endpoint == "api.bookcollection" and not _wants_stream():
+        return _get_collection()
+    if endpoint == "api.bookchanges":
+        return _get_changes()
+    return None
+
+
+def _wants_shared_schema():
+    """
+    Checks whether the items of the collection should refer to the shared
+    book schema instead of each carrying a copy of it. The default comes
+    from the MASON_SHARED_SCHEMA setting and can be overridden per request
+    with "?schema=shared" or "?schema=inline".
+    """
+
+    schema = request.args.get("schema")
+    if schema is None:
+        return current_app.config.get("MASON_SHARED_SCHEMA", False)
+    return schema == "shared"
+
+
+def _wants_stream():
+    """
+    Checks whether the client asked for the streaming NDJSON representation
+    either with "?stream=1" or by preferring NDJSON in the Accept header.
+    """
+
+    if request.args.get("stream") in ("1", "true"):
+        return True
+    return request.accept_mimetypes.best_match([MASON, NDJSON]) == NDJSON
+
+
+def _stream_books(fields=FIELDS, controls="full", sort="book_id",
+                  descending=False):
+    """
+    Streams the whole collection as newline delimited JSON, one book item per
+    line, filtered and sorted like the collection. Rows are read from the
+    database in batches so that memory use stays flat no matter how large
+    the catalog is.
+    """
+
+    def generate():
+        if engine is None:
+            result = db.session.execute(statement)
+        else:
+            conn = engine.connect()
+            result = conn.execute(statement)
         try:
-            validate(request.json, Book.get_schema())
-        except ValidationError as e:
-            return create_error_response(400,
-                "Invalid JSON document. Missing field or incorrect type.", str(e)
-            )
-            
-        db_book.title = request.json["title"]
-        db_book.author = request.json["author"]
-        db_book.description = request.json["description"]
-        db.session.commit()
+            for db_book in result.yield_per(STREAM_BATCH_SIZE):
+                item = _book_item(db_book, shared_schema, fields, controls)
+                yield serialize(item, pretty=False) + b"\n"
+        finally:
+            if engine is not None:
+                conn.close()
 
-        return Response(status=204, headers={
-            "Location": url_for("api.bookitem", book_id=db_book.book_id)
-        })
+    statement = _filter_books(_select_books(fields, sort)).order_by(
+        *_sort_order(sort, descending)
+    ).execution_options(stream_results=True)
+    engine = get_read_engine()
+    shared_schema = _wants_shared_schema()
+    return Response(stream_with_context(generate()), 200, mimetype=NDJSON)
+
+
+def _parse_limit(value):
+    """
+    Parses the page size given in the "limit" query parameter. Falls back to
+    the default page size and clamps the value to the maximum page size.
+    """
+
+    if value is None:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def _parse_sort(value):
+    """
+    Parses the "sort" query parameter, a column name optionally prefixed
+    with "-" for descending order. Returns a tuple of (column name,
+    descending).
+    """
+
+    if value is None:
+        return "book_id", False
+    descending = value.startswith("-")
+    sort = value.lstrip("-")
+    if sort not in SORT_COLUMNS:
+        raise ValueError("sort must be one of {}, optionally prefixed with -"
+            .format(", ".join(SORT_COLUMNS)))
+    return sort, descending
+
+
+def _sort_order(sort, descending):
+    """
+    Returns the ORDER BY clauses for a sort order. book_id is always the last
+    key so that the order is total, which keyset pagination relies on, and
+    the composite indexes on Book end with it so the order comes straight
+    from an index.
+    """
+
+    columns = [SORT_COLUMNS[sort]]
+    if sort != "book_id":
+        columns.append(Book.book_id)
+    if descending:
+        return [column.desc() for column in columns]
+    return columns
+
+
+def _filter_books(query):
+    """
+    Applies the "author" and "title_prefix" filters from the query string.
+    The title prefix is matched as a range so that it can use an index.
+    """
+
+    author = request.args.get("author")
+    if author is not None:
+        query = query.filter(Book.author == author)
+    prefix = request.args.get("title_prefix")
+    if prefix:
+        query = query.filter(Book.title >= prefix)
+        upper = _prefix_upper_bound(prefix)
+        if upper is not None:
+            query = query.filter(Book.title < upper)
+    return query
+
+
+def _prefix_upper_bound(prefix):
+    """
+    Returns the smallest string that is greater than every string starting
+    with the prefix, or None if there is no such string.
+    """
+
+    while prefix:
+        code = ord(prefix[-1]) + 1
+        if 0xD800 <= code <= 0xDFFF:
+            code = 0xE000
+        if code <= 0x10FFFF:
+            return prefix[:-1] + chr(code)
+        prefix = prefix[:-1]
+    return None
+
+
+def _book_cursor(db_book, sort):
+    value = None if sort == "book_id" else getattr(db_book, sort)
+    return encode_cursor(sort, db_book.book_id, value)
+
+
+def _after_cursor(sort, descending, cursor):
+    """
+    Returns the filters that select the books coming after the cursor in the
+    sort order, as a list of segments that follow each other in that order.
+    NULLs sort first in ascending order, and keeping them in a segment of
+    their own lets every segment seek straight to its start in the index
+    with a row value comparison instead of scanning from the beginning.
+    """
+
+    value, book_id = cursor
+    if sort == "book_id":
+        if descending:
+            return [Book.book_id < book_id]
+        return [Book.book_id > book_id]
+
+    column = SORT_COLUMNS[sort]
+    position = tuple_(column, Book.book_id)
+    if value is None:
+        if descending:
+            return [and_(column.is_(None), Book.book_id < book_id)]
+        return [
+            and_(column.is_(None), Book.book_id > book_id),
+            column.isnot(None),
+        ]
+    if descending:
+        return [position < tuple_(value, book_id), column.is_(None)]
+    return [position > tuple_(value, book_id)]
+
+
+def _query_segments(query, segments, order, count):
+    """
+    Fetches up to count books from consecutive segments of the sort order.
+    """
+
+    rows = []
+    for segment in segments:
+        rows += yield query.filter(segment).order_by(*order).limit(
+            count - len(rows)
+        )
+        if len(rows) >= count:
+            break
+    return rows
+
+
+def _get_page(query, sort, descending, limit, after=None, before=None):
+    """
+    Fetches one page of books using keyset pagination on the sort column
+    and book_id. One extra row is fetched to find out whether there is a
+    further page, so the cost of a page does not depend on how deep into the
+    table it is. Returns a tuple of (books, has_prev, has_next).
+    """
+
+    if before is not None:
+        rows = yield from _query_segments(
+            query, _after_cursor(sort, not descending, before),
+            _sort_order(sort, not descending), limit + 1
+        )
+        has_prev = len(rows) > limit
+        books = rows[:limit][::-1]
+        return books, has_prev, bool(books)
+
+    order = _sort_order(sort, descending)
+    if after is not None:
+        rows = yield from _query_segments(
+            query, _after_cursor(sort, descending, after), order, limit + 1
+        )
+    else:
+        rows = yield query.order_by(*order).limit(limit + 1)
+    has_next = len(rows) > limit
+    books = rows[:limit]
+    return books, after is not None and bool(books), has_next
+
+
+
+class BookItem(Resource):
+    
+    def get(self, book_id):
+        return run_queries(_get_book(book_id))
+
+
+    def put(self, book_id):
+        return _update_book(book_id, partial=False)
+
+
+    def patch(self, book_id):
+        return _update_book(book_id, partial=True)
         
 
     def delete(self, book_id):
-        db_book = Book.query.filter_by(book_id=book_id).first()
-        if db_book is None:
-            return create_error_response(
-                404, "Not found",
-                "No book was found with the id '{}'".format(book_id)
-            )
+        deleted = Book.delete_by_id(book_id, if_match_versions(book_id))
+        if deleted is None:
+            return _write_failed_response(book_id)
 
-        db.session.delete(db_book)
+        BookChange.record("delete", deleted)
+        ChangeCounter.bump("book")
         db.session.commit()
+        publish_changes()
+
+        return Response(status=204)
+
+
+
+def _get_book(book_id):
+    """
+    Read handler of a book item, see _get_collection.
+    """
+
+    rows = yield select(
+        *[getattr(Book, name) for name in ITEM_COLUMNS]
+    ).where(Book.book_id == book_id)
+    db_book = rows[0] if rows else None
+    if db_book is None:
+        return create_error_response(
+            404, "Not found",
+            "No book was found with the id '{}'".format(book_id)
+        )
+
+    etag = book_etag(db_book.book_id, db_book.version)
+    if is_not_modified(etag, db_book.updated_at):
+        return create_not_modified_response(etag, db_book.updated_at)
+
+    cache = get_cache()
+    if cache is not None and _is_canonical_id(book_id):
+        cache_key = cache.item_key(
+            book_id, db_book.version, representation_variant()
+        )
+        entry = None if reads_after_write() else cache.get(cache_key)
+        if entry is not None:
+            return _cached_response(entry)
+    else:
+        cache = None
+
+    body = LibraryBuilder(
+        book_id=db_book.book_id,
+        title=db_book.title,
+        author=db_book.author,
+        description=db_book.description
+    )
+    body.add_namespace("library", "n/a")
+    body.add_control("self", cached_url_for("api.bookitem", book_id=book_id))
+    body.add_control("collection", cached_url_for("api.bookcollection"))
+    body.add_control_edit_book(book_id)
+    body.add_control_delete_book(book_id)
+    resp = render_mason(body)
+    if cache is not None and not reads_from_replica():
+        cache.set(cache_key, resp, etag, db_book.updated_at)
+    return add_validators(resp, etag, db_book.updated_at)
+
+
+def _update_book(book_id, partial):
+    """
+    Replaces (PUT) or partially updates (PATCH) a book with a single UPDATE
+    statement. The If-Match precondition is part of the statement, so the
+    book is only read again when the update doesn't match any row, to tell
+    a missing book from a stale ETag.
+    """
+
+    if not request.json:
+        return create_error_response(
+            415, "Unsupported media type",
+            "Requests must be JSON"
+        )
+
+    try:
+        validation.validate(request.json, Book, partial)
+    except validation.ValidationError as e:
+        return create_error_response(400,
+            "Invalid JSON document. Missing field or incorrect type.", str(e)
+        )
+
+    if partial:
+        values = {
+            name: request.json[name] for name in WRITABLE_FIELDS
+            if name in request.json
+        }
+        if not values:
+            return create_error_response(400,
+                "Invalid JSON document. Nothing to update.",
+                "A patch must have at least one of {}".format(
+                    ", ".join(WRITABLE_FIELDS)
+                )
+            )
+    else:
+        values = {
+            name: request.json.get(name) for name in WRITABLE_FIELDS
+        }
 
-        return Response(status=204)
\ No newline at end of file
+    row = Book.update_by_id(book_id, values, if_match_versions(book_id))
+    if row is None:
+        return _write_failed_response(book_id)
+
+    BookChange.record("update", row.book_id)
+    ChangeCounter.bump("book")
+    db.session.commit()
+    publish_changes()
+
+    resp = Response(status=204, headers={
+        "Location": url_for("api.bookitem", book_id=row.book_id)
+    })
+    return add_validators(
+        resp, book_etag(row.book_id, row.version), row.updated_at
+    )
+
+
+
+def _is_canonical_id(book_id):
+    """
+    Checks that a book_id from the URL is written the canonical way, e.g.
+    "1" but not "01", so that only one spelling of each book is cached.
+    """
+
+    return book_id.isdigit() and str(int(book_id)) == book_id
+
+
+def _cached_response(entry, vary=None):
+    """
+    Serves a representation from the response cache, answering conditional
+    requests from the validators stored with the entry.
+    """
+
+    if is_not_modified(entry.etag, entry.last_modified):
+        return create_not_modified_response(entry.etag, entry.last_modified)
+    resp = create_cached_response(entry)
+    if vary is not None:
+        resp.vary.add(vary)
+    return resp
+
+
+def _write_failed_response(book_id):
+    """
+    Creates the response for a write that didn't match any row: 404 if the
+    book doesn't exist and 412 with the current validators if it exists but
+    the If-Match precondition failed.
+    """
+
+    db.session.rollback()
+    db_book = db.session.execute(
+        select(Book.book_id, Book.version, Book.updated_at)
+        .where(Book.book_id == book_id)
+    ).first()
+    if db_book is None:
+        return create_error_response(
+            404, "Not found",
+            "No book was found with the id '{}'".format(book_id)
+        )
+
+    resp = create_error_response(
+        412, "Precondition failed",
+        "The book with the id '{}' has been modified".format(db_book.book_id)
+    )
+    return add_validators(
+        resp, book_etag(db_book.book_id, db_book.version), db_book.updated_at
+    )
+
+
+
+class BookChanges(Resource):
+
+    def get(self):
+        return run_queries(_get_changes())
+
+
+
+def _get_changes():
+    """
+    Read handler of the change feed, see _get_collection. Returns the
+    changes after the sequence number in "?since=", oldest first, with the
+    version each change created and the current data of created and
+    updated books, and only the id of deleted ones. Without "since" it returns no changes, only the sequence number
+    to start from. Clients that are too far behind get a 410 and have to
+    reload the collection.
+    """
+
+    try:
+        since = _parse_since(request.args.get("since"))
+        limit = _parse_limit(request.args.get("limit", MAX_PAGE_SIZE))
+    except ValueError as e:
+        return create_error_response(
+            400, "Invalid query parameters", str(e)
+        )
+
+    rows = yield BookChange.select_bounds()
+    reset, last = rows[0].reset or 0, rows[0].last or 0
+    if since is not None and since < reset:
+        return create_error_response(
+            410, "Changes expired",
+            "Changes before the sequence number {} are no longer available, "
+            "reload the collection".format(reset)
+        )
+    etag = changes_etag(last)
+    if is_not_modified(etag):
+        return create_not_modified_response(etag)
+
+    changes = []
+    if since is not None and since < last:
+        changes = yield select(
+            BookChange.seq, BookChange.op, BookChange.book_id,
+            BookChange.version, Book.book_id.label("current"), Book.title,
+            Book.author, Book.description
+        ).outerjoin(
+            Book, Book.book_id == BookChange.book_id
+        ).where(
+            BookChange.seq > since, BookChange.book_id.is_not(None)
+        ).order_by(BookChange.seq).limit(limit + 1)
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    body = LibraryBuilder(seq=changes[-1].seq if more else last, more=more)
+    body.add_namespace("library", "n/a")
+    body.add_control(
+        "self", url_for("api.bookchanges", **request.args.to_dict())
+    )
+    body.add_control("collection", cached_url_for("api.bookcollection"))
+    params = {"since": body["seq"]}
+    if "limit" in request.args:
+        params["limit"] = limit
+    body.add_control("next", url_for("api.bookchanges", **params))
+    body["items"] = [_change_item(change) for change in changes]
+
+    return add_validators(render_mason(body), etag)
+
+
+def _change_item(change):
+    """
+    Builds an item of the change feed from a row of a change joined with
+    the current data of its book. The version is the one the change
+    created. Books deleted since the change have no data, their delete is
+    a later change of the feed.
+    """
+
+    item = MasonBuilder(seq=change.seq, op=change.op, book_id=change.book_id)
+    if change.op != "delete" and change.current is not None:
+        item["version"] = change.version
+        for name in WRITABLE_FIELDS:
+            item[name] = getattr(change, name)
+        item.add_control(
+            "self", cached_url_for("api.bookitem", book_id=change.book_id)
+        )
+    return item
+
+
+def _parse_since(value):
+    """
+    Parses the "since" parameter of the change feed, None if it is missing.
+    """
+
+    if value is None:
+        return None
+    try:
+        since = int(value)
+    except ValueError:
+        raise ValueError("since must be a sequence number")
+    if since < 0:
+        raise ValueError("since must be a sequence number")
+    return since
+
+
+
+class BookSchema(Resource):
+
+    def get(self):
+        return render_mason(BOOK_SCHEMA, mimetype=JSON_SCHEMA)
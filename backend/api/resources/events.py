@@ -0,0 +1,144 @@
+from flask import Response, current_app, request
+from flask_restful import Resource
+from api.events import RESYNC, get_broker, read_events
+from api.models import BookChange
+from api import db
+from api.serializers import get_serializer
+from api.utils import create_error_response
+
+EVENT_STREAM = "text/event-stream"
+# Milliseconds a client waits before reconnecting after a disconnect
+RETRY_MS = 3000
+HEARTBEAT = b": keep-alive\n\n"
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+class BookEvents(Resource):
+
+    def get(self):
+        stream = open_event_stream()
+        if isinstance(stream, Response):
+            return stream
+        return Response(
+            _generate_events(stream), mimetype=EVENT_STREAM,
+            headers=STREAM_HEADERS
+        )
+
+
+class EventStream(object):
+    """
+    The event stream of one client: its subscription, the events replayed
+    to it and the id of the last event it was sent. Events are named by
+    their op and have the sequence number as id, a client that gets a
+    resync event has to catch up from the change feed. Created in the
+    request, so that the Flask view and the ASGI app can send it.
+    """
+
+    def __init__(self, broker, subscriber, replay, since):
+        self.broker = broker
+        self.subscriber = subscriber
+        self.replay = replay
+        self.last = since or 0
+        self.dumps = get_serializer().dumps
+        self.heartbeat = current_app.config.get("EVENTS_HEARTBEAT", 15.0)
+
+    def start(self):
+        """
+        Returns the first chunk of the stream: the reconnection delay and
+        the replayed events.
+        """
+
+        return "retry: {}\n\n".format(RETRY_MS).encode("utf-8") \
+            + self.format(self.replay, heartbeat=False)
+
+    def format(self, events, heartbeat=True):
+        """
+        Formats published events, or a comment sent as a heartbeat when
+        there are none so that proxies keep the connection open.
+        """
+
+        data, self.last = _format_events(events, self.last, self.dumps)
+        return data or (HEARTBEAT if heartbeat else b"")
+
+    def close(self):
+        self.broker.unsubscribe(self.subscriber)
+
+
+def open_event_stream():
+    """
+    Subscribes the client of the current request to the event stream.
+    Returns an EventStream, or an error response if the stream is disabled
+    or the event id is invalid.
+    """
+
+    broker = get_broker()
+    if broker is None:
+        return create_error_response(
+            404, "Not found", "The event stream is disabled"
+        )
+    since = request.headers.get("Last-Event-ID", request.args.get("since"))
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return create_error_response(
+                400, "Invalid event id", "The event id must be a number"
+            )
+
+    subscriber = broker.subscribe()
+    try:
+        return EventStream(
+            broker, subscriber, _replay(since, broker.max_events), since
+        )
+    except Exception:
+        broker.unsubscribe(subscriber)
+        raise
+
+
+def _replay(since, limit):
+    """
+    Reads the events a reconnecting client missed after the event id it
+    has seen last. Returns [RESYNC] if it missed more than limit events
+    and a reset event if the changes it missed are no longer in the log.
+    """
+
+    if since is None:
+        return []
+    reset, last = db.session.execute(BookChange.select_bounds()).first()
+    if reset is not None and since < reset:
+        return [{"seq": reset, "op": "reset"}]
+    events = read_events(since, limit + 1)
+    if len(events) > limit:
+        return [RESYNC]
+    return events
+
+
+def _generate_events(stream):
+    try:
+        yield stream.start()
+        while True:
+            yield stream.format(stream.subscriber.get(stream.heartbeat))
+    finally:
+        stream.close()
+
+
+def _format_events(events, last, dumps):
+    """
+    Formats events for the event stream, skipping events the client has
+    already got. Returns the data and the id of the last event sent.
+    """
+
+    chunks = []
+    for event in events:
+        if event is RESYNC:
+            chunks.append(
+                b"event: resync\ndata: " + dumps({"since": last}) + b"\n\n"
+            )
+            continue
+        if event["seq"] <= last:
+            continue
+        last = event["seq"]
+        chunks.append("id: {}\nevent: {}\ndata: ".format(
+            event["seq"], event["op"]
+        ).encode("utf-8") + dumps(event) + b"\n\n")
+    return b"".join(chunks), last
@@ -0,0 +1,72 @@
+import json
+from flask import current_app, has_app_context
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONSerializer(object):
+    """
+    Serializer using the json module of the standard library. Output is
+    compact unless pretty printing is asked for.
+    """
+
+    name = "json"
+
+    def dumps(self, obj, pretty=False):
+        if pretty:
+            text = json.dumps(obj, indent=4, default=str)
+        else:
+            text = json.dumps(obj, separators=(",", ":"), default=str)
+        return text.encode("utf-8")
+
+
+class OrjsonSerializer(object):
+    """
+    Serializer using orjson, which is several times faster than the standard
+    library. orjson only supports two space indentation for pretty printing.
+    """
+
+    name = "orjson"
+
+    def dumps(self, obj, pretty=False):
+        option = orjson.OPT_INDENT_2 if pretty else 0
+        return orjson.dumps(obj, default=str, option=option)
+
+
+SERIALIZERS = {
+    "json": JSONSerializer,
+    "orjson": OrjsonSerializer,
+}
+_default = JSONSerializer()
+
+
+def init_app(app):
+    """
+    Chooses the JSON serializer from the JSON_SERIALIZER config value: "json"
+    for the standard library, "orjson" to require orjson or "auto" (the
+    default) to use orjson when it is installed and fall back to the
+    standard library otherwise.
+    """
+
+    name = app.config.get("JSON_SERIALIZER", "auto")
+    if name == "auto":
+        name = "orjson" if orjson is not None else "json"
+    if name not in SERIALIZERS:
+        raise ValueError("Unknown JSON_SERIALIZER '{}'".format(name))
+    if name == "orjson" and orjson is None:
+        raise ValueError("JSON_SERIALIZER is orjson but it is not installed")
+    app.extensions["serializer"] = SERIALIZERS[name]()
+
+
+def get_serializer():
+    """
+    Returns the serializer of the current app, or the standard library
+    serializer outside of an app context.
+    """
+
+    if has_app_context():
+        return current_app.extensions.get("serializer", _default)
+    return _default
@@ -11,5 +11,9 @@ setup(
         "flask-restful",
         "flask-sqlalchemy",
         "SQLAlchemy",
-    ]
+    ],
+    extras_require={
+        "fast": ["orjson"],
+        "async": ["aiosqlite", "uvicorn"],
+    }
 )
\ No newline at end of file
@@ -1,6 +1,77 @@
+import base64
+import binascii
+import hashlib
 import json
-from flask import Response, request, url_for
+from datetime import timezone
+from urllib.parse import quote
+from flask import (
+    Response, current_app, has_request_context, request, url_for
+)
+from api.metrics import timed
 from api.models import Book
+from api.serializers import get_serializer
+
+MASON = "application/vnd.mason+json"
+
+URL_PLACEHOLDER = "MASONURLPARAM{}MASONURLPARAM"
+
+
+class FrozenDict(dict):
+    """
+    A read-only dictionary. Used for data that is built once and then shared
+    between every response, such as the book schema, so that a handler can't
+    accidentally modify the shared copy. Being a dict subclass it serializes
+    like any other dictionary.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("FrozenDict does not support item assignment")
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+def freeze(obj):
+    """
+    Recursively converts dictionaries into FrozenDicts and lists into tuples.
+    : param obj: the object to freeze
+    """
+
+    if isinstance(obj, dict):
+        return FrozenDict((key, freeze(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+BOOK_SCHEMA = freeze(Book.get_schema())
+
+
+def cached_url_for(endpoint, **values):
+    """
+    A faster url_for for endpoints where all values are path variables. The
+    URL is built with url_for only once per endpoint and script root, after
+    which it is cached as a format string and filled with the quoted values.
+    : param str endpoint: the endpoint to build the URL for
+    """
+
+    key = (request.script_root, endpoint, tuple(sorted(values)))
+    templates = current_app.extensions.setdefault("mason_url_templates", {})
+    template = templates.get(key)
+    if template is None:
+        url = url_for(endpoint, **{
+            name: URL_PLACEHOLDER.format(name) for name in values
+        })
+        template = url.replace("{", "{{").replace("}", "}}")
+        for name in values:
+            template = template.replace(
+                URL_PLACEHOLDER.format(name), "{" + name + "}"
+            )
+        templates[key] = template
+
+    return template.format(**{
+        name: quote(str(value), safe="") for name, value in values.items()
+    })
 
 
 # Convenience functions for Mason
@@ -72,7 +143,7 @@ class LibraryBuilder(MasonBuilder):
     def add_control_get_books(self):
         self.add_control(
             "library:books-all",
-            url_for("api.bookcollection"),
+            cached_url_for("api.bookcollection"),
             method="GET",
             title="Get all books in the database"
         )
@@ -80,31 +151,340 @@ class LibraryBuilder(MasonBuilder):
     def add_control_add_book(self):
         self.add_control(
             "library:add-book",
-            url_for("api.bookcollection"),
+            cached_url_for("api.bookcollection"),
             method="POST",
             encoding="json",
             title="Add a new book",
-            schema=Book.get_schema()
+            schema=BOOK_SCHEMA
+        )
+
+    def add_control_search_books(self):
+        self.add_control(
+            "library:search",
+            cached_url_for("api.bookcollection") + "?q={q}",
+            method="GET",
+            isHrefTemplate=True,
+            title="Search books by title, author and description",
+            schema={
+                "type": "object",
+                "required": ["q"],
+                "properties": {
+                    "q": {
+                        "description": "Words to search for",
+                        "type": "string"
+                    }
+                }
+            }
+        )
+
+    def add_control_get_books_by_id(self):
+        self.add_control(
+            "library:books-by-id",
+            cached_url_for("api.bookcollection") + "?ids={ids}",
+            method="GET",
+            isHrefTemplate=True,
+            title="Get books by a comma separated list of ids",
+            schema={
+                "type": "object",
+                "required": ["ids"],
+                "properties": {
+                    "ids": {
+                        "description": "Comma separated book ids",
+                        "type": "string"
+                    }
+                }
+            }
+        )
+
+    def add_control_batch_books(self):
+        self.add_control(
+            "library:batch",
+            cached_url_for("api.bookbatch"),
+            method="POST",
+            encoding="json",
+            title="Create, edit and delete books in a batch"
         )
 
-    def add_control_edit_book(self, book_id):
+    def add_control_book_changes(self):
+        self.add_control(
+            "library:changes",
+            cached_url_for("api.bookchanges") + "?since={since}",
+            method="GET",
+            isHrefTemplate=True,
+            title="Get the changes to books after a sequence number",
+            schema={
+                "type": "object",
+                "properties": {
+                    "since": {
+                        "description": "Sequence number of the last change "
+                                       "the client has seen",
+                        "type": "integer"
+                    }
+                }
+            }
+        )
+
+    def add_control_edit_book(self, book_id, shared_schema=False):
+        """
+        Adds the edit control of a book. With shared_schema the control
+        refers to the book schema resource with schemaUrl instead of carrying
+        a copy of the schema, which keeps large collections small.
+        """
+
+        if shared_schema:
+            schema = {"schemaUrl": cached_url_for("api.bookschema")}
+        else:
+            schema = {"schema": BOOK_SCHEMA}
         self.add_control(
             "edit",
-            url_for("api.bookitem", book_id=book_id),
+            cached_url_for("api.bookitem", book_id=book_id),
             method="PUT",
             encoding="json",
             title="Edit this book",
-            schema=Book.get_schema()
+            **schema
         )
 
     def add_control_delete_book(self, book_id):
         self.add_control(
             "library:delete",
-            url_for("api.bookitem", book_id=book_id),
+            cached_url_for("api.bookitem", book_id=book_id),
             method="DELETE",
             title="Delete this book"
         )
 
+    def add_control_next_page(self, cursor, **params):
+        """
+        Adds the control for the next page of a paginated collection.
+        : param str cursor: cursor created with encode_cursor from the last
+        item of the page
+        : param params: other query parameters of the page, e.g. limit
+        """
+
+        self.add_control(
+            "next",
+            url_for("api.bookcollection", after=cursor, **params),
+            method="GET",
+            title="Get the next page of books"
+        )
+
+    def add_control_prev_page(self, cursor, **params):
+        """
+        Adds the control for the previous page of a paginated collection.
+        : param str cursor: cursor created with encode_cursor from the first
+        item of the page
+        : param params: other query parameters of the page, e.g. limit
+        """
+
+        self.add_control(
+            "prev",
+            url_for("api.bookcollection", before=cursor, **params),
+            method="GET",
+            title="Get the previous page of books"
+        )
+
+
+def encode_cursor(sort, book_id, value=None):
+    """
+    Encodes the position of a book in a sorted collection into an opaque
+    pagination cursor. Clients should treat the cursor as an opaque string
+    and only pass it back to the API.
+    : param str sort: name of the column the collection is sorted by
+    : param int book_id: the book_id of the book at the page boundary
+    : param value: the value of the sort column of the book, if not book_id
+    """
+
+    raw = json.dumps([sort, value, book_id], separators=(",", ":"))
+    cursor = base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+    return cursor.rstrip("=")
+
+
+def decode_cursor(cursor, sort="book_id"):
+    """
+    Decodes a pagination cursor created by encode_cursor back into a tuple of
+    (value, book_id). Returns None if no cursor was given and raises
+    ValueError if the cursor is malformed or was created for a different
+    sort order.
+    : param str cursor: the cursor from the query string
+    : param str sort: name of the column the collection is sorted by
+    """
+
+    if cursor is None:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+        cursor_sort, value, book_id = json.loads(raw)
+        if cursor_sort != sort or type(book_id) is not int:
+            raise ValueError
+        if value is not None and not isinstance(value, str):
+            raise ValueError
+        return value, book_id
+    except (ValueError, TypeError, UnicodeError, binascii.Error):
+        raise ValueError("Invalid pagination cursor '{}'".format(cursor))
+
+
+def book_etag(book_id, version):
+    """
+    Creates the strong ETag of a book representation from the book's
+    version, which is incremented on every write.
+    : param int book_id: id of the book
+    : param int version: current version of the book
+    """
+
+    return "book-{}-v{}".format(book_id, version)
+
+
+def collection_etag(counter):
+    """
+    Creates the strong ETag of a collection representation from the change
+    counter of the book table. Query parameters and the negotiated media type
+    change the representation so they are included as a short digest.
+    : param int counter: current value of the book table change counter
+    """
+
+    return "books-{}-{}".format(counter, representation_variant())
+
+
+def changes_etag(last):
+    """
+    Creates the strong ETag of a change feed representation from the
+    sequence number of the latest change, so that polling clients get a 304
+    when nothing has changed.
+    : param int last: sequence number of the latest change
+    """
+
+    return "changes-{}-{}".format(last, representation_variant())
+
+
+def representation_variant():
+    """
+    Returns a short digest of everything in the request, besides the path,
+    that changes the representation of a resource: the query string, the
+    Accept header and the script root the URLs in controls are built from.
+    """
+
+    variant = hashlib.sha1(request.query_string)
+    variant.update(str(request.accept_mimetypes).encode("utf-8"))
+    variant.update(request.script_root.encode("utf-8"))
+    return variant.hexdigest()[:12]
+
+
+def _etag_variants(etag):
+    """
+    Returns the ETag of a resource and the ETags of its compressed
+    representations, which have the content coding appended.
+    """
+
+    return [etag] + ["{}-{}".format(etag, coding) for coding in ("gzip", "br")]
+
+
+def _http_date(value):
+    if value is None:
+        return None
+    return value.replace(microsecond=0, tzinfo=timezone.utc)
+
+
+def is_not_modified(etag, last_modified=None):
+    """
+    Checks the If-None-Match and If-Modified-Since headers of the request
+    against the current validators of a resource. If-Modified-Since is only
+    considered when there is no If-None-Match header.
+    : param str etag: current ETag of the resource
+    : param datetime last_modified: last modification time in UTC, if known
+    """
+
+    if request.if_none_match:
+        return any(
+            request.if_none_match.contains_weak(variant)
+            for variant in _etag_variants(etag)
+        )
+    last_modified = _http_date(last_modified)
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def if_match_versions(book_id):
+    """
+    Returns the versions of a book listed in the If-Match header of the
+    request, for writes that check the precondition in their WHERE clause.
+    Returns None if there is no If-Match header or it is "*", and an empty
+    set if no listed ETag belongs to the book.
+    : param book_id: id of the book
+    """
+
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = set()
+    for etag in request.if_match.as_set():
+        for coding in ("gzip", "br"):
+            if etag.endswith("-" + coding):
+                etag = etag[:-len(coding) - 1]
+        prefix, __, version = etag.rpartition("-v")
+        if prefix == "book-{}".format(book_id) and version.isdigit():
+            versions.add(int(version))
+    return versions
+
+
+def add_validators(response, etag, last_modified=None):
+    """
+    Adds the ETag and Last-Modified headers to a response.
+    : param Response response: the response to add the headers to
+    : param str etag: current ETag of the resource
+    : param datetime last_modified: last modification time in UTC, if known
+    """
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = _http_date(last_modified)
+    return response
+
+
+def create_not_modified_response(etag, last_modified=None):
+    """
+    Creates a 304 response without a body
+    """
+
+    return add_validators(Response(status=304), etag, last_modified)
+
+
+def wants_pretty():
+    """
+    Checks whether the client asked for indented output with "?pretty=1".
+    """
+
+    return request.args.get("pretty") in ("1", "true")
+
+
+def serialize(body, pretty=None):
+    """
+    Serializes a body to JSON bytes with the serializer chosen for the app.
+    Output is compact unless pretty is set, which by default follows the
+    "pretty" query parameter.
+    : param body: the MasonBuilder or other JSON compatible object
+    : param bool pretty: whether to indent the output
+    """
+
+    if pretty is None:
+        pretty = has_request_context() and wants_pretty()
+    with timed("serialize"):
+        return get_serializer().dumps(body, pretty)
+
+
+def render_mason(body, status_code=200, mimetype=MASON, headers=None):
+    """
+    Creates a response from a MasonBuilder. Every Mason response of the API
+    is rendered here so that the encoder is chosen in one place.
+    : param MasonBuilder body: the body of the response
+    : param int status_code: HTTP status code of the response
+    : param str mimetype: media type of the response
+    : param dict headers: extra headers of the response
+    """
+
+    return Response(
+        serialize(body), status_code, mimetype=mimetype, headers=headers
+    )
+
 
 def create_error_response(status_code, title, message=None):
     """
@@ -114,9 +494,5 @@ def create_error_response(status_code, title, message=None):
     resource_url = request.path
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
-    return Response(
-        json.dumps(body, indent=4),
-        status_code,
-        mimetype="application/vnd.mason+json"
-    )
+    return render_mason(body, status_code)
 
@@ -0,0 +1,167 @@
+from api.metrics import timed
+
+# Python types accepted for each JSON schema type by the fast path. These are
+# deliberately strict, anything not accepted here is left to the full
+# validator to decide.
+FLAT_TYPES = {
+    "string": (str,),
+    "integer": (int,),
+    "number": (int, float),
+    "boolean": (bool,),
+}
+FLAT_KEYWORDS = {"type", "description"}
+
+_validators = {}
+
+
+def __getattr__(name):
+    # jsonschema takes a good part of the startup time, so it is only
+    # imported when a document fails the fast path or a caller catches its
+    # ValidationError
+    if name == "ValidationError":
+        from jsonschema import ValidationError
+        return ValidationError
+    raise AttributeError(
+        "module '{}' has no attribute '{}'".format(__name__, name)
+    )
+
+
+class FlatSchemaValidator(object):
+    """
+    A fast path for flat object schemas where every property only declares a
+    simple type. Documents are first checked with plain isinstance checks and
+    only documents that fail them are handed to the full jsonschema
+    validator, which then produces the detailed ValidationError. A document
+    accepted by the fast path is always valid according to the full schema.
+    The full validator is only compiled for the first document that fails
+    the fast path, or by preload.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self._validator = None
+        self.required = tuple(schema.get("required", ()))
+        self.types = {
+            name: FLAT_TYPES[prop["type"]]
+            for name, prop in schema["properties"].items()
+        }
+
+    @staticmethod
+    def supports(schema):
+        """
+        Checks whether the schema is simple enough for the fast path.
+        : param dict schema: the JSON schema
+        """
+
+        if set(schema) - {"type", "required", "properties"}:
+            return False
+        if schema.get("type") != "object":
+            return False
+        for prop in schema.get("properties", {}).values():
+            if set(prop) - FLAT_KEYWORDS:
+                return False
+            if prop.get("type") not in FLAT_TYPES:
+                return False
+        return True
+
+    def _is_valid(self, instance):
+        if type(instance) is not dict:
+            return False
+        for name in self.required:
+            if name not in instance:
+                return False
+        for name, value in instance.items():
+            types = self.types.get(name)
+            if types is None:
+                continue
+            if isinstance(value, bool) and bool not in types:
+                return False
+            if not isinstance(value, types):
+                return False
+        return True
+
+    @property
+    def validator(self):
+        if self._validator is None:
+            self._validator = compile_schema(self.schema)
+        return self._validator
+
+    def validate(self, instance):
+        if not self._is_valid(instance):
+            self.validator.validate(instance)
+
+
+def compile_schema(schema):
+    """
+    Checks a schema against its metaschema and returns the full jsonschema
+    validator for it.
+    : param dict schema: the JSON schema
+    """
+
+    from jsonschema.validators import validator_for
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def register_validator(model, partial=False):
+    """
+    Compiles the validator for a model's schema and adds it to the registry.
+    The schema is checked against its metaschema once, instead of on every
+    request: here, or for schemas with a fast path when the full validator
+    is first needed.
+    : param model: a model class with a get_schema static method
+    : param bool partial: compile the validator for partial documents, where
+        no property is required
+    """
+
+    schema = model.get_schema()
+    if partial:
+        schema.pop("required", None)
+    if FlatSchemaValidator.supports(schema):
+        validator = FlatSchemaValidator(schema)
+    else:
+        validator = compile_schema(schema)
+    _validators[model, partial] = validator
+    return validator
+
+
+def preload_validators():
+    """
+    Compiles the full validators of every registered schema that has a
+    fast path, which otherwise happens on the first invalid document.
+    """
+
+    for validator in list(_validators.values()):
+        if isinstance(validator, FlatSchemaValidator):
+            validator.validator
+
+
+def validate(instance, model, partial=False):
+    """
+    Validates a document against the schema of a model using the compiled
+    validator from the registry. Raises ValidationError if the document is
+    invalid.
+    : param instance: the deserialized JSON document
+    : param model: the model class whose schema to validate against
+    : param bool partial: validate a partial document, e.g. of a PATCH
+    """
+
+    validator = get_validator(model, partial)
+    with timed("validate"):
+        validator.validate(instance)
+
+
+def get_validator(model, partial=False):
+    """
+    Returns the compiled validator for a model's schema from the registry,
+    compiling it first if needed. Its validate method raises
+    ValidationError for invalid documents.
+    : param model: the model class
+    : param bool partial: the validator for partial documents
+    """
+
+    validator = _validators.get((model, partial))
+    if validator is None:
+        validator = register_validator(model, partial)
+    return validator
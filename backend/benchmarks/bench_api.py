@@ -0,0 +1,409 @@
+"""
+Load tests and micro-benchmarks for the books API.
+
+Every catalog size gets a fresh temporary database filled with a synthetic
+catalog, and the API is exercised through the Flask test client. Results are
+written as JSON so that runs can be compared with --compare.
+
+Usage, from the backend folder:
+    python -m benchmarks.bench_api --sizes 10000 100000 --output results.json
+    python -m benchmarks.bench_api --compare old.json --output new.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import jsonschema
+
+from api import create_app, db
+from api.models import Book
+from api.serializers import SERIALIZERS, orjson
+from api.utils import encode_cursor
+from api.validation import validate
+from benchmarks.bench_startup import bench_cold_start
+from benchmarks.catalog import generate_books, populate_catalog
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+# The whole collection is only rendered for catalogs up to this size
+FULL_COLLECTION_MAX_SIZE = 10000
+# Number of rows loaded per operation by the read path comparison
+READ_PATH_ROWS = 500
+
+
+def percentile(samples, pct):
+    """
+    Returns the pct percentile of a sorted list of samples using the
+    nearest-rank method.
+    """
+
+    index = max(0, int(round(pct / 100.0 * len(samples))) - 1)
+    return samples[min(index, len(samples) - 1)]
+
+
+def summarize(samples):
+    """
+    Summarizes latency samples given in seconds.
+    : param list samples: latencies of the individual operations
+    """
+
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        "count": len(samples),
+        "ops_per_s": round(len(samples) / total, 1) if total else None,
+        "mean_ms": round(total / len(samples) * 1000, 4),
+        "p50_ms": round(percentile(samples, 50) * 1000, 4),
+        "p99_ms": round(percentile(samples, 99) * 1000, 4),
+    }
+
+
+def measure(func, args_list):
+    """
+    Calls func once for every item in args_list and returns the summary of
+    the latencies.
+    """
+
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def request(client, method, url, expected, **kwargs):
+    resp = client.open(url, method=method, **kwargs)
+    resp.get_data()
+    if resp.status_code != expected:
+        raise RuntimeError("{} {} returned {}, expected {}".format(
+            method, url, resp.status_code, expected
+        ))
+
+
+def bench_size(size, iterations, config, seed=0):
+    """
+    Runs the API benchmarks against a catalog of the given size.
+    : param int size: number of books in the catalog
+    : param int iterations: number of requests per benchmark
+    : param dict config: extra app configuration
+    """
+
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    app = create_app(dict(
+        config,
+        SQLALCHEMY_DATABASE_URI="sqlite:///" + db_fname,
+        TESTING=True,
+    ))
+    results = {}
+    try:
+        start = time.perf_counter()
+        with app.app_context():
+            db.create_all()
+            populate_catalog(size, seed)
+        results["populate_s"] = round(time.perf_counter() - start, 2)
+        results["read_path"] = bench_read_path(
+            app, max(1, iterations // 10), min(size, READ_PATH_ROWS)
+        )
+
+        rng = random.Random(seed)
+        client = app.test_client()
+        book = {"title": "Benchmark", "author": "Bench", "description": "x"}
+        ids = lambda: [(rng.randint(1, size),) for __ in range(iterations)]
+        cursors = lambda sort: [
+            (encode_cursor(sort, book_id, value),)
+            for book_id, value in _sample_positions(app, sort, iterations, rng)
+        ]
+
+        if size <= FULL_COLLECTION_MAX_SIZE:
+            results["collection_get_full"] = measure(
+                lambda: request(client, "GET", "/api/books/", 200),
+                [()] * max(1, iterations // 20)
+            )
+        results["collection_get_first_page"] = measure(
+            lambda: request(client, "GET", "/api/books/?limit=50", 200),
+            [()] * iterations
+        )
+        results["collection_get_sparse_page"] = measure(
+            lambda: request(
+                client, "GET",
+                "/api/books/?limit=50&fields=title&controls=none", 200
+            ),
+            [()] * iterations
+        )
+        results["collection_get_deep_page"] = measure(
+            lambda cursor: request(
+                client, "GET", "/api/books/?limit=50&after=" + cursor, 200
+            ),
+            cursors("book_id")
+        )
+        results["collection_get_sorted_page"] = measure(
+            lambda cursor: request(
+                client, "GET",
+                "/api/books/?sort=title&limit=50&after=" + cursor, 200
+            ),
+            cursors("title")
+        )
+        results["collection_search"] = measure(
+            lambda word: request(
+                client, "GET", "/api/books/?limit=20&q=" + word, 200
+            ),
+            [(rng.choice(("dragon", "wiz", "ring stone")),)
+             for __ in range(iterations)]
+        )
+        results["item_get"] = measure(
+            lambda book_id: request(
+                client, "GET", "/api/books/{}/".format(book_id), 200
+            ),
+            ids()
+        )
+        # the same 50 books as one multi-get instead of 50 item requests
+        results["collection_get_50_ids"] = measure(
+            lambda: request(
+                client, "GET", "/api/books/?ids=" + ",".join(
+                    str(rng.randint(1, size)) for __ in range(50)
+                ), 200
+            ),
+            [()] * iterations
+        )
+        results["item_put"] = measure(
+            lambda book_id: request(
+                client, "PUT", "/api/books/{}/".format(book_id), 204,
+                json=book
+            ),
+            ids()
+        )
+        results["item_patch"] = measure(
+            lambda book_id: request(
+                client, "PATCH", "/api/books/{}/".format(book_id), 204,
+                json={"title": "Patched"}
+            ),
+            ids()
+        )
+        results["collection_post"] = measure(
+            lambda: request(client, "POST", "/api/books/", 201, json=book),
+            [()] * iterations
+        )
+        delete_ids = rng.sample(range(1, size + 1), min(iterations, size))
+        results["item_delete"] = measure(
+            lambda book_id: request(
+                client, "DELETE", "/api/books/{}/".format(book_id), 204
+            ),
+            [(book_id,) for book_id in delete_ids]
+        )
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+    return results
+
+
+def bench_read_path(app, iterations, rows):
+    """
+    Compares loading collection items through ORM entities with the Core
+    rows the read handlers use. Reports CPU time and peak memory per row
+    for loading the rows and building the Mason items from them.
+    : param int iterations: number of loads per read path
+    : param int rows: number of rows per load
+    """
+
+    from api.resources.book import FIELDS, _book_item, _select_books
+
+    loaders = {
+        "orm": lambda: Book.query.order_by(Book.book_id).limit(rows).all(),
+        "core": lambda: db.session.execute(
+            _select_books(FIELDS).order_by(Book.book_id).limit(rows)
+        ).all(),
+    }
+    results = {}
+    with app.test_request_context("/api/books/"):
+        for name, load in loaders.items():
+            def load_items():
+                items = [_book_item(book) for book in load()]
+                db.session.remove()
+                return items
+
+            timing = measure(load_items, [()] * iterations)
+            tracemalloc.start()
+            try:
+                load_items()
+                __, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            results[name] = {
+                "rows": rows,
+                "cpu_us_per_row": round(timing["mean_ms"] * 1000 / rows, 3),
+                "peak_bytes_per_row": peak // rows,
+            }
+    return results
+
+
+def _sample_positions(app, sort, count, rng):
+    """
+    Picks random books and returns their (book_id, sort value) positions for
+    building pagination cursors.
+    """
+
+    with app.app_context():
+        size = Book.query.count()
+        positions = []
+        for __ in range(count):
+            db_book = Book.query.get(rng.randint(1, size))
+            value = None if sort == "book_id" else getattr(db_book, sort)
+            positions.append((db_book.book_id, value))
+        return positions
+
+
+def bench_micro(iterations, config):
+    """
+    Micro-benchmarks serialization of collection items and schema
+    validation, outside of the request cycle.
+    : param int iterations: number of operations per benchmark
+    """
+
+    from api.resources.book import _book_item
+
+    app = create_app(dict(
+        config, SQLALCHEMY_DATABASE_URI="sqlite://", TESTING=True
+    ))
+    books = [
+        Book(book_id=index + 1, title=title, author=author,
+             description=description, version=1)
+        for index, (title, author, description)
+        in enumerate(generate_books(iterations))
+    ]
+    docs = [
+        {"title": title, "author": author, "description": description}
+        for title, author, description in generate_books(iterations)
+    ]
+    schema = Book.get_schema()
+    results = {}
+    with app.test_request_context("/api/books/"):
+        results["build_item"] = measure(_book_item, [(b,) for b in books])
+        items = [_book_item(b) for b in books]
+        for name, serializer_class in SERIALIZERS.items():
+            if name == "orjson" and orjson is None:
+                continue
+            serializer = serializer_class()
+            for pretty in (False, True):
+                key = "serialize_item_{}{}".format(
+                    name, "_pretty" if pretty else ""
+                )
+                results[key] = measure(
+                    lambda item: serializer.dumps(item, pretty),
+                    [(i,) for i in items]
+                )
+    results["validate_registry"] = measure(
+        lambda doc: validate(doc, Book), [(doc,) for doc in docs]
+    )
+    results["validate_jsonschema"] = measure(
+        lambda doc: jsonschema.validate(doc, schema), [(doc,) for doc in docs]
+    )
+    return results
+
+
+def environment():
+    try:
+        revision = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "revision": revision,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+    }
+
+
+def compare(old, new):
+    """
+    Prints the change in p50 and p99 latency of every benchmark found in both
+    results.
+    """
+
+    def flatten(results, prefix=""):
+        for key, value in results.items():
+            if isinstance(value, dict) and "p50_ms" in value:
+                yield prefix + key, value
+            elif isinstance(value, dict):
+                for item in flatten(value, prefix + key + "/"):
+                    yield item
+
+    old_results = dict(flatten(old["results"]))
+    print("{:55} {:>10} {:>10} {:>8}".format(
+        "benchmark", "old p50", "new p50", "change"
+    ))
+    for name, value in flatten(new["results"]):
+        if name not in old_results:
+            continue
+        before = old_results[name]["p50_ms"]
+        after = value["p50_ms"]
+        change = (after - before) / before * 100 if before else 0.0
+        print("{:55} {:>10.4f} {:>10.4f} {:>+7.1f}%".format(
+            name, before, after, change
+        ))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--profile", default="production",
+                        help="DATABASE_PROFILE to run the API with")
+    parser.add_argument("--cache", action="store_true",
+                        help="enable the in-process response cache")
+    parser.add_argument("--startup-runs", type=int, default=10,
+                        help="number of cold starts to measure, 0 to skip")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--compare", help="earlier results to compare with")
+    args = parser.parse_args(argv)
+
+    config = {
+        "DATABASE_PROFILE": args.profile,
+        "RESPONSE_CACHE": "memory" if args.cache else None,
+    }
+    report = {
+        "environment": environment(),
+        "options": {
+            "iterations": args.iterations,
+            "profile": args.profile,
+            "cache": args.cache,
+        },
+        "results": {"micro": bench_micro(args.iterations, config)},
+    }
+    if args.startup_runs:
+        report["results"]["startup"] = bench_cold_start(args.startup_runs)
+    for size in args.sizes:
+        print("Benchmarking {} books".format(size), file=sys.stderr)
+        report["results"][str(size)] = bench_size(size, args.iterations, config)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
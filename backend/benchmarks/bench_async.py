@@ -0,0 +1,204 @@
+"""
+Concurrent connection benchmark of the sync (WSGI) and async (ASGI) modes.
+
+Both modes serve the same catalog over real sockets. The WSGI app runs on a
+server with a fixed pool of worker threads, like a threaded production
+server, and the ASGI app runs on uvicorn. Clients are simulated with
+asyncio. Like browsers, each client keeps its connection open and pauses
+between requests, so on the sync server an open connection holds a worker
+thread even while the client is idle. Results are written as JSON.
+
+Usage, from the backend folder (needs the async extras):
+    python -m benchmarks.bench_async --concurrency 10 50 200 --workers 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import uvicorn
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+
+from api import create_app, db
+from api.asgi import AsyncApp
+from benchmarks.bench_api import environment, summarize
+from benchmarks.catalog import populate_catalog
+
+DEFAULT_CONCURRENCY = (10, 50, 200)
+URL = "/api/books/?limit=20"
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    # keep-alive connections need HTTP/1.1
+    protocol_version = "HTTP/1.1"
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class PooledWSGIServer(ThreadedWSGIServer):
+    """
+    A WSGI server handling connections on a fixed number of worker threads,
+    so that a connection waits for a free worker like it would on a sync
+    production server.
+    """
+
+    def __init__(self, host, port, app, workers):
+        super().__init__(host, port, app, handler=QuietRequestHandler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(
+            self.process_request_thread, request, client_address
+        )
+
+
+async def client(port, requests, delay, samples):
+    """
+    Sends requests over one keep-alive connection, pausing between them,
+    and adds the latency of each request to samples.
+    """
+
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = "GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(URL)
+    try:
+        for index in range(requests):
+            start = time.perf_counter()
+            writer.write(request.encode("ascii"))
+            status = await reader.readline()
+            if b" 200 " not in status:
+                raise RuntimeError("Unexpected response " + repr(status))
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                name, __, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+            samples.append(time.perf_counter() - start)
+            if index < requests - 1:
+                await asyncio.sleep(delay)
+    finally:
+        writer.close()
+
+
+async def load(port, concurrency, requests, delay):
+    """
+    Runs about requests requests in total, split between the given number
+    of concurrent clients, and returns the latency summary and the
+    throughput.
+    """
+
+    samples = []
+    per_client = max(1, requests // concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        client(port, per_client, delay, samples) for __ in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    result = summarize(samples)
+    result["throughput_per_s"] = round(len(samples) / elapsed, 1)
+    return result
+
+
+def serve_sync(app, workers):
+    server = PooledWSGIServer("127.0.0.1", 0, app, workers)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server.server_port, server.shutdown
+
+
+def serve_async(app):
+    config = uvicorn.Config(
+        AsyncApp(app), host="127.0.0.1", port=0, log_level="warning",
+        access_log=False, lifespan="on"
+    )
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+
+    return port, stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--size", type=int, default=10000,
+                        help="number of books in the catalog")
+    parser.add_argument("--concurrency", type=int, nargs="+",
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="requests per concurrency level")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="worker threads of the sync server")
+    parser.add_argument("--delay", type=float, default=0.05,
+                        help="seconds each client pauses between requests")
+    parser.add_argument("--profile", default="production")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    args = parser.parse_args(argv)
+
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "DATABASE_PROFILE": args.profile,
+    })
+    report = {
+        "environment": environment(),
+        "options": vars(args),
+        "results": {},
+    }
+    try:
+        with app.app_context():
+            db.create_all()
+            populate_catalog(args.size)
+
+        for mode in ("sync", "async"):
+            if mode == "sync":
+                port, stop = serve_sync(app, args.workers)
+            else:
+                port, stop = serve_async(app)
+            try:
+                results = report["results"][mode] = {}
+                for concurrency in args.concurrency:
+                    print("Benchmarking {} mode with {} clients".format(
+                        mode, concurrency
+                    ), file=sys.stderr)
+                    results[str(concurrency)] = asyncio.run(load(
+                        port, concurrency, args.requests, args.delay
+                    ))
+            finally:
+                stop()
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
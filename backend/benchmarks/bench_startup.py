@@ -0,0 +1,247 @@
+"""
+Cold start and worker memory benchmark of the API.
+
+Cold start is measured in fresh interpreters: the time to import the api
+package, to run create_app and to serve the first read and the first
+invalid write, which pays for importing jsonschema, and the resident memory
+afterwards. Worker memory is measured like a server that forks its workers,
+such as gunicorn: a master process forks the workers, which serve a few
+requests each and report how much of their memory is private to them and
+how much they share with the master, with and without PRELOAD. The worker
+benchmark needs os.fork and /proc, so it only runs on Linux.
+
+Usage, from the backend folder:
+    python -m benchmarks.bench_startup --runs 10 --workers 4
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# Nothing from the api package is imported at module level, as the module
+# also runs the fresh interpreters that are measured
+BOOK_COUNT = 1000
+
+
+def bench_cold_start(runs):
+    """
+    Starts the API in runs fresh interpreters and summarizes the time of
+    each startup phase and the resident memory.
+    : param int runs: number of interpreters to start
+    """
+
+    from benchmarks.bench_api import summarize
+    samples = {}
+    rss = []
+    for __ in range(runs):
+        result = _run_child(["cold"])
+        rss.append(result.pop("rss_mb"))
+        for phase, seconds in result.items():
+            samples.setdefault(phase, []).append(seconds)
+    results = {
+        phase: summarize(values) for phase, values in samples.items()
+    }
+    results["rss_mb"] = sorted(rss)[len(rss) // 2]
+    return results
+
+
+def bench_workers(workers, requests):
+    """
+    Measures the memory of forked worker processes with and without
+    PRELOAD. Returns None where os.fork or /proc is not available.
+    : param int workers: number of worker processes
+    : param int requests: requests served by each worker before measuring
+    """
+
+    if not hasattr(os, "fork") or not os.path.exists("/proc/self/smaps_rollup"):
+        return None
+
+    from api import create_app, db
+    from benchmarks.catalog import populate_catalog
+
+    db_fd, db_fname = tempfile.mkstemp(suffix=".db")
+    try:
+        app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+        with app.app_context():
+            db.create_all()
+            populate_catalog(BOOK_COUNT)
+            db.engine.dispose()
+        return {
+            mode: _run_child([
+                "workers", db_fname, str(workers), str(requests), mode
+            ])
+            for mode in ("no_preload", "preload")
+        }
+    finally:
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+def _run_child(args):
+    output = subprocess.check_output(
+        [sys.executable, "-m", "benchmarks.bench_startup", "--child"] + args
+    )
+    return json.loads(output)
+
+
+def _child_cold():
+    """
+    Runs in a fresh interpreter and reports the duration of every startup
+    phase in seconds.
+    """
+
+    results = {}
+    start = time.perf_counter()
+    from api import create_app, db
+    from api.database import memory_database_uri
+    results["import"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": memory_database_uri()})
+    results["create_app"] = time.perf_counter() - start
+
+    with app.app_context():
+        db.create_all()
+    client = app.test_client()
+    start = time.perf_counter()
+    client.get("/api/books/")
+    results["first_read"] = time.perf_counter() - start
+    start = time.perf_counter()
+    client.post("/api/books/", json={"title": 1})
+    results["first_invalid_write"] = time.perf_counter() - start
+
+    results["rss_mb"] = round(_memory()["Rss"] / 1024.0, 1)
+    return results
+
+
+def _child_workers(db_fname, workers, requests, mode):
+    """
+    Runs in a fresh interpreter as the master process: forks the workers,
+    lets each of them serve requests and reports the average memory of a
+    worker in MiB. Private memory is what a worker adds, PSS counts the
+    pages shared with the master and the other workers proportionally.
+    """
+
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "DATABASE_PROFILE": "production",
+        "RESPONSE_CACHE": "memory",
+        "PRELOAD": mode == "preload",
+    }
+    app = None
+    if mode == "preload":
+        from api import create_app
+        app = create_app(config)
+
+    pipes = []
+    for __ in range(workers):
+        read_fd, write_fd = os.pipe()
+        if os.fork() == 0:
+            os.close(read_fd)
+            try:
+                memory = _serve(app, config, requests)
+                os.write(write_fd, json.dumps(memory).encode("utf-8"))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        pipes.append(read_fd)
+
+    reports = []
+    for read_fd in pipes:
+        with os.fdopen(read_fd, "rb") as f:
+            reports.append(json.loads(f.read()))
+        os.wait()
+    return {
+        key + "_mb": round(
+            sum(report[key] for report in reports) / len(reports) / 1024.0, 1
+        )
+        for key in ("Rss", "Pss", "Private")
+    }
+
+
+def _serve(app, config, requests):
+    if app is None:
+        from api import create_app
+        app = create_app(config)
+    from api.preload import warm_pool
+    warm_pool(app)
+    client = app.test_client()
+    for index in range(requests):
+        client.get("/api/books/?limit=20")
+        client.get("/api/books/{}/".format(index % BOOK_COUNT + 1))
+    client.post("/api/books/", json={"title": 1})
+    # wait until every worker has served its requests, so that the pages
+    # of the others are counted as shared
+    time.sleep(1)
+    return _memory()
+
+
+def _memory():
+    """
+    Reads the memory of the current process in KiB from /proc.
+    """
+
+    memory = {}
+    path = "/proc/self/smaps_rollup"
+    if not os.path.exists(path):
+        import resource
+        return {"Rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    with open(path) as f:
+        for line in f:
+            name, __, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                memory[name] = int(value.split()[0])
+    memory["Private"] = memory["Private_Clean"] + memory["Private_Dirty"]
+    return memory
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10,
+                        help="number of cold starts")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of forked worker processes")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="requests served by each worker")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        if args.child[0] == "cold":
+            result = _child_cold()
+        else:
+            db_fname, workers, requests, mode = args.child[1:]
+            result = _child_workers(db_fname, int(workers), int(requests), mode)
+        print(json.dumps(result))
+        return
+
+    from benchmarks.bench_api import environment
+    report = {
+        "environment": environment(),
+        "options": {
+            "runs": args.runs,
+            "workers": args.workers,
+            "requests": args.requests,
+        },
+        "results": {
+            "cold_start": bench_cold_start(args.runs),
+            "workers": bench_workers(args.workers, args.requests),
+        },
+    }
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import random
+from api import db
+
+WORDS = (
+    "dragon wizard ring stone tower witch wardrobe lion river mountain "
+    "shadow crown sword garden ocean winter summer night star forest "
+    "king queen thief ghost castle island storm secret mirror clock"
+).split()
+FIRST_NAMES = ("Anna", "Ben", "Clara", "David", "Eva", "Frank", "Grace", "Hugo")
+LAST_NAMES = ("Smith", "Jones", "Brown", "Taylor", "Wilson", "Davies", "Evans")
+INSERT_SQL = (
+    "INSERT INTO book (title, author, description, version, updated_at) "
+    "VALUES (?, ?, ?, 1, CURRENT_TIMESTAMP)"
+)
+
+
+def generate_books(count, seed=0):
+    """
+    Generates synthetic book rows as (title, author, description) tuples.
+    The same seed always produces the same catalog so that results of
+    different runs can be compared.
+    : param int count: number of books to generate
+    : param int seed: seed for the random generator
+    """
+
+    rng = random.Random(seed)
+    for __ in range(count):
+        title = " ".join(rng.choice(WORDS) for __ in range(rng.randint(2, 5)))
+        author = "{} {}".format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+        description = " ".join(rng.choice(WORDS) for __ in range(20))
+        yield title.capitalize(), author, description
+
+
+def populate_catalog(count, seed=0, batch_size=10000):
+    """
+    Fills the book table of the current app with a synthetic catalog using
+    executemany in large batches on the raw DB-API connection.
+    : param int count: number of books to insert
+    : param int seed: seed for the random generator
+    : param int batch_size: number of rows per executemany call
+    """
+
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        batch = []
+        for row in generate_books(count, seed):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                cursor.executemany(INSERT_SQL, batch)
+                batch = []
+        if batch:
+            cursor.executemany(INSERT_SQL, batch)
+        cursor.execute(
+            "INSERT INTO change_counter (name, value, updated_at) "
+            "VALUES ('book', 1, CURRENT_TIMESTAMP)"
+        )
+        conn.commit()
+        cursor.execute("ANALYZE")
+        conn.commit()
+    finally:
+        conn.close()
@@ -0,0 +1,12 @@
+# Settings for serving the API with gunicorn. Run from the backend folder:
+#     gunicorn "api:create_app()"
+# with PRELOAD = True and DATABASE_PROFILE = "production" in
+# instance/config.py, so that the app is warmed up once in the master and
+# shared by the workers.
+
+preload_app = True
+
+
+def post_fork(server, worker):
+    from api.preload import warm_pool
+    warm_pool(worker.app.wsgi())
@@ -1,19 +1,34 @@
+import asyncio
+import gzip
 import json
 import os
 import pytest
 import tempfile
+import threading
 from jsonschema import validate
+from sqlalchemy import event
 
 from api import create_app, db
-from api.models import Book
+from api.cache import CachedResponse, MemoryCache, get_cache
+from api.database import memory_database_uri
+from api.events import (
+    RESYNC, ChangeLogBackend, EventBroker, Subscriber, get_broker
+)
+from api.limits import ConcurrencyLimiter
+from api.models import Book, BookChange
+from api.resources.book import _book_item
+from api.serializers import SERIALIZERS, get_serializer
+from api.utils import serialize
+
+MASON = "application/vnd.mason+json"
 
 
 # Based on http://flask.pocoo.org/docs/1.0/testing/
 @pytest.fixture
 def client():
-    db_fd, db_fname = tempfile.mkstemp()
     config = {
-        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLALCHEMY_DATABASE_URI": memory_database_uri(),
+        "RESPONSE_CACHE": "memory",
         "TESTING": True
     }
     
@@ -26,8 +41,6 @@ def client():
     yield app.test_client()
     
     db.session.remove()
-    os.close(db_fd)
-    os.unlink(db_fname)
 
 
 def _populate_db():
@@ -62,6 +75,39 @@ def _get_book_json():
             "description": "Young wizard with a bad-ass scar fights against a bad guy with a weird nose."
             }
 
+def _get_query_plans(client, url):
+    """
+    Makes a GET request and returns the EXPLAIN QUERY PLAN output of every
+    SELECT from the book table that was run during the request, one string
+    per statement.
+    """
+
+    statements = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    with client.application.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        resp = client.get(url)
+        assert resp.status_code == 200
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+
+    plans = []
+    conn = engine.raw_connection()
+    try:
+        for statement, parameters in statements:
+            if "FROM book" not in statement:
+                continue
+            cursor = conn.cursor()
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            plans.append(" / ".join(row[-1] for row in cursor.fetchall()))
+    finally:
+        conn.close()
+    return plans
+
 def _check_control_get_method(ctrl, client, obj):
     """
     Checks a GET type control from a JSON object be it root document or an item
@@ -143,6 +189,28 @@ class TestApiEntry(object):
         resp = client.get(self.RESOURCE_URL)
         assert resp.status_code == 200
 
+    # test compact output by default and indentation on request
+    def test_get_pretty(self, client):
+        compact = client.get(self.RESOURCE_URL)
+        assert b"\n" not in compact.data
+        pretty = client.get(self.RESOURCE_URL + "?pretty=1")
+        assert b"\n" in pretty.data
+        assert json.loads(pretty.data) == json.loads(compact.data)
+
+    # test that every serializer produces the same documents
+    def test_serializers(self):
+        book = Book(book_id=1, title="Dune", version=1)
+        for name in SERIALIZERS:
+            app = create_app({"JSON_SERIALIZER": name, "TESTING": True})
+            with app.test_request_context("/api/books/"):
+                assert get_serializer().name == name
+                item = _book_item(book)
+                for pretty in (False, True):
+                    data = serialize(item, pretty)
+                    assert json.loads(data) == json.loads(json.dumps(item))
+        with pytest.raises(ValueError):
+            create_app({"JSON_SERIALIZER": "yaml"})
+
 
 class TestBookCollection(object):
     
@@ -160,6 +228,250 @@ class TestBookCollection(object):
         for item in body["items"]:
             _check_control_get_method("self", client, item)
 
+    # test keyset pagination with limit and cursors
+    def test_get_paginated(self, client):
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [1, 2]
+        assert "prev" not in body["@controls"]
+
+        # follow the next control to the last page
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [3]
+        assert "next" not in body["@controls"]
+
+        # and back again with the prev control
+        resp = client.get(body["@controls"]["prev"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [1, 2]
+        assert "prev" not in body["@controls"]
+        assert "next" in body["@controls"]
+
+        # test with invalid limit and cursor
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=abc")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=notacursor")
+        assert resp.status_code == 400
+
+    # test filtering and sorting, also across pages
+    def test_get_filtered_sorted(self, client):
+        book = _get_book_json()
+        del book["book_id"]
+        for title in ("Chamber of Secrets", "Prisoner of Azkaban"):
+            client.post(self.RESOURCE_URL, json=dict(book, title=title))
+
+        resp = client.get(self.RESOURCE_URL + "?author=J.%20K.%20Rowling&sort=title")
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [4, 1, 5]
+        resp = client.get(self.RESOURCE_URL + "?title_prefix=The%20L")
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [3]
+        resp = client.get(self.RESOURCE_URL + "?sort=-book_id")
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [5, 4, 3, 2, 1]
+
+        # page through books sorted by author, ties broken by book_id
+        url = self.RESOURCE_URL + "?sort=-author&limit=2"
+        pages = []
+        while url:
+            body = json.loads(client.get(url).data)
+            pages.append([item["book_id"] for item in body["items"]])
+            url = body["@controls"].get("next", {}).get("href")
+        assert pages == [[2, 5], [4, 1], [3]]
+        body = json.loads(client.get(body["@controls"]["prev"]["href"]).data)
+        assert [item["book_id"] for item in body["items"]] == [4, 1]
+
+        resp = client.get(self.RESOURCE_URL + "?sort=price")
+        assert resp.status_code == 400
+        # cursors can't be used with a different sort order
+        cursor = body["@controls"]["next"]["href"].split("after=")[1].split("&")[0]
+        resp = client.get(self.RESOURCE_URL + "?sort=title&after=" + cursor)
+        assert resp.status_code == 400
+
+    # test that filtered and sorted pages are read in order from an index
+    def test_get_filtered_sorted_plans(self, client):
+        urls = {
+            "?author=x&sort=title&limit=2": "ix_book_author_title_book_id",
+            "?author=x&limit=2": "ix_book_author_book_id",
+            "?title_prefix=Th&sort=title&limit=2": "ix_book_title_book_id",
+            "?sort=-title&limit=2": "ix_book_title_book_id",
+            "?sort=author&limit=2": "ix_book_author_book_id",
+        }
+        for url, index in urls.items():
+            plans = _get_query_plans(client, self.RESOURCE_URL + url)
+            assert len(plans) == 1
+            assert index in plans[0]
+            assert "TEMP B-TREE" not in plans[0]
+
+        # pages after a cursor seek into the index
+        for sort, seek in (("title", "(title>?)"), ("-title", "(title<?)")):
+            url = self.RESOURCE_URL + "?limit=1&sort=" + sort
+            body = json.loads(client.get(url).data)
+            plans = _get_query_plans(client, body["@controls"]["next"]["href"])
+            assert "USING INDEX ix_book_title_book_id " + seek in plans[0]
+            assert "TEMP B-TREE" not in plans[0]
+
+    # test streaming NDJSON representation
+    def test_get_stream(self, client):
+        requests = [
+            (self.RESOURCE_URL + "?stream=1", {}),
+            (self.RESOURCE_URL, {"Accept": "application/x-ndjson"}),
+        ]
+        for url, headers in requests:
+            resp = client.get(url, headers=headers)
+            assert resp.status_code == 200
+            assert resp.mimetype == "application/x-ndjson"
+            lines = resp.data.decode("utf-8").splitlines()
+            items = [json.loads(line) for line in lines]
+            assert [item["book_id"] for item in items] == [1, 2, 3]
+            for item in items:
+                _check_control_get_method("self", client, item)
+
+        # filters and sort order apply to the stream as well
+        resp = client.get(
+            self.RESOURCE_URL + "?stream=1&author=C.%20S.%20Lewis"
+        )
+        lines = resp.data.decode("utf-8").splitlines()
+        assert [json.loads(line)["book_id"] for line in lines] == [3]
+        resp = client.get(
+            self.RESOURCE_URL + "?sort=-title",
+            headers={"Accept": "application/x-ndjson"}
+        )
+        lines = resp.data.decode("utf-8").splitlines()
+        assert [json.loads(line)["book_id"] for line in lines] == [3, 2, 1]
+        for query in ("q=ring", "limit=2"):
+            resp = client.get(self.RESOURCE_URL + "?stream=1&" + query)
+            assert resp.status_code == 400
+
+    # test that items can refer to the shared schema instead of copying it
+    def test_get_shared_schema(self, client):
+        resp = client.get(self.RESOURCE_URL + "?schema=shared")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert "schema" in body["@controls"]["library:add-book"]
+        for item in body["items"]:
+            edit = item["@controls"]["edit"]
+            assert "schema" not in edit
+            resp = client.get(edit["schemaUrl"])
+            assert resp.status_code == 200
+            assert json.loads(resp.data) == body["@controls"]["library:add-book"]["schema"]
+
+    # test sparse fieldsets and control levels
+    def test_get_sparse(self, client):
+        full = client.get(self.RESOURCE_URL)
+        resp = client.get(self.RESOURCE_URL + "?fields=title&controls=none")
+        assert resp.status_code == 200
+        assert len(resp.data) < len(full.data)
+        body = json.loads(resp.data)
+        assert "library:add-book" in body["@controls"]
+        for item in body["items"]:
+            assert set(item) == {"book_id", "title"}
+
+        resp = client.get(self.RESOURCE_URL + "?fields=author&controls=minimal")
+        for item in json.loads(resp.data)["items"]:
+            assert set(item) == {"book_id", "author", "@controls"}
+            assert list(item["@controls"]) == ["self"]
+            _check_control_get_method("self", client, item)
+
+        # only the requested columns and the sort column are selected
+        statements = []
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            url = self.RESOURCE_URL + "?fields=title&sort=author&limit=2"
+            body = json.loads(client.get(url).data)
+            client.get(body["@controls"]["next"]["href"])
+            client.get(self.RESOURCE_URL + "?fields=title&stream=1")
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+        selects = [s for s in statements if "FROM book" in s]
+        assert len(selects) == 3
+        for statement in selects:
+            assert "description" not in statement.split("FROM")[0]
+        assert "book.author" in selects[0].split("FROM")[0]
+
+        for query in ("?fields=title,isbn", "?controls=some"):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+
+    # test getting books by a list of ids
+    def test_get_ids(self, client, monkeypatch):
+        resp = client.get(self.RESOURCE_URL + "?ids=3,99,1,3&fields=title")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [3, 99, 1, 3]
+        assert body["items"][0]["title"] == "The Lion, the Witch and the Wardrobe"
+        assert body["items"][1]["status"] == 404
+        assert "@error" in body["items"][1]
+        assert "title" not in body["items"][1]
+        _check_control_get_method("self", client, body["items"][2])
+
+        monkeypatch.setattr("api.resources.book.IDS_CHUNK_SIZE", 2)
+        statements = []
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            resp = client.get(self.RESOURCE_URL + "?ids=1,2,3&stream=1")
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+        assert resp.mimetype == MASON
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [1, 2, 3]
+        selects = [s for s in statements if "FROM book" in s]
+        assert len(selects) == 2
+        assert all(" IN " in statement for statement in selects)
+
+        for query in ("?ids=1,a", "?ids=", "?ids=1&q=ring", "?ids=1&limit=2",
+                      "?ids=1&author=C.%20S.%20Lewis", "?ids=1&title_prefix=L",
+                      "?ids=" + ",".join(["1"] * 1001)):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+
+    # test full-text search and that the index follows writes
+    def test_get_search(self, client):
+        resp = client.get(self.RESOURCE_URL + "?q=wizard")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [1]
+
+        # title matches rank above description matches, last word is a prefix
+        resp = client.get(self.RESOURCE_URL + "?q=witc")
+        body = json.loads(resp.data)
+        assert [item["book_id"] for item in body["items"]] == [3]
+        resp = client.get(self.RESOURCE_URL + '?q="bad guy')
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 2
+
+        book = _get_book_json()
+        book["title"] = "Dune"
+        book["description"] = "Sand."
+        client.put("/api/books/1/", json=book)
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=wizard").data)
+        assert body["items"] == []
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=dune").data)
+        assert [item["book_id"] for item in body["items"]] == [1]
+        client.delete("/api/books/1/")
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=dune").data)
+        assert body["items"] == []
+
+        resp = client.get(self.RESOURCE_URL + "?q=dune&after=Ym9vazox")
+        assert resp.status_code == 400
+        for query in ("&author=C.%20S.%20Lewis", "&title_prefix=L"):
+            resp = client.get(self.RESOURCE_URL + "?q=wizard" + query)
+            assert resp.status_code == 400
+
     # test POST method
     def test_post(self, client):
         valid = _get_book_json()
@@ -201,6 +513,41 @@ class TestBookItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    # test conditional GET and optimistic concurrency with ETags
+    def test_conditional(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        assert resp.headers["Last-Modified"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.data == b""
+
+        # collection ETag changes on every write
+        resp = client.get("/api/books/")
+        collection_etag = resp.headers["ETag"]
+        resp = client.get("/api/books/", headers={"If-None-Match": collection_etag})
+        assert resp.status_code == 304
+
+        resp = client.put(
+            self.RESOURCE_URL, json=_get_book_json(),
+            headers={"If-Match": etag}
+        )
+        assert resp.status_code == 204
+        assert resp.headers["ETag"] != etag
+        resp = client.get("/api/books/", headers={"If-None-Match": collection_etag})
+        assert resp.status_code == 200
+
+        # stale ETag is rejected
+        resp = client.put(
+            self.RESOURCE_URL, json=_get_book_json(),
+            headers={"If-Match": etag}
+        )
+        assert resp.status_code == 412
+        resp = client.delete(self.RESOURCE_URL, headers={"If-Match": etag})
+        assert resp.status_code == 412
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
     # test PUT method
     def test_put(self, client):
         valid = _get_book_json()
@@ -223,6 +570,66 @@ class TestBookItem(object):
         assert resp.status_code == 400
         
         
+    # test PATCH method
+    def test_patch(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        before = json.loads(resp.data)
+        resp = client.patch(self.RESOURCE_URL, json={"title": "Patched"})
+        assert resp.status_code == 204
+        assert resp.headers["ETag"] != etag
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["title"] == "Patched"
+        assert body["author"] == before["author"]
+        assert body["description"] == before["description"]
+
+        resp = client.patch(
+            self.RESOURCE_URL, json={"author": "x"},
+            headers={"If-Match": etag}
+        )
+        assert resp.status_code == 412
+        assert resp.headers["ETag"] != etag
+        resp = client.patch(self.RESOURCE_URL, json={"title": 1})
+        assert resp.status_code == 400
+        resp = client.patch(self.RESOURCE_URL, json={"isbn": "1"})
+        assert resp.status_code == 400
+        resp = client.patch(self.RESOURCE_URL, data="title")
+        assert resp.status_code == 415
+        resp = client.patch(self.INVALID_URL, json={"title": "x"})
+        assert resp.status_code == 404
+
+    # test that writes don't read the book before changing it
+    def test_write_statements(self, client):
+        statements = []
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            etag = '"book-1-v1"'
+            resp = client.put(
+                self.RESOURCE_URL, json=_get_book_json(),
+                headers={"If-Match": etag}
+            )
+            assert resp.status_code == 204
+            resp = client.delete(
+                self.RESOURCE_URL, headers={"If-Match": resp.headers["ETag"]}
+            )
+            assert resp.status_code == 204
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+        books = [
+            s for s in statements
+            if "change_counter" not in s and "book_change" not in s
+        ]
+        assert len(books) == 2
+        assert books[0].startswith("UPDATE book")
+        assert books[1].startswith("DELETE FROM book")
+        changes = [s for s in statements if "book_change" in s]
+        assert len(changes) == 2
+        assert all(s.startswith("INSERT INTO book_change") for s in changes)
+
     # test DELETE method
     def test_delete(self, client):
         resp = client.delete(self.RESOURCE_URL)
@@ -232,3 +639,804 @@ class TestBookItem(object):
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
 
+    # test that a book created after deleting the last one gets a new id, so
+    # that the ETag of the deleted book doesn't match it
+    def test_delete_recreate(self, client):
+        etag = client.get("/api/books/3/").headers["ETag"]
+        assert client.delete("/api/books/3/").status_code == 204
+        book = _get_book_json()
+        del book["book_id"]
+        resp = client.post("/api/books/", json=book)
+        assert resp.status_code == 201
+        assert resp.headers["Location"].endswith("/api/books/4/")
+        resp = client.get("/api/books/3/", headers={"If-None-Match": etag})
+        assert resp.status_code == 404
+        resp = client.put(
+            "/api/books/4/", json=book, headers={"If-Match": etag}
+        )
+        assert resp.status_code == 412
+
+
+class TestInstrumentation(object):
+
+    # test Server-Timing headers, the metrics endpoint and the profiler
+    def test_instrumentation(self, client):
+        resp = client.get("/api/books/1/")
+        assert "Server-Timing" not in resp.headers
+        assert client.get("/api/_metrics").status_code == 404
+
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "RESPONSE_CACHE": "memory",
+            "INSTRUMENTATION": True,
+            "INSTRUMENTATION_PROFILER": True,
+            "TESTING": True
+        })
+        with app.app_context():
+            db.create_all()
+            _populate_db()
+        client = app.test_client()
+        try:
+            resp = client.get("/api/books/1/")
+            timing = resp.headers["Server-Timing"]
+            assert "total;dur=" in timing
+            assert 'db;dur=' in timing and "statements" in timing
+            assert "serialize;dur=" in timing
+            resp = client.put("/api/books/1/", json=_get_book_json())
+            assert "validate;dur=" in resp.headers["Server-Timing"]
+
+            resp = client.get("/api/_metrics")
+            assert resp.status_code == 200
+            text = resp.data.decode("utf-8")
+            assert "# TYPE library_http_request_duration_seconds histogram" in text
+            assert ('library_http_request_duration_seconds_count{'
+                    'endpoint="api.bookitem",method="GET",status="200"} 1') in text
+            assert 'phase="validate"' in text
+            assert "library_response_cache_misses 1" in text
+
+            resp = client.get("/api/books/?_profile=1")
+            assert resp.mimetype == "text/plain"
+            assert b"cumulative" in resp.data
+        finally:
+            with app.app_context():
+                db.session.remove()
+            os.close(db_fd)
+            os.unlink(db_fname)
+
+
+class TestResponseCache(object):
+
+    # test that representations are served from the cache until a write
+    def test_cache_invalidation(self, client):
+        for url in ("/api/books/", "/api/books/1/"):
+            resp = client.get(url)
+            assert "X-Cache" not in resp.headers
+            resp = client.get(url)
+            assert resp.headers["X-Cache"] == "HIT"
+            etag = resp.headers["ETag"]
+            resp = client.get(url, headers={"If-None-Match": etag})
+            assert resp.status_code == 304
+
+        body = _get_book_json()
+        body["title"] = "Cached"
+        resp = client.put("/api/books/1/", json=body)
+        assert resp.status_code == 204
+        for url in ("/api/books/", "/api/books/1/"):
+            resp = client.get(url)
+            assert "X-Cache" not in resp.headers
+            assert b"Cached" in resp.data
+
+        resp = client.delete("/api/books/1/")
+        assert client.get("/api/books/1/").status_code == 404
+        body = json.loads(client.get("/api/books/").data)
+        assert len(body["items"]) == 2
+        with client.application.app_context():
+            assert get_cache().stats["hits"] == 2
+
+    # test that the cache of a worker process doesn't serve stale responses
+    # after a write in another worker process
+    def test_cache_workers(self, client):
+        worker = create_app(client.application.config).test_client()
+        for url in ("/api/books/", "/api/books/2/"):
+            client.get(url)
+            assert client.get(url).headers["X-Cache"] == "HIT"
+
+        body = _get_book_json()
+        body["title"] = "Elsewhere"
+        resp = worker.put("/api/books/2/", json=body)
+        assert resp.status_code == 204
+        for url in ("/api/books/", "/api/books/2/"):
+            resp = client.get(url)
+            assert "X-Cache" not in resp.headers
+            assert b"Elsewhere" in resp.data
+
+    # test that the memory cache evicts least recently used entries
+    def test_memory_cache_eviction(self):
+        cache = MemoryCache(max_entries=2, max_bytes=10)
+        entry = lambda body: CachedResponse(body, 200, MASON, None, None)
+        cache.set("a", entry(b"1234"))
+        cache.set("b", entry(b"1234"))
+        assert cache.get("a") is not None
+        cache.set("c", entry(b"1234"))
+        assert cache.get("b") is None
+        assert len(cache) == 2
+        cache.set("d", entry(b"12345678"))
+        assert len(cache) == 1
+        assert cache.size == 8
+        assert cache.evictions == 3
+
+
+class TestCompression(object):
+
+    # test that large responses are compressed when the client accepts it
+    def test_compressed(self, client):
+        plain = client.get("/api/books/")
+        assert len(plain.data) > 1024
+        assert "Content-Encoding" not in plain.headers
+        assert "Accept-Encoding" in plain.headers["Vary"]
+
+        resp = client.get("/api/books/", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == plain.data
+        assert resp.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+
+        # second request is a cache hit served with the stored gzip body
+        resp = client.get("/api/books/", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["X-Cache"] == "HIT"
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == plain.data
+
+        resp = client.get("/api/books/", headers={
+            "If-None-Match": resp.headers["ETag"]
+        })
+        assert resp.status_code == 304
+
+    # test that small responses are sent as they are
+    def test_small_response(self, client):
+        resp = client.get("/api/", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+        json.loads(resp.data)
+
+        etag = client.get("/api/books/1/").headers["ETag"]
+        body = _get_book_json()
+        body["book_id"] = 1
+        resp = client.put("/api/books/1/", json=body, headers={
+            "If-Match": etag[:-1] + '-gzip"'
+        })
+        assert resp.status_code == 204
+
+    # test that streamed responses are compressed chunk by chunk
+    def test_stream_compressed(self, client):
+        resp = client.get("/api/books/?stream=1", headers={
+            "Accept-Encoding": "gzip"
+        })
+        assert resp.headers["Content-Encoding"] == "gzip"
+        lines = gzip.decompress(resp.data).splitlines()
+        assert len(lines) == 3
+        assert json.loads(lines[0])["title"]
+
+
+class TestAsync(object):
+
+    # test that the ASGI app serves the same reads as the Flask app
+    def test_asgi_reads(self, client):
+        asgi = pytest.importorskip("api.asgi")
+        app = asgi.AsyncApp(client.application)
+        urls = [
+            "/api/books/",
+            "/api/books/?limit=1&sort=-title&fields=title",
+            "/api/books/?q=ring",
+            "/api/books/?controls=x",
+            "/api/books/2/",
+            "/api/books/99/",
+            "/api/books/changes/?since=0",
+            "/api/books/?ids=2,99&fields=title",
+        ]
+        responses = _asgi_requests(app, [("GET", url) for url in urls])
+        for url, (status, headers, body) in zip(urls, responses):
+            resp = client.get(url)
+            assert status == resp.status_code
+            assert body == resp.data
+            assert headers.get("etag") == resp.headers.get("ETag")
+
+        book = _get_book_json()
+        book["title"] = "Async"
+        responses = _asgi_requests(app, [
+            ("PUT", "/api/books/2/", json.dumps(book).encode("utf-8")),
+            ("GET", "/api/books/2/"),
+            ("HEAD", "/api/books/2/"),
+            ("GET", "/api/books/?stream=1"),
+            ("GET", "/api/nothing/"),
+        ])
+        assert responses[0][0] == 204
+        assert json.loads(responses[1][2])["title"] == "Async"
+        assert responses[2][0] == 200 and responses[2][2] == b""
+        assert responses[2][1]["etag"] == responses[1][1]["etag"]
+        assert responses[3][1]["content-type"] == "application/x-ndjson"
+        assert len(responses[3][2].splitlines()) == 3
+        assert responses[4][0] == 404
+
+    # test that a slow client of a request served by the Flask app doesn't
+    # hold up the other requests that go through it
+    def test_asgi_overlapping_fallbacks(self, client):
+        asgi = pytest.importorskip("api.asgi")
+        app = asgi.AsyncApp(client.application)
+        book = json.dumps(_get_book_json()).encode("utf-8")
+
+        async def run():
+            stalled = asyncio.Event()
+            release = asyncio.Event()
+            async def slow_send(message):
+                if message["type"] == "http.response.body":
+                    stalled.set()
+                    await release.wait()
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+            stream = asyncio.ensure_future(app(
+                _asgi_scope("GET", "/api/books/?stream=1"), receive, slow_send
+            ))
+            await stalled.wait()
+
+            sent = []
+            async def send(message):
+                sent.append(message)
+            async def receive_book():
+                return {"type": "http.request", "body": book, "more_body": False}
+            try:
+                await asyncio.wait_for(app(
+                    _asgi_scope("PUT", "/api/books/1/", book), receive_book, send
+                ), 5)
+            finally:
+                release.set()
+                await stream
+                await app.engine.dispose()
+            return sent[0]["status"]
+
+        assert asyncio.run(run()) == 204
+
+
+    # test that the Flask app gets the whole body of a request sent in
+    # several messages and that its streamed response is passed on in parts
+    def test_asgi_fallback(self, client):
+        asgi = pytest.importorskip("api.asgi")
+        app = asgi.AsyncApp(client.application)
+        book = _get_book_json()
+        del book["book_id"]
+        body = json.dumps(book).encode("utf-8")
+
+        async def run():
+            responses = []
+            for scope, parts in [
+                (_asgi_scope("POST", "/api/books/", body), [body[:10], body[10:]]),
+                (_asgi_scope("GET", "/api/books/?stream=1"), [b""]),
+            ]:
+                messages = [
+                    {"type": "http.request", "body": part, "more_body": True}
+                    for part in parts
+                ]
+                messages[-1]["more_body"] = False
+                sent = []
+                async def receive():
+                    return messages.pop(0)
+                async def send(message):
+                    sent.append(message)
+                await app(scope, receive, send)
+                responses.append(sent)
+            await app.engine.dispose()
+            return responses
+
+        created, stream = asyncio.run(run())
+        assert created[0]["status"] == 201
+        assert (b"location", b"http://localhost/api/books/4/") in created[0]["headers"]
+        assert stream[0]["status"] == 200
+        bodies = [m["body"] for m in stream[1:] if m["body"]]
+        assert len(bodies) == 4
+        assert not stream[-1]["more_body"]
+        assert client.get("/api/books/4/").status_code == 200
+
+
+def _asgi_requests(app, requests):
+    """
+    Sends requests given as (method, url) or (method, url, JSON body) tuples
+    to an ASGI app one after another. Returns a (status, headers, body) tuple
+    for each request with the header names in lower case.
+    """
+
+    async def run():
+        responses = []
+        for method, url, *body in requests:
+            scope = _asgi_scope(method, url, *body)
+            messages = [{
+                "type": "http.request", "body": body[0] if body else b"",
+                "more_body": False
+            }]
+            sent = []
+            async def receive():
+                return messages.pop(0)
+            async def send(message):
+                sent.append(message)
+            await app(scope, receive, send)
+            responses.append((
+                sent[0]["status"],
+                {k.decode(): v.decode() for k, v in sent[0]["headers"]},
+                b"".join(m.get("body", b"") for m in sent[1:]),
+            ))
+        await app.engine.dispose()
+        return responses
+
+    return asyncio.run(run())
+
+
+def _asgi_scope(method, url, body=None):
+    """
+    Builds the ASGI scope of a request with an optional JSON body.
+    """
+
+    path, __, query = url.partition("?")
+    headers = [(b"host", b"localhost")]
+    if body:
+        headers.append((b"content-type", b"application/json"))
+        headers.append((b"content-length", str(len(body)).encode("ascii")))
+    return {
+        "type": "http", "http_version": "1.1", "method": method,
+        "scheme": "http", "path": path, "root_path": "",
+        "query_string": query.encode("ascii"), "headers": headers,
+    }
+
+
+class TestBookBatch(object):
+
+    RESOURCE_URL = "/api/books/batch/"
+
+    # test that a mixed batch is applied and reported per item
+    def test_post(self, client):
+        book = _get_book_json()
+        del book["book_id"]
+        ops = [
+            dict(book, op="create"),
+            dict(book, op="update", book_id=1, title="Updated"),
+            {"op": "delete", "book_id": 2},
+            {"op": "delete", "book_id": 999},
+            dict(book, op="update", book_id=3, title=[]),
+            {"op": "rename"},
+        ]
+        resp = client.post(self.RESOURCE_URL + "?chunk_size=2", json=ops)
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert [item["status"] for item in items] == [201, 204, 204, 404, 400, 400]
+        assert client.get(items[0]["href"]).status_code == 200
+        assert json.loads(client.get("/api/books/1/").data)["title"] == "Updated"
+        assert client.get("/api/books/2/").status_code == 404
+
+        # test NDJSON input
+        data = "\n".join(json.dumps(dict(book, op="create")) for i in range(3))
+        resp = client.post(
+            self.RESOURCE_URL, data=data,
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert [item["status"] for item in items] == [201, 201, 201]
+
+        # test with wrong content type and a non-array document
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(ops))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json=book)
+        assert resp.status_code == 400
+
+    # test that the books of a chunk are created with a single INSERT
+    def test_post_statements(self, client):
+        statements = []
+        def capture(conn, cursor, statement, *args):
+            statements.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        book = _get_book_json()
+        del book["book_id"]
+        ops = [dict(book, op="create", title=str(i)) for i in range(5)]
+        event.listen(engine, "before_cursor_execute", capture)
+        try:
+            resp = client.post(self.RESOURCE_URL, json=ops)
+        finally:
+            event.remove(engine, "before_cursor_execute", capture)
+        assert resp.status_code == 200
+        items = json.loads(resp.data)["items"]
+        assert [item["book_id"] for item in items] == [4, 5, 6, 7, 8]
+        inserts = [s for s in statements if s.startswith("INSERT INTO book ")]
+        assert len(inserts) == 1
+        for i, item in enumerate(items):
+            body = json.loads(client.get(item["href"]).data)
+            assert body["title"] == str(i)
+        body = json.loads(client.get("/api/books/changes/?since=0").data)
+        assert [change["book_id"] for change in body["items"]] == [4, 5, 6, 7, 8]
+
+    # test that an atomic batch is applied all or nothing
+    def test_post_atomic(self, client):
+        ops = [
+            {"op": "delete", "book_id": 1},
+            {"op": "delete", "book_id": 999},
+        ]
+        resp = client.post(self.RESOURCE_URL + "?atomic=1", json=ops)
+        assert resp.status_code == 400
+        items = json.loads(resp.data)["items"]
+        assert [item["status"] for item in items] == [424, 404]
+        assert client.get("/api/books/1/").status_code == 200
+
+        resp = client.post(self.RESOURCE_URL + "?atomic=1", json=ops[:1])
+        assert resp.status_code == 200
+        assert client.get("/api/books/1/").status_code == 404
+
+
+class TestBookChanges(object):
+
+    RESOURCE_URL = "/api/books/changes/"
+
+    # test that writes show up in the feed in order
+    def test_get(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["seq"] == 0
+        assert body["items"] == []
+
+        resp = client.post("/api/books/", json=_get_book_json())
+        assert resp.status_code == 201
+        book = _get_book_json()
+        book["title"] = "Changed"
+        resp = client.put("/api/books/1/", json=book)
+        assert resp.status_code == 204
+        resp = client.delete("/api/books/2/")
+        assert resp.status_code == 204
+        resp = client.post("/api/books/batch/", json=[
+            {"op": "update", "book_id": 3, "title": "Batched"},
+            {"op": "delete", "book_id": 4},
+        ])
+        assert resp.status_code == 200
+
+        resp = client.get(self.RESOURCE_URL + "?since=0")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["seq"] == 5
+        assert body["more"] is False
+        assert [(item["op"], item["book_id"]) for item in body["items"]] == [
+            ("create", 4), ("update", 1), ("delete", 2), ("update", 3),
+            ("delete", 4),
+        ]
+        create, update, delete, batched = body["items"][:4]
+        assert "title" not in create
+        assert update["title"] == "Changed"
+        assert update["version"] == 2
+        assert "title" not in delete
+        assert batched["title"] == "Batched"
+        _check_control_get_method("self", client, update)
+        _check_control_get_method("collection", client, body)
+
+        # every change reports the version it created
+        for title in ("Second", "Third"):
+            book["title"] = title
+            client.put("/api/books/1/", json=book)
+        resp = client.get(self.RESOURCE_URL + "?since=5")
+        body = json.loads(resp.data)
+        assert [item["version"] for item in body["items"]] == [3, 4]
+        assert body["items"][0]["title"] == "Third"
+
+        resp = client.get(self.RESOURCE_URL + "?since=2&limit=2")
+        body = json.loads(resp.data)
+        assert [item["seq"] for item in body["items"]] == [3, 4]
+        assert body["more"] is True
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["seq"] for item in body["items"]] == [5, 6]
+        assert body["more"] is True
+        resp = client.get(body["@controls"]["next"]["href"])
+        body = json.loads(resp.data)
+        assert [item["seq"] for item in body["items"]] == [7]
+        assert body["more"] is False
+
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+        resp = client.get(
+            body["@controls"]["next"]["href"],
+            headers={"If-None-Match": resp.headers["ETag"]}
+        )
+        assert resp.status_code == 304
+
+        resp = client.get(self.RESOURCE_URL + "?since=x")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?since=-1")
+        assert resp.status_code == 400
+
+    # test that compaction keeps the latest change of each book and that
+    # clients behind the retention have to reload
+    def test_compact(self, client):
+        for title in ("One", "Two", "Three"):
+            book = _get_book_json()
+            book["title"] = title
+            resp = client.put("/api/books/1/", json=book)
+            assert resp.status_code == 204
+        resp = client.delete("/api/books/2/")
+
+        with client.application.app_context():
+            BookChange.compact()
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL + "?since=0")
+        body = json.loads(resp.data)
+        assert [(item["seq"], item["op"]) for item in body["items"]] == [
+            (3, "update"), (4, "delete")
+        ]
+        assert body["items"][0]["title"] == "Three"
+
+        with client.application.app_context():
+            BookChange.compact(max_rows=1)
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL + "?since=0")
+        assert resp.status_code == 410
+        resp = client.get(self.RESOURCE_URL + "?since=3")
+        body = json.loads(resp.data)
+        assert [item["seq"] for item in body["items"]] == [4]
+
+        client.application.config["CHANGE_LOG_COMPACT_EVERY"] = 5
+        client.application.config["CHANGE_LOG_RETENTION"] = 0
+        resp = client.delete("/api/books/3/")
+        resp = client.get(self.RESOURCE_URL + "?since=4")
+        assert resp.status_code == 410
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        assert body["seq"] == 5
+        resp = client.get(self.RESOURCE_URL + "?since=5")
+        assert json.loads(resp.data)["items"] == []
+
+
+def _read_events(chunks):
+    """
+    Reads the next chunk of an event stream and returns its events as
+    (event, id, data) tuples, skipping comments and the retry field.
+    """
+
+    events = []
+    for block in next(chunks).decode("utf-8").split("\n\n"):
+        fields = dict(
+            line.split(": ", 1) for line in block.splitlines()
+            if line and not line.startswith(":")
+        )
+        if "event" in fields:
+            events.append((
+                fields["event"], fields.get("id"), json.loads(fields["data"])
+            ))
+    return events
+
+
+class TestBookEvents(object):
+
+    RESOURCE_URL = "/api/books/events/"
+
+    # test that the ASGI app serves the stream on the event loop, so that
+    # an open stream doesn't hold up writes, and ends it on a disconnect
+    def test_asgi(self, client):
+        asgi = pytest.importorskip("api.asgi")
+        app = asgi.AsyncApp(client.application)
+        book = json.dumps(_get_book_json()).encode("utf-8")
+
+        async def run():
+            messages = asyncio.Queue()
+            disconnected = asyncio.Event()
+            async def send(message):
+                await messages.put(message)
+            async def receive():
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+            stream = asyncio.ensure_future(
+                app(_asgi_scope("GET", self.RESOURCE_URL), receive, send)
+            )
+            start = await asyncio.wait_for(messages.get(), 5)
+            first = await asyncio.wait_for(messages.get(), 5)
+
+            sent = []
+            async def send_book(message):
+                sent.append(message)
+            async def receive_book():
+                return {"type": "http.request", "body": book, "more_body": False}
+            await asyncio.wait_for(app(
+                _asgi_scope("PUT", "/api/books/1/", book), receive_book, send_book
+            ), 5)
+            event = await asyncio.wait_for(messages.get(), 5)
+            disconnected.set()
+            await asyncio.wait_for(stream, 5)
+            await app.engine.dispose()
+            return start, first, sent[0]["status"], event
+
+        start, first, status, event = asyncio.run(run())
+        assert start["status"] == 200
+        headers = dict(start["headers"])
+        assert headers[b"content-type"].startswith(b"text/event-stream")
+        assert b"content-length" not in headers
+        assert first["body"] == b"retry: 3000\n\n"
+        assert status == 204
+        assert _read_events(iter([event["body"]])) == [
+            ("update", "1", {"seq": 1, "op": "update", "book_id": 1,
+                             "version": 2})
+        ]
+        with client.application.app_context():
+            assert get_broker().stats["subscribers"] == 0
+
+    # test that writes are pushed to subscribers and replayed after a
+    # reconnect
+    def test_get(self, client):
+        client.application.config["EVENTS_HEARTBEAT"] = 0.01
+        stream = client.get(self.RESOURCE_URL)
+        assert stream.status_code == 200
+        assert stream.mimetype == "text/event-stream"
+        chunks = iter(stream.response)
+        assert next(chunks) == b"retry: 3000\n\n"
+
+        resp = client.post("/api/books/", json=_get_book_json())
+        assert resp.status_code == 201
+        book = _get_book_json()
+        book["title"] = "Changed"
+        client.put("/api/books/1/", json=book)
+        client.post("/api/books/batch/", json=[
+            {"op": "delete", "book_id": 2},
+        ])
+        assert _read_events(chunks) == [
+            ("create", "1", {"seq": 1, "op": "create", "book_id": 4,
+                             "version": 1}),
+            ("update", "2", {"seq": 2, "op": "update", "book_id": 1,
+                             "version": 2}),
+            ("delete", "3", {"seq": 3, "op": "delete", "book_id": 2}),
+        ]
+        with client.application.app_context():
+            assert get_broker().stats["subscribers"] == 1
+        stream.close()
+        with client.application.app_context():
+            assert get_broker().stats["subscribers"] == 0
+
+        resp = client.get(self.RESOURCE_URL, headers={"Last-Event-ID": "1"})
+        chunks = iter(resp.response)
+        assert [event[1] for event in _read_events(chunks)] == ["2", "3"]
+        resp.close()
+
+        with client.application.app_context():
+            BookChange.compact(max_rows=1)
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL + "?since=1")
+        chunks = iter(resp.response)
+        assert _read_events(chunks) == [
+            ("reset", "2", {"seq": 2, "op": "reset"})
+        ]
+        resp.close()
+        resp = client.get(self.RESOURCE_URL + "?since=x")
+        assert resp.status_code == 400
+
+    # test that a slow subscriber is told to resync instead of queueing
+    def test_slow_subscriber(self, client):
+        client.application.config["EVENTS_HEARTBEAT"] = 0.01
+        with client.application.app_context():
+            get_broker().max_events = 2
+        resp = client.get(self.RESOURCE_URL)
+        chunks = iter(resp.response)
+        next(chunks)
+        for book_id in (1, 2, 3):
+            client.delete("/api/books/{}/".format(book_id))
+        assert _read_events(chunks) == [("resync", None, {"since": 0})]
+        client.post("/api/books/", json=_get_book_json())
+        assert [event[0] for event in _read_events(chunks)] == ["create"]
+        with client.application.app_context():
+            assert get_broker().stats["dropped"] == 1
+        resp.close()
+
+        subscriber = Subscriber(2)
+        assert subscriber.put([{"seq": 1}, {"seq": 2}])
+        assert not subscriber.put([{"seq": 3}])
+        assert not subscriber.put([{"seq": 4}])
+        assert subscriber.get(0) == [RESYNC]
+        assert subscriber.get(0) == []
+
+    # test that the change log backend publishes changes committed by
+    # other processes
+    def test_changelog_backend(self, client):
+        app = client.application
+        app.config["EVENTS_HEARTBEAT"] = 1.0
+        app.extensions["events"] = EventBroker(app, ChangeLogBackend(0.01))
+        stream = client.get(self.RESOURCE_URL)
+        chunks = iter(stream.response)
+        next(chunks)
+        with app.app_context():
+            BookChange.record("delete", 2)
+            db.session.commit()
+        assert _read_events(chunks) == [
+            ("delete", "1", {"seq": 1, "op": "delete", "book_id": 2})
+        ]
+        stream.close()
+
+
+class TestAdmissionControl(object):
+
+    def _create_client(self, **config):
+        config.update({
+            "SQLALCHEMY_DATABASE_URI": memory_database_uri(),
+            "INSTRUMENTATION": True,
+            "TESTING": True
+        })
+        app = create_app(config)
+        with app.app_context():
+            db.create_all()
+            _populate_db()
+        return app.test_client()
+
+    # test that each client gets its own token bucket per endpoint class
+    def test_rate_limit(self, client):
+        assert client.application.extensions["limits"] is None
+        client = self._create_client(RATE_LIMITS={"collection": (0.1, 2)})
+        assert client.get("/api/books/").status_code == 200
+        assert client.get("/api/books/?ids=1").status_code == 200
+        resp = client.get("/api/books/")
+        assert resp.status_code == 429
+        assert resp.headers["Retry-After"] == "10"
+        body = json.loads(resp.data)
+        assert body["@error"]["@message"] == "Too many requests"
+        assert client.get("/api/books/1/").status_code == 200
+        assert client.post("/api/books/", json=_get_book_json()).status_code == 201
+        other = {"REMOTE_ADDR": "10.0.0.2"}
+        assert client.get(
+            "/api/books/", environ_base=other
+        ).status_code == 200
+
+        text = client.get("/api/_metrics").data.decode("utf-8")
+        assert "library_admission_collection_rate_limited 1" in text
+
+        with pytest.raises(ValueError):
+            create_app({"RATE_LIMITS": {"search": (1, 1)}})
+
+    # test that requests over the concurrency limit of their endpoint class
+    # are queued or rejected and that finished requests free their slot
+    def test_concurrency_limit(self, client):
+        client = self._create_client(
+            CONCURRENCY_LIMITS={"collection": 1, "write": 1},
+            CONCURRENCY_QUEUE_SIZE=0
+        )
+        limiter = client.application.extensions["limits"].limiters["collection"]
+        assert limiter.acquire()
+        resp = client.get("/api/books/")
+        assert resp.status_code == 503
+        assert resp.headers["Retry-After"] == "1"
+        assert client.get("/api/books/1/").status_code == 200
+        limiter.release()
+        assert client.get("/api/books/").status_code == 200
+        resp = client.get("/api/books/?stream=1")
+        assert limiter.active == 1
+        resp.close()
+        assert limiter.active == 0
+        assert client.delete("/api/books/1/").status_code == 204
+        assert client.application.extensions["limits"].limiters[
+            "write"
+        ].active == 0
+
+        text = client.get("/api/_metrics").data.decode("utf-8")
+        assert "library_admission_collection_rejected 1" in text
+        assert "library_admission_collection_queued 0" in text
+
+        limiter = ConcurrencyLimiter(1, max_queue=1, timeout=5.0)
+        assert limiter.acquire()
+        # signals once the waiter is in the queue, the limiter's lock is
+        # taken again as soon as it waits
+        queued = threading.Event()
+        wait = limiter._cond.wait
+        def wait_queued(timeout=None):
+            queued.set()
+            return wait(timeout)
+        limiter._cond.wait = wait_queued
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(
+            limiter.acquire()
+        ))
+        waiter.start()
+        assert queued.wait(5)
+        assert not limiter.acquire()
+        assert not limiter.acquire(wait=False)
+        limiter.release()
+        waiter.join()
+        assert results == [True] and limiter.active == 1
+        assert limiter.rejected == 2
+        assert not ConcurrencyLimiter(0, max_queue=1, timeout=0.01).acquire()
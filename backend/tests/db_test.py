@@ -1,9 +1,21 @@
+import gc
+import json
 import os
 import pytest
+import sqlite3
 import tempfile
-from sqlalchemy.exc import IntegrityError
+import threading
+from contextlib import closing
+from sqlalchemy import event, inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.pool import QueuePool
 from api import create_app, db
 from api.models import *
+from api.bulk import export_books_command, import_books_command
+from api.database import connect_memory_database, memory_database_uri
+from api.preload import warm_pool
+from api.validation import get_validator
 
 # Based on http://flask.pocoo.org/docs/1.0/testing/
 @pytest.fixture
@@ -33,6 +45,13 @@ def _get_book():
         description="Young wizard with a bad-ass scar fights against a bad guy with a weird nose."
     )
 
+def _search(terms):
+    return db.session.execute(Book.search_statement(terms, 10)).all()
+
+def _book_counter():
+    row = db.session.execute(ChangeCounter.select("book")).first()
+    return 0 if row is None else row.value
+
 def test_create_instances(app):
     """
     Tests that we can create one instance of each model and save them to the
@@ -69,6 +88,194 @@ def test_book_columns(app):
         db.session.add(book)  
         assert Book.query.first() == book
 
+def test_production_profile():
+    """
+    Tests that the production profile pools connections and runs its pragmas
+    on every connection, and that single pragmas can be overridden
+    """
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "DATABASE_PROFILE": "production",
+        "SQLITE_PRAGMAS": {"cache_size": -1000},
+        "TESTING": True
+    })
+    try:
+        with app.app_context():
+            assert isinstance(db.engine.pool, QueuePool)
+            with db.engine.connect() as conn:
+                pragma = lambda name: conn.execute(
+                    db.text("PRAGMA " + name)
+                ).scalar()
+                assert pragma("journal_mode") == "wal"
+                assert pragma("synchronous") == 1
+                assert pragma("busy_timeout") == 5000
+                assert pragma("cache_size") == -1000
+            db.engine.dispose()
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+    with pytest.raises(ValueError):
+        create_app({"DATABASE_PROFILE": "fast"})
+
+def test_read_engine():
+    """
+    Tests that reads go to a read-only engine with its own pool and writes
+    to the primary, and that a client reads from the primary after a write
+    when reads go to a replica, without the response cache serving it a
+    stale read of the replica
+    """
+
+    db_fd, db_fname = tempfile.mkstemp()
+    replica_fd, replica_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "DATABASE_PROFILE": "production",
+        "READ_DATABASE": "readonly",
+        "TESTING": True
+    }
+    book = {"title": "Changed", "author": "a", "description": "d"}
+    try:
+        app = create_app(config)
+        with app.app_context():
+            db.create_all()
+            db.session.add(_get_book())
+            db.session.commit()
+        engine = app.extensions["read_engine"]
+        assert engine.url.query["mode"] == "ro"
+        with engine.connect() as conn:
+            with pytest.raises(OperationalError):
+                conn.execute(db.text("DELETE FROM book"))
+
+        statements = []
+        capture = lambda conn, cursor, statement, *args: statements.append(
+            statement
+        )
+        event.listen(engine, "before_cursor_execute", capture)
+        client = app.test_client()
+        assert client.get("/api/books/1/").status_code == 200
+        assert client.get("/api/books/?limit=1").status_code == 200
+        assert client.get("/api/books/?stream=1").status_code == 200
+        assert len([s for s in statements if "FROM book" in s]) == 3
+        resp = client.put("/api/books/1/", json=book)
+        assert resp.status_code == 204
+        assert "Set-Cookie" not in resp.headers
+        assert not [s for s in statements if s.startswith("UPDATE")]
+        body = json.loads(client.get("/api/books/1/").data)
+        assert body["title"] == "Changed"
+
+        # a replica that doesn't get the writes
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        engine.dispose()
+        with closing(sqlite3.connect(db_fname)) as source:
+            with closing(sqlite3.connect(replica_fname)) as replica:
+                source.backup(replica)
+        config["READ_DATABASE"] = "sqlite:///" + replica_fname
+        config["RESPONSE_CACHE"] = "memory"
+        app = create_app(config)
+        client = app.test_client()
+        book["title"] = "Newer"
+        resp = client.put("/api/books/1/", json=book)
+        assert "read_primary=1" in resp.headers["Set-Cookie"]
+        # stale reads of the replica are not cached for the writer
+        for __ in range(2):
+            body = json.loads(app.test_client().get("/api/books/1/").data)
+            assert body["title"] == "Changed"
+        assert len(app.extensions["response_cache"].backend) == 0
+        body = json.loads(client.get("/api/books/1/").data)
+        assert body["title"] == "Newer"
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        app.extensions["read_engine"].dispose()
+    finally:
+        os.close(db_fd)
+        os.close(replica_fd)
+        for fname in (db_fname, replica_fname):
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(fname + suffix):
+                    os.unlink(fname + suffix)
+
+    with pytest.raises(ValueError):
+        create_app({"READ_DATABASE": "readonly",
+                    "SQLALCHEMY_DATABASE_URI": "sqlite://"})
+
+def test_memory_database():
+    """
+    Tests that all connections of the process share a named in-memory
+    database for as long as the app lives, also from other threads
+    """
+
+    uri = memory_database_uri()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        db.session.add(_get_book())
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+        assert Book.query.count() == 1
+        rows = []
+        thread = threading.Thread(target=lambda: rows.append(
+            connect_memory_database(uri).execute(
+                "SELECT title FROM book"
+            ).fetchall()
+        ))
+        thread.start()
+        thread.join()
+        assert rows == [[(_get_book().title,)]]
+        db.session.remove()
+    assert not os.path.exists(os.path.join(app.root_path, uri.split("/")[-1]))
+
+    with pytest.raises(ValueError):
+        create_app({"READ_DATABASE": "readonly",
+                    "SQLALCHEMY_DATABASE_URI": uri})
+
+def test_preload():
+    """
+    Tests that preload compiles the full validators and warms up the reads
+    without leaving responses in the cache or connections in the pool
+    """
+
+    uri = memory_database_uri()
+    app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        db.session.add(_get_book())
+        db.session.commit()
+        db.session.remove()
+
+    statements = []
+    capture = lambda conn, cursor, statement, *args: statements.append(
+        statement
+    )
+    event.listen(Engine, "before_cursor_execute", capture)
+    try:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": uri,
+            "DATABASE_PROFILE": "production",
+            "RESPONSE_CACHE": "memory",
+            "PRELOAD": True,
+            "TESTING": True
+        })
+    finally:
+        event.remove(Engine, "before_cursor_execute", capture)
+        gc.unfreeze()
+    assert [s for s in statements if "FROM book" in s]
+    assert get_validator(Book)._validator is not None
+    assert app.extensions["mason_url_templates"]
+    cache = app.extensions["response_cache"]
+    assert len(cache.backend) == 0 and cache.hits == cache.misses == 0
+    with app.app_context():
+        assert db.engine.pool.checkedin() == 0
+        warm_pool(app)
+        assert db.engine.pool.checkedin() == db.engine.pool.size()
+    assert app.test_client().get("/api/books/1/").status_code == 200
+
 def test_cli_init(app):
     """
     Tests that init_db_command exists
@@ -77,6 +284,82 @@ def test_cli_init(app):
     result = runner.invoke(init_db_command)
     assert result
 
+def test_upgrade_db(app):
+    """
+    Tests that upgrade_db adds missing columns to an existing database
+    without losing data and rebuilds the book table with AUTOINCREMENT
+    """
+
+    with app.app_context():
+        db.drop_all()
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                "CREATE TABLE book (book_id INTEGER NOT NULL, title VARCHAR, "
+                "author VARCHAR, description VARCHAR, PRIMARY KEY (book_id))"
+            ))
+            conn.execute(db.text("INSERT INTO book (title) VALUES ('Dune')"))
+        upgrade_db()
+        sql = db.session.execute(db.text(
+            "SELECT sql FROM sqlite_master WHERE name = 'book'"
+        )).scalar()
+        assert "AUTOINCREMENT" in sql
+        indexes = {index["name"] for index in inspect(db.engine).get_indexes("book")}
+        assert "ix_book_author_title_book_id" in indexes
+        assert [book.title for book in _search("dune")] == ["Dune"]
+        book = Book.query.first()
+        assert book.title == "Dune"
+        assert book.version == 1
+        ChangeCounter.bump("book")
+        db.session.commit()
+        assert _book_counter() == 1
+        upgrade_db()
+        # the id of a deleted book is not reused
+        db.session.delete(book)
+        db.session.add(Book(title="Emma"))
+        db.session.commit()
+        assert [book.book_id for book in Book.query] == [2]
+        assert [book.title for book in _search("emma")] == ["Emma"]
+
+def test_cli_rebuild_search_index(app):
+    """
+    Tests that rebuild_search_index_command restores the search index
+    """
+
+    with app.app_context():
+        db.session.add(_get_book())
+        db.session.commit()
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                "INSERT INTO book_fts(book_fts) VALUES ('delete-all')"
+            ))
+        assert _search("wizard") == []
+    runner = app.test_cli_runner()
+    result = runner.invoke(rebuild_search_index_command)
+    assert result.exit_code == 0
+    with app.app_context():
+        assert len(_search("wizard")) == 1
+
+def test_cli_compact_changes(app):
+    """
+    Tests that compact_changes_command keeps the latest change of each book
+    """
+
+    with app.app_context():
+        db.session.add(_get_book())
+        db.session.flush()
+        BookChange.record("create", 1)
+        BookChange.record("update", 1)
+        BookChange.record("delete", 1)
+        db.session.commit()
+    runner = app.test_cli_runner()
+    result = runner.invoke(compact_changes_command)
+    assert result.exit_code == 0
+    with app.app_context():
+        changes = BookChange.query.all()
+        assert [(change.seq, change.op) for change in changes] == [
+            (3, "delete")
+        ]
+
 def test_cli_delete(app):
     """
     Tests that delete_db_command exists
@@ -91,4 +374,82 @@ def test_cli_testgen(app):
     """
     runner = app.test_cli_runner()
     result = runner.invoke(insert_initial_data)
-    assert result
\ No newline at end of file
+    assert result
+
+@pytest.mark.parametrize("fmt,fast", [("csv", False), ("ndjson", True)])
+def test_cli_import_export_books(app, tmp_path, fmt, fast):
+    """
+    Tests that import-books loads a file exported by export-books, in small
+    batches and with the fast mode rebuilding the indexes and search index
+    """
+
+    with app.app_context():
+        db.session.add(_get_book())
+        db.session.add(Book(title="Dune", author="Frank Herbert"))
+        db.session.commit()
+    path = str(tmp_path / ("books." + fmt))
+    runner = app.test_cli_runner()
+    result = runner.invoke(export_books_command, [path])
+    assert result.exit_code == 0
+    assert "Exported 2 books" in result.output
+
+    with app.app_context():
+        db.session.execute(db.delete(Book))
+        db.session.commit()
+    args = [path, "--batch-size", "1", "--commit-every", "1"]
+    if fast:
+        args.append("--fast")
+    result = runner.invoke(import_books_command, args)
+    assert result.exit_code == 0
+    assert "Imported 2 books" in result.output
+    with app.app_context():
+        books = Book.query.order_by(Book.book_id).all()
+        assert [(book.book_id, book.title) for book in books] == [
+            (1, "Harry Potter and the Philosopher's Stone"), (2, "Dune")
+        ]
+        assert books[1].description is None
+        assert books[1].version == 1
+        assert books[1].updated_at is not None
+        assert [book.title for book in _search("dune")] == ["Dune"]
+        indexes = {
+            index["name"] for index in inspect(db.engine).get_indexes("book")
+        }
+        assert "ix_book_author_title_book_id" in indexes
+        assert _book_counter() == 1
+        assert [change.op for change in BookChange.query] == ["reset"]
+
+        db.session.add(Book(title="Emma"))
+        db.session.commit()
+        assert [book.title for book in _search("emma")] == ["Emma"]
+
+def test_cli_import_books_invalid(app, tmp_path):
+    """
+    Tests that import-books stops at an invalid book or a duplicate id and
+    keeps the batches committed before it, which change the collection
+    """
+
+    path = tmp_path / "books.ndjson"
+    path.write_text(
+        '{"title": "Dune"}\n\n{"title": "Emma"}\n{"author": "Nobody"}\n'
+    )
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        import_books_command,
+        [str(path), "--batch-size", "1", "--commit-every", "1", "--fast"]
+    )
+    assert result.exit_code == 1
+    assert "line 4" in result.output
+    with app.app_context():
+        assert Book.query.count() == 2
+        assert len(_search("emma")) == 1
+        assert _book_counter() == 1
+
+    path = tmp_path / "books.txt"
+    path.write_text("book_id,title\n1,Persuasion\n")
+    result = runner.invoke(import_books_command, [str(path)])
+    assert result.exit_code == 2
+    result = runner.invoke(import_books_command, [str(path), "--format", "csv"])
+    assert result.exit_code == 1
+    assert "UNIQUE" in result.output
+    with app.app_context():
+        assert Book.query.count() == 2
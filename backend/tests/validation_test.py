@@ -0,0 +1,54 @@
+import pytest
+from jsonschema import validate as full_validate
+
+from api.models import Book
+from api.validation import (
+    FlatSchemaValidator, ValidationError, register_validator, validate
+)
+
+
+def _get_documents():
+    """
+    Returns a mix of valid and invalid book documents.
+    """
+
+    return [
+        {"title": "Dune", "author": "Frank Herbert", "description": "Sand."},
+        {"title": "Dune"},
+        {"title": "Dune", "book_id": 1, "extra": [1, 2]},
+        {"title": "Dune", "book_id": 1.0},
+        {"title": "Dune", "book_id": True},
+        {"title": True},
+        {"title": []},
+        {"title": None},
+        {"author": "Frank Herbert"},
+        [],
+        "Dune",
+    ]
+
+def test_fast_path_supported():
+    """
+    Tests that the flat book schema gets the fast path validator.
+    """
+
+    assert FlatSchemaValidator.supports(Book.get_schema())
+    assert isinstance(register_validator(Book), FlatSchemaValidator)
+    assert not FlatSchemaValidator.supports({
+        "type": "object",
+        "properties": {"tags": {"type": "array"}}
+    })
+
+def test_matches_full_validator():
+    """
+    Tests that the registry accepts and rejects exactly the same documents
+    as plain jsonschema validation.
+    """
+
+    for doc in _get_documents():
+        try:
+            full_validate(doc, Book.get_schema())
+        except ValidationError:
+            with pytest.raises(ValidationError):
+                validate(doc, Book)
+        else:
+            validate(doc, Book)
@@ -1,4 +1,4 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import BookList from '../BookList/BookList';
 import BookForm from '../BookForm/BookForm';
 import './appStyle.css';
@@ -11,10 +11,61 @@ function App() {
     updateBookList()
   }, []);
 
+  // sequence number of the last change in databaseBooks
+  const changeSeq = useRef(null);
+
   const updateBookList = () => {
-    fetch("/api/books/")
+    if (changeSeq.current === null) {
+      loadBookList()
+    } else {
+      syncBookList()
+    }
+  }
+
+  const loadBookList = () => {
+    fetch("/api/books/changes/")
       .then(response => response.json())
-      .then(data => { setBooks(data.items) })
+      .then(changes => fetch("/api/books/")
+        .then(response => response.json())
+        .then(data => {
+          changeSeq.current = changes.seq
+          setBooks(data.items)
+        }))
+  }
+
+  // Fetches only the changes since the last update and applies them
+  const syncBookList = () => {
+    fetch("/api/books/changes/?since=" + changeSeq.current)
+      .then(response => {
+        if (response.status === 410) {
+          changeSeq.current = null
+          return null
+        }
+        return response.json()
+      })
+      .then(data => {
+        if (data === null) {
+          loadBookList()
+          return
+        }
+        changeSeq.current = data.seq
+        setBooks(books => applyChanges(books, data.items))
+        if (data.more) {
+          syncBookList()
+        }
+      })
+  }
+
+  const applyChanges = (books, changes) => {
+    const byId = new Map(books.map(book => [book.book_id, book]))
+    changes.forEach(change => {
+      if (change.op === "delete") {
+        byId.delete(change.book_id)
+      } else if (change.version !== undefined) {
+        byId.set(change.book_id, change)
+      }
+    })
+    return Array.from(byId.values()).sort((a, b) => a.book_id - b.book_id)
   }
 
   return (
@@ -0,0 +1,4 @@
+ECHO OFF
+cd backend
+python -m benchmarks.bench_api --output benchmark-results.json %*
+PAUSE
\ No newline at end of file